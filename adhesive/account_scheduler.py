@@ -0,0 +1,208 @@
+import heapq
+import time
+import itertools
+
+from .leaky_bucket import LeakyBucket
+
+class _Slot:
+	__slots__ = 'account', 'index', 'version', 'space', 'last_used', 'enqueued'
+
+	def __init__(self, account, index):
+		self.account = account
+		self.index = index
+		# bumped whenever the slot is re-queued, so that older heap entries for it can be skipped
+		self.version = 0
+		self.space = 0
+		self.last_used = -1
+		self.enqueued = 0
+
+# Ready accounts are taken in ascending order of key(slot). Keys must not change while a slot is queued.
+
+def _most_space(slot):
+	bucket = slot.account.bucket
+	# when the bucket was last empty. this doesn't change as the bucket refills, and the earlier it was,
+	# the more space the bucket has now (full buckets tie in reality, but not here)
+	return bucket.last_updated_at - (bucket.space_remaining - bucket.reserved) / bucket.leak_rate_per_second
+
+def _round_robin(slot):
+	# accounts go to the back of the line whenever they're used or come back from waiting
+	return slot.enqueued
+
+def _least_recently_used(slot):
+	return slot.last_used
+
+STRATEGIES = dict(
+	most_space=_most_space,
+	round_robin=_round_robin,
+	least_recently_used=_least_recently_used,
+)
+
+class AccountScheduler:
+	"""Picks which account to use next, in O(log n) time.
+
+	Accounts with a token to spare are kept in a heap ordered by the strategy,
+	and the rest in a heap ordered by when they'll have one.
+	Anything that changes an account's bucket other than acquire() must call update(account) afterwards.
+	"""
+
+	def __init__(self, accounts, strategy='most_space', *, _timer=time.time):
+		try:
+			self.key = STRATEGIES[strategy]
+		except KeyError:
+			raise ValueError(f'unknown account strategy {strategy!r}; choose one of {", ".join(STRATEGIES)}')
+
+		self._timer = _timer
+		self._slots = [_Slot(account, i) for i, account in enumerate(accounts)]
+		self._by_id = {id(slot.account): slot for slot in self._slots}
+		self._ready = []
+		self._waiting = []
+		self._counter = itertools.count()
+		# total tokens across all accounts, as of when each one was last looked at
+		self.capacity = 0
+
+		now = _timer()
+		for slot in self._slots:
+			self._place(slot, now)
+
+	def __len__(self):
+		return len(self._slots)
+
+	def _place(self, slot, now):
+		slot.version += 1
+		bucket = slot.account.bucket
+		space = bucket.get_space_remaining(now)
+		self.capacity += space - slot.space
+		slot.space = space
+		if space >= 1:
+			slot.enqueued = next(self._counter)
+			heapq.heappush(self._ready, (self.key(slot), slot.index, slot.version))
+		else:
+			heapq.heappush(self._waiting, (bucket.get_ready_at(1), slot.index, slot.version))
+
+	def _promote(self, now):
+		"""Move accounts that have refilled by now from waiting to ready."""
+		while self._waiting and self._waiting[0][0] <= now:
+			_, index, version = heapq.heappop(self._waiting)
+			slot = self._slots[index]
+			if slot.version == version:
+				self._place(slot, now)
+
+	@staticmethod
+	def _prune(heap, slots):
+		while heap and slots[heap[0][1]].version != heap[0][2]:
+			heapq.heappop(heap)
+
+	def acquire(self, now=None):
+		"""Take a token from the next account and return it, or None if they're all out."""
+		now = self._timer() if now is None else now
+		self._promote(now)
+		while self._ready:
+			_, index, version = heapq.heappop(self._ready)
+			slot = self._slots[index]
+			if slot.version != version:
+				continue
+
+			taken = slot.account.bucket.add(1, now=now)
+			if taken:
+				slot.last_used = next(self._counter)
+			self._place(slot, now)
+			if taken:
+				return slot.account
+
+		return None
+
+	def update(self, account, now=None):
+		"""Re-queue an account whose bucket was changed from outside."""
+		self._place(self._by_id[id(account)], self._timer() if now is None else now)
+
+	def reserve(self, amount=1, now=None):
+		"""Reserve amount tokens from whichever account will have them first. Returns the account and its Reservation.
+
+		Call update(account) after redeeming or cancelling the reservation.
+		"""
+		slot = min(self._slots, key=lambda slot: slot.account.bucket.get_ready_at(amount))
+		reservation = slot.account.bucket.reserve(amount)
+		self._place(slot, self._timer() if now is None else now)
+		return slot.account, reservation
+
+	def get_min_wait_time(self, amount=1, now=None) -> float:
+		"""Return how long until any account will have the given amount of tokens."""
+		now = self._timer() if now is None else now
+		if not self._slots:
+			return float('inf')
+		if amount != 1:
+			return max(0.0, min(slot.account.bucket.get_ready_at(amount) for slot in self._slots) - now)
+
+		self._promote(now)
+		self._prune(self._ready, self._slots)
+		if self._ready:
+			return 0.0
+		self._prune(self._waiting, self._slots)
+		return max(0.0, self._waiting[0][0] - now)
+
+class _Account:
+	__slots__ = 'username', 'bucket'
+
+	def __init__(self, username, bucket):
+		self.username = username
+		self.bucket = bucket
+
+def _accounts(*spaces, now=1000.0):
+	return [
+		_Account(i, LeakyBucket(bucket_size=10, leak_rate_per_second=1.0, space_remaining=space, last_updated_at=now))
+		for i, space in enumerate(spaces)
+	]
+
+def test_most_space_spreads_load():
+	accounts = _accounts(3, 3)
+	scheduler = AccountScheduler(accounts, _timer=lambda: 1000.0)
+	assert scheduler.capacity == 6
+	used = [scheduler.acquire(now=1000.0).username for _ in range(6)]
+	assert sorted(used[:2]) == [0, 1]
+	assert used.count(0) == used.count(1) == 3
+	assert scheduler.acquire(now=1000.0) is None
+	assert scheduler.capacity == 0
+	assert scheduler.get_min_wait_time(now=1000.0) == 1.0
+
+def test_round_robin():
+	accounts = _accounts(5, 5, 5)
+	scheduler = AccountScheduler(accounts, 'round_robin', _timer=lambda: 1000.0)
+	assert [scheduler.acquire(now=1000.0).username for _ in range(6)] == [0, 1, 2, 0, 1, 2]
+
+def test_least_recently_used():
+	accounts = _accounts(1, 5)
+	scheduler = AccountScheduler(accounts, 'least_recently_used', _timer=lambda: 1000.0)
+	assert [scheduler.acquire(now=1000.0).username for _ in range(3)] == [0, 1, 1]
+	# account 0 refilled, and it was used longest ago
+	assert scheduler.acquire(now=1001.0).username == 0
+
+def test_waiting_and_update():
+	accounts = _accounts(0, 0)
+	accounts[1].bucket.last_updated_at = 999.5
+	scheduler = AccountScheduler(accounts, _timer=lambda: 1000.0)
+	assert scheduler.acquire(now=1000.0) is None
+	assert scheduler.get_min_wait_time(now=1000.0) == 0.5
+	assert scheduler.get_min_wait_time(2, now=1000.0) == 1.5
+	assert scheduler.acquire(now=1000.5).username == 1
+
+	# e.g. Signal said we were rate limited when we thought we weren't
+	accounts[0].bucket.space_remaining = 5
+	scheduler.update(accounts[0], now=1000.5)
+	assert scheduler.acquire(now=1000.5).username == 0
+	accounts[0].bucket.space_remaining = 0
+	scheduler.update(accounts[0], now=1000.5)
+	assert scheduler.get_min_wait_time(now=1000.5) == 1.0
+
+def test_reserve():
+	accounts = _accounts(1, 0)
+	scheduler = AccountScheduler(accounts, _timer=lambda: 1000.0)
+	account, reservation = scheduler.reserve(now=1000.0)
+	assert account is accounts[0] and reservation.eta == 1000.0
+	# account 0's token is spoken for
+	assert scheduler.get_min_wait_time(now=1000.0) == 1.0
+	account, reservation = scheduler.reserve(now=1000.0)
+	assert account is accounts[0] and reservation.eta == 1001.0
+	# account 1 refilled at the same time, and that token isn't reserved
+	assert scheduler.acquire(now=1001.0) is accounts[1]
+	assert scheduler.acquire(now=1001.0) is None
+	assert reservation.redeem(now=1001.0)
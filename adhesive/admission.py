@@ -0,0 +1,151 @@
+import logging
+import contextlib
+from collections import deque
+
+import anyio
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUDGET = 1024 ** 3
+
+# Rough multiples of a sticker's download size that a conversion holds in memory at once.
+# WEBPs are kept as downloaded, then padded and encrypted (two more copies) while the pack is uploaded.
+# .tgs files are gzipped Lottie JSON, and the APNGs they're rendered to are far bigger.
+TG_COST_FACTORS = {'image/webp': 3, 'application/x-tgsticker': 50}
+DEFAULT_TG_COST_FACTOR = 3
+# Signal manifests don't say how big each sticker is. This covers the WEBP plus its PNG at 512×512.
+SIGNAL_STICKER_COST = 512 * 1024
+
+def estimate_tg_pack(tg_pack) -> int:
+	return sum(
+		document.size * TG_COST_FACTORS.get(document.mime_type, DEFAULT_TG_COST_FACTOR)
+		for document in tg_pack.documents
+	)
+
+def estimate_signal_pack(pack) -> int:
+	# +1 for the cover
+	return (len(pack.stickers) + 1) * SIGNAL_STICKER_COST
+
+class Ticket:
+	__slots__ = 'estimate', 'reserved', 'actual', 'admitted'
+
+	def __init__(self, estimate, reserved):
+		self.estimate = estimate
+		self.reserved = reserved
+		# filled in by the conversion once it's holding all of its images
+		self.actual = 0
+		self.admitted = False
+
+class MemoryBudget:
+	"""Admits conversions one after another, in the order they arrived, once their estimated memory use fits.
+
+	A conversion estimated to need more than the whole budget is admitted once nothing else is running.
+	"""
+
+	def __init__(self, budget=DEFAULT_BUDGET):
+		self.budget = budget
+		self.reserved = 0
+		self.active = set()
+		# [ticket, event] for each conversion waiting to be admitted, first come first served
+		self._queue = deque()
+		# for metrics: totals over finished conversions, to see how good the estimates are
+		self.estimated_total = 0
+		self.actual_total = 0
+
+	@classmethod
+	def from_config(cls, config):
+		return cls(config.get('admission', {}).get('memory_budget', DEFAULT_BUDGET))
+
+	@property
+	def actual(self) -> int:
+		return sum(ticket.actual for ticket in self.active)
+
+	@property
+	def waiting(self) -> int:
+		return len(self._queue)
+
+	def _fits(self, ticket):
+		return self.reserved + ticket.reserved <= self.budget
+
+	def _admit(self, ticket):
+		ticket.admitted = True
+		self.reserved += ticket.reserved
+		self.active.add(ticket)
+
+	async def _wake(self):
+		while self._queue and self._fits(self._queue[0][0]):
+			ticket, event = self._queue.popleft()
+			self._admit(ticket)
+			await event.set()
+
+	@contextlib.asynccontextmanager
+	async def admit(self, estimate: int):
+		"""Wait until there's room for a conversion estimated to use this many bytes."""
+		ticket = Ticket(estimate, min(estimate, self.budget))
+		if not self._queue and self._fits(ticket):
+			self._admit(ticket)
+		else:
+			logger.debug('Waiting for %d bytes of memory budget (%d queued ahead)', ticket.reserved, len(self._queue))
+			entry = [ticket, anyio.create_event()]
+			self._queue.append(entry)
+			try:
+				await entry[1].wait()
+			except BaseException:
+				if not ticket.admitted:
+					self._queue.remove(entry)
+					# we might have been holding up everyone behind us
+					async with anyio.open_cancel_scope(shield=True):
+						await self._wake()
+				else:
+					await self._release(ticket)
+				raise
+
+		try:
+			yield ticket
+		finally:
+			self.estimated_total += ticket.estimate
+			self.actual_total += ticket.actual
+			await self._release(ticket)
+
+	async def _release(self, ticket):
+		self.active.discard(ticket)
+		self.reserved -= ticket.reserved
+		async with anyio.open_cancel_scope(shield=True):
+			await self._wake()
+
+def test_first_come_first_served():
+	budget = MemoryBudget(100)
+	order = []
+
+	async def convert(name, estimate, hold):
+		async with budget.admit(estimate):
+			order.append(name)
+			await hold.wait()
+
+	async def main():
+		holds = {name: anyio.create_event() for name in 'abcd'}
+		async with anyio.create_task_group() as tg:
+			await tg.spawn(convert, 'a', 60, holds['a'])
+			await anyio.sleep(0.01)
+			await tg.spawn(convert, 'b', 60, holds['b'])
+			await anyio.sleep(0.01)
+			# would fit, but b was first
+			await tg.spawn(convert, 'c', 10, holds['c'])
+			# too big to ever fit, so it gets the whole budget to itself
+			await tg.spawn(convert, 'd', 1000, holds['d'])
+			await anyio.sleep(0.01)
+			assert order == ['a'] and budget.waiting == 3
+
+			await holds['a'].set()
+			await anyio.sleep(0.01)
+			assert order == ['a', 'b', 'c'] and budget.reserved == 70
+
+			for name in 'bc':
+				await holds[name].set()
+			await anyio.sleep(0.01)
+			assert order == ['a', 'b', 'c', 'd'] and budget.reserved == 100
+			await holds['d'].set()
+
+		assert budget.reserved == 0 and not budget.active
+
+	anyio.run(main)
@@ -1,17 +1,275 @@
 import io
+import sys
+import json
+import zlib
+import struct
 
-from apng import APNG
-from lottie.exporters.cairo import export_png
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+DEFAULT_COMPRESS_LEVEL = 6
+# cairo's ARGB32 is premultiplied and native endian, so it's BGRA in memory on little endian machines.
+# Pillow can undo the premultiplication while unpacking that, but not the big endian layout.
+CAIRO_IMAGE_MODE, CAIRO_RAW_MODE = ('RGBA', 'BGRa') if sys.byteorder == 'little' else ('RGBa', 'aRGB')
 
-# adapted from https://gitlab.com/mattbas/python-lottie/-/blob/v0.6.6/lib/lottie/exporters/gif.py#L70
-# and used under the terms of the GNU AGPLv3 license
-def export_apng(animation, fp):
+def _chunk(chunk_type: bytes, data) -> bytes:
+	crc = zlib.crc32(data, zlib.crc32(chunk_type))
+	return b''.join((struct.pack('>I', len(data)), chunk_type, data, struct.pack('>I', crc)))
+
+def compress_frame(rgba, width, height, compress_level=DEFAULT_COMPRESS_LEVEL) -> bytes:
+	"""Compress a frame of 8-bit RGBA pixels into image data for APNGWriter."""
+	view = memoryview(rgba).cast('B')
+	stride = width * 4
+	if len(view) != stride * height:
+		raise ValueError(f'expected {stride * height} bytes of RGBA for a {width}×{height} frame, got {len(view)}')
+
+	compressor = zlib.compressobj(compress_level)
+	parts = []
+	for row in range(height):
+		# every scanline starts with its filter type. 0 is none, which costs nothing to apply
+		parts.append(compressor.compress(b'\0'))
+		parts.append(compressor.compress(view[row * stride:(row + 1) * stride]))
+	parts.append(compressor.flush())
+	return b''.join(parts)
+
+class APNGWriter:
+	"""Writes an APNG to fp a frame at a time, without holding onto any frames or ever parsing a PNG.
+
+	Frames are passed already compressed (see compress_frame), so that the expensive part can be done elsewhere,
+	e.g. by the processes that rendered them. If num_frames isn't known up front, fp has to be seekable
+	so that it can be filled in by close().
+	"""
+
+	def __init__(self, fp, width, height, num_frames=None, *, num_plays=0):
+		self.fp = fp
+		self.width = width
+		self.height = height
+		self.num_frames = num_frames
+		self.num_plays = num_plays
+		self.frames_written = 0
+		# fcTL and fdAT chunks share one sequence
+		self._sequence = 0
+
+		fp.write(PNG_SIGNATURE)
+		# 8 bit RGBA, not interlaced
+		fp.write(_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)))
+		self._actl_offset = fp.tell() if num_frames is None else None
+		fp.write(_chunk(b'acTL', struct.pack('>II', num_frames or 0, num_plays)))
+
+	def _next_sequence(self):
+		sequence = self._sequence
+		self._sequence += 1
+		return sequence
+
+	def write_frame(self, data, delay_num, delay_den=1000, *, x=0, y=0, width=None, height=None):
+		"""Add a frame of compressed image data, shown for delay_num / delay_den seconds.
+
+		Frames after the first may cover only part of the canvas, replacing just that part of the frame before.
+		"""
+		if self.frames_written == self.num_frames:
+			raise ValueError(f'this APNG only has room for {self.num_frames} frames')
+		width = self.width if width is None else width
+		height = self.height if height is None else height
+		first = self.frames_written == 0
+		if first and (x, y, width, height) != (0, 0, self.width, self.height):
+			raise ValueError('the first frame has to cover the whole image')
+
+		# dispose op 0 leaves each frame on the canvas for the next one to be drawn onto,
+		# and blend op 0 replaces the pixels it covers (transparency included) rather than compositing over them
+		self.fp.write(_chunk(b'fcTL', struct.pack(
+			'>IIIIIHHBB', self._next_sequence(), width, height, x, y, delay_num, delay_den, 0, 0,
+		)))
+		if first:
+			# the first frame doubles as the still image shown by viewers that don't support APNG
+			self.fp.write(_chunk(b'IDAT', data))
+		else:
+			self.fp.write(_chunk(b'fdAT', struct.pack('>I', self._next_sequence()) + data))
+		self.frames_written += 1
+
+	def close(self):
+		if self._actl_offset is not None:
+			end = self.fp.tell()
+			self.fp.seek(self._actl_offset)
+			self.fp.write(_chunk(b'acTL', struct.pack('>II', self.frames_written, self.num_plays)))
+			self.fp.seek(end)
+		elif self.frames_written != self.num_frames:
+			raise ValueError(f'expected {self.num_frames} frames, but only {self.frames_written} were written')
+		self.fp.write(_chunk(b'IEND', b''))
+
+def _changed_box(previous, current, size):
+	"""Return the box (left, upper, right, lower) in which two RGBA frames differ, or None if they're identical."""
+	import PIL.Image
+	import PIL.ImageChops
+
+	if previous == current:
+		return None
+	# as RGBX so that getbbox() looks at all four bytes of each pixel, not just the alpha
+	previous, current = (PIL.Image.frombuffer('RGBX', size, frame, 'raw', 'RGBX', 0, 1) for frame in (previous, current))
+	return PIL.ImageChops.difference(previous, current).getbbox()
+
+def optimize_frames(frames, size, compress_level=DEFAULT_COMPRESS_LEVEL, previous=None):
+	"""Compress each of an iterable of RGBA frames for APNGWriter, cropped to what changed since the frame before.
+
+	Yields None for a frame that's identical to the one before it, so that it can be shown for longer instead,
+	or else (box, data) where box is the (left, upper, right, lower) part of the canvas that data covers.
+	Pass previous to diff the first frame against the frame that comes before it.
+	"""
+	import PIL.Image
+
+	full = (0, 0, *size)
+	for rgba in frames:
+		box = full if previous is None else _changed_box(previous, rgba, size)
+		if box is None:
+			yield None
+		else:
+			data = rgba
+			if box != full:
+				data = PIL.Image.frombuffer('RGBA', size, rgba, 'raw', 'RGBA', 0, 1).crop(box).tobytes()
+			yield box, compress_frame(data, box[2] - box[0], box[3] - box[1], compress_level)
+		previous = rgba
+
+class FrameMerger:
+	"""Writes the output of optimize_frames to an APNGWriter, showing runs of identical frames as one longer frame.
+
+	Only the last frame is held onto, in case the ones after it are the same.
+	"""
+
+	# the longest delay an fcTL can hold, in ms
+	MAX_DELAY = 0xffff
+
+	def __init__(self, writer):
+		self.writer = writer
+		# [(box, data), delay in ms]
+		self._pending = None
+
+	def add(self, frame, delay: float):
+		if frame is None:
+			# stickers are a few seconds long, so losing time past MAX_DELAY is never going to matter
+			self._pending[1] = min(self._pending[1] + delay, self.MAX_DELAY)
+			return
+		self._flush()
+		self._pending = [frame, delay]
+
+	def _flush(self):
+		if self._pending is None:
+			return
+		(left, upper, right, lower), data = self._pending[0]
+		self.writer.write_frame(
+			data, max(1, round(self._pending[1])), x=left, y=upper, width=right - left, height=lower - upper,
+		)
+		self._pending = None
+
+	def close(self):
+		self._flush()
+		self.writer.close()
+
+def render_rgba(animation, frame, size, scale=1) -> bytes:
+	"""Render one frame of a lottie Animation to 8-bit RGBA pixels."""
+	import cairosvg
+	import PIL.Image
+	from lottie.exporters.svg import export_svg
+
+	# this is what lottie's PNG exporter does, minus encoding the surface to a PNG
+	svg = io.StringIO()
+	export_svg(animation, svg, frame)
+	surface = cairosvg.surface.PNGSurface(
+		cairosvg.parser.Tree(bytestring=svg.getvalue().encode()), None, 96, scale=scale,
+	).cairo
+	surface.flush()
+	im = PIL.Image.frombuffer(
+		CAIRO_IMAGE_MODE, (surface.get_width(), surface.get_height()), surface.get_data(),
+		'raw', CAIRO_RAW_MODE, surface.get_stride(), 1,
+	)
+	if im.mode != 'RGBA':
+		im = im.convert('RGBA')
+	if im.size != size:
+		im = im.resize(size)
+	return im.tobytes()
+
+def scaled_size(width, height, scale):
+	return max(1, round(width * scale)), max(1, round(height * scale))
+
+def export_apng(animation, fp, compress_level=DEFAULT_COMPRESS_LEVEL):
 	start = int(animation.in_point)
 	end = int(animation.out_point)
-	apng = APNG()
-	for i in range(start, end + 1):
-		file = io.BytesIO()
-		export_png(animation, file, i)
-		file.seek(0)
-		apng.append_file(file, delay=int(round(1000 / animation.frame_rate)))
-	apng.save(fp)
+	size = int(animation.width), int(animation.height)
+	merger = FrameMerger(APNGWriter(fp, *size))
+	frames = (render_rgba(animation, i, size) for i in range(start, end + 1))
+	for frame in optimize_frames(frames, size, compress_level):
+		merger.add(frame, 1000 / animation.frame_rate)
+	merger.close()
+
+def render_frames(lottie_json: bytes, frames, previous=None, scale=1, compress_level=DEFAULT_COMPRESS_LEVEL):
+	"""Render the given frames of an animation given as Lottie JSON, and return the output of optimize_frames.
+
+	previous is the number of the frame that will be shown before the first of them, if any.
+	"""
+	from lottie.objects import Animation
+
+	animation = Animation.load(json.loads(lottie_json))
+	size = scaled_size(animation.width, animation.height, scale)
+	if previous is not None:
+		previous = render_rgba(animation, previous, size, scale)
+	return list(optimize_frames(
+		(render_rgba(animation, i, size, scale) for i in frames), size, compress_level, previous,
+	))
+
+def sample_frame_sizes(lottie_json: bytes, points, steps, compress_level=DEFAULT_COMPRESS_LEVEL):
+	"""Measure how big frames of an animation come out, to predict how big the whole thing will be.
+
+	Returns the compressed size of each frame in points, and for each step in steps, the compressed sizes of
+	the frames step frames after each point once they're cropped to what changed since the point.
+	"""
+	from lottie.objects import Animation
+
+	animation = Animation.load(json.loads(lottie_json))
+	size = int(animation.width), int(animation.height)
+	end = int(animation.out_point)
+	full_sizes = []
+	delta_sizes = {step: [] for step in steps}
+	for point in points:
+		rgba = render_rgba(animation, point, size)
+		full_sizes.append(len(compress_frame(rgba, *size, compress_level)))
+		for step in steps:
+			if point + step > end:
+				continue
+			[frame] = optimize_frames([render_rgba(animation, point + step, size)], size, compress_level, rgba)
+			delta_sizes[step].append(0 if frame is None else len(frame[1]))
+	return full_sizes, delta_sizes
+
+def test_apng_writer():
+	import PIL.Image
+
+	red, clear = b'\xff\x00\x00\xff', b'\x00\x00\x00\x00'
+	frames = [red * 4, clear * 2 + red * 2]
+	out = io.BytesIO()
+	writer = APNGWriter(out, 2, 2, len(frames))
+	for frame in frames:
+		writer.write_frame(compress_frame(frame, 2, 2), 50)
+	writer.close()
+
+	out.seek(0)
+	im = PIL.Image.open(out)
+	assert im.n_frames == 2
+	assert im.convert('RGBA').tobytes() == frames[0]
+	im.seek(1)
+	assert im.info['duration'] == 50
+	assert im.convert('RGBA').tobytes() == frames[1]
+
+def test_optimize_frames():
+	import PIL.Image
+
+	red, blue, clear = b'\xff\x00\x00\xff', b'\x00\x00\xff\xff', b'\x00\x00\x00\x00'
+	frames = [red * 9, red * 9, red * 4 + clear + red * 4, red * 4 + blue + red * 4]
+	out = io.BytesIO()
+	merger = FrameMerger(APNGWriter(out, 3, 3))
+	for frame in optimize_frames(frames, (3, 3)):
+		merger.add(frame, 25)
+	merger.close()
+
+	out.seek(0)
+	im = PIL.Image.open(out)
+	# the first two frames were merged, and the rest only cover the middle pixel
+	assert im.n_frames == 3
+	assert im.info['duration'] == 50
+	for i, expected in enumerate((frames[0], frames[2], frames[3])):
+		im.seek(i)
+		assert im.convert('RGBA').tobytes() == expected
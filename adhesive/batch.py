@@ -0,0 +1,293 @@
+"""Convert a list of sticker pack links in one go, e.g. to mirror a community catalogue.
+
+	python -m adhesive.batch links.txt -o results.jsonl
+
+Links are read one per line, and a JSON object is written to the output for each of them once it's converted
+(or has failed). Run it again with the same links to pick up where an interrupted run stopped.
+
+Stop the bot first. Each process keeps its own copy of the Signal accounts' rate limits and writes it back over
+the other's, and two processes converting the same pack would both register it and share its staged images.
+"""
+
+import sys
+import json
+import time
+import logging
+import argparse
+
+import anyio
+
+from .database import Database
+from .glue import IN_PROGRESS, parse_link, signal_pack_url, tg_pack_url
+from .jobs import CONVERTERS, DIRECTIONS, dump_pack_info, load_pack_info
+from .stickers_client import RateLimited
+from .utils import chunked
+
+logger = logging.getLogger(__name__)
+
+class BatchRun:
+	"""Converts every link in a run, concurrency packs at a time.
+
+	Each conversion overlaps its own downloads, transcodes and uploads, and those go through services shared by
+	every conversion (downloads, transcoder, uploads, admission), so running a few packs at once keeps every stage
+	busy without any one of them running more at once than it would for the bot.
+	Progress is kept in the batch_items table under the run's name, so links that were done or failed by an earlier
+	attempt at the run are skipped, and ones that were interrupted are started over (resuming their upload).
+	Like JobScheduler, Telegram→Signal conversions are only started when there's a Signal account with a token
+	to spare. The rest of the run carries on in the meantime.
+	"""
+
+	def __init__(self, db, tg_client, stickers_client, name, output, *, concurrency=4, poll_interval=60):
+		self.db = db
+		self.tg_client = tg_client
+		self.stickers_client = stickers_client
+		self.name = name
+		self.output = output
+		self.concurrency = concurrency
+		self.poll_interval = poll_interval
+
+	async def add_links(self, links):
+		"""Add links to the run. Ones it already has are left as they are."""
+		rows = []
+		for position, link in enumerate(links):
+			link = link.strip()
+			if not link or link.startswith('#'):
+				continue
+			try:
+				converter, pack_info = parse_link(link)
+			except ValueError:
+				# these fail when they're reached, so that they're reported in order with everything else
+				rows.append((self.name, link, position, None, None))
+			else:
+				rows.append((self.name, link, position, DIRECTIONS[converter], dump_pack_info(pack_info)))
+
+		# SQLite limits how many parameters a statement can have
+		for chunk in chunked(rows, 100):
+			await self.db.execute(
+				"""
+				INSERT INTO batch_items (run, link, position, direction, pack_info)
+				VALUES """ + ', '.join(['(?, ?, ?, ?, ?)'] * len(chunk)) + """
+				ON CONFLICT DO NOTHING
+				""",
+				*[param for row in chunk for param in row],
+			)
+
+	async def run(self, *, retry_failed=False) -> dict:
+		"""Convert everything left in the run. Returns how many of its links ended up in each state."""
+		# links that were being converted when we last stopped were interrupted
+		await self.db.execute(
+			"UPDATE batch_items SET state = 'pending' WHERE run = ? AND state = 'running'", self.name,
+		)
+		if retry_failed:
+			await self.db.execute(
+				"UPDATE batch_items SET state = 'pending', result = NULL, finished_at = NULL WHERE run = ? AND state = 'failed'",
+				self.name,
+			)
+
+		async with anyio.create_task_group() as tg:
+			for _ in range(self.concurrency):
+				await tg.spawn(self._worker)
+
+		rows = await self.db.fetchall(
+			'SELECT state, count(*) FROM batch_items WHERE run = ? GROUP BY state', self.name,
+		)
+		return dict(map(tuple, rows))
+
+	async def _worker(self):
+		while True:
+			item = await self._claim()
+			if item is not None:
+				await self._convert(*item)
+			elif await self._has_pending():
+				# everything that's left is waiting on Signal rate limits
+				await anyio.sleep(min(self.poll_interval, self.stickers_client.get_min_wait_time() or self.poll_interval))
+			else:
+				return
+
+	async def _claim(self):
+		directions = ['telegram']
+		if not self.stickers_client.get_min_wait_time():
+			directions.append('signal')
+
+		return await self.db.fetchone(
+			f"""
+			UPDATE batch_items
+			SET state = 'running'
+			WHERE rowid = (
+				SELECT rowid
+				FROM batch_items
+				WHERE
+					run = ?
+					AND state = 'pending'
+					AND (direction IS NULL OR direction IN ({', '.join('?' * len(directions))}))
+				ORDER BY position
+				LIMIT 1
+			)
+			RETURNING rowid, link, direction, pack_info
+			""",
+			self.name, *directions,
+		)
+
+	async def _has_pending(self) -> bool:
+		return await self.db.fetchone(
+			"SELECT 1 FROM batch_items WHERE run = ? AND state = 'pending' LIMIT 1", self.name,
+		) is not None
+
+	async def _convert(self, rowid, link, direction, pack_info):
+		if direction is None:
+			result = dict(state='failed', error='Not a sticker pack link.')
+		else:
+			pack_info = load_pack_info(pack_info)
+			logger.info('Converting %s', link)
+			try:
+				result = await self._run_converter(direction, pack_info)
+			except RateLimited:
+				# someone else got to the last token first, so put it back
+				logger.debug('%s rate limited; requeueing', link)
+				await self.db.execute("UPDATE batch_items SET state = 'pending' WHERE rowid = ?", rowid)
+				return
+			except (ValueError, NotImplementedError) as exc:
+				result = await self._converted_before(direction, pack_info) or dict(state='failed', error=exc.args[0])
+			except Exception as exc:
+				logger.exception('Unhandled exception while converting %s', link)
+				result = dict(state='failed', error=f'Internal error: {exc!r}')
+
+		result = dict(link=link, **result)
+		# written before it's marked as finished, so that being interrupted in between repeats it instead of losing it
+		self.output.write(json.dumps(result) + '\n')
+		self.output.flush()
+		await self.db.execute(
+			'UPDATE batch_items SET state = ?, result = ?, finished_at = ? WHERE rowid = ?',
+			result['state'], json.dumps(result), int(time.time()), rowid,
+		)
+
+	async def _run_converter(self, direction, pack_info):
+		value = None
+		async for response in CONVERTERS[direction](self.db, self.tg_client, self.stickers_client, *pack_info):
+			if response is not IN_PROGRESS:
+				_, value = response
+		if value is None:
+			raise RuntimeError('the converter finished without a result')
+
+		if direction == 'signal':
+			pack_id, pack_key, _ = value
+			value = signal_pack_url(pack_id, pack_key)
+		return dict(state='done', url=value)
+
+	async def _converted_before(self, direction, pack_info):
+		# convert_to_telegram refuses packs it's already converted, but for a mirror that's as good as done.
+		# (convert_to_signal just returns the pack it converted before.)
+		if direction != 'telegram':
+			return None
+		try:
+			signal_pack_id = bytes.fromhex(pack_info[0])
+		except ValueError:
+			return None
+		row = await self.db.fetchone(
+			'SELECT tg_short_name FROM telegram_packs WHERE signal_pack_id = ?', signal_pack_id,
+		)
+		return row and dict(state='done', url=tg_pack_url(row[0]))
+
+async def main(args):
+	import toml
+	with open(args.config) as f:
+		config = toml.load(f)
+	logging.basicConfig(level=getattr(logging, config.get('log_level', 'INFO').upper(), logging.INFO))
+
+	from .bot import build_stickers_client
+	from .telegram_bot import build_client as build_tg_client, started
+
+	links = args.links.read().splitlines()
+	name = args.run or args.links.name
+	session_name = config['telegram'].get('session_name', 'adhesive') + '-batch'
+
+	async with Database.from_config(config) as db:
+		await db.migrate()
+		async with await build_stickers_client(db, config) as stickers_client:
+			tg_client = build_tg_client(config, db, stickers_client, session_name=session_name, handle_events=False)
+			async with started(tg_client), anyio.create_task_group() as tg:
+				await tg.spawn(stickers_client.flush_periodically)
+				batch = BatchRun(db, tg_client, stickers_client, name, args.output, concurrency=args.concurrency)
+				await batch.add_links(links)
+				counts = await batch.run(retry_failed=args.retry_failed)
+				await tg.cancel_scope.cancel()
+
+	logger.info('Run %r: %s', name, ', '.join(f'{count} {state}' for state, count in sorted(counts.items())))
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(
+		prog='python -m adhesive.batch',
+		description='Convert sticker pack links in bulk. Writes a JSON object per link. Stop the bot before running this.',
+	)
+	parser.add_argument(
+		'links', type=argparse.FileType('r'), nargs='?', default=sys.stdin,
+		help='file of links, one per line (default: stdin). blank lines and lines starting with # are ignored',
+	)
+	parser.add_argument(
+		'-o', '--output', type=argparse.FileType('a'), default=sys.stdout,
+		help='file to append results to as JSON lines (default: stdout)',
+	)
+	parser.add_argument(
+		'--run', help='name to save progress under, to resume it later (default: the name of the links file)',
+	)
+	parser.add_argument('--concurrency', type=int, default=4, help='packs to convert at once')
+	parser.add_argument('--retry-failed', action='store_true', help='also retry links that failed in an earlier attempt')
+	parser.add_argument('--config', default='config.toml')
+	return parser.parse_args(argv)
+
+def test_batch(tmp_path):
+	import io
+	from . import glue
+	from .benchmark.fakes import FakeTelegramClient, FakeStickersClient
+	from functools import partial
+	from .benchmark.fixtures import ImagePool, make_sticker_image
+
+	config = dict(
+		cache=dict(path=tmp_path / 'cache'),
+		staging=dict(path=tmp_path / 'staging'),
+		transcode=dict(executor='inline'),
+	)
+	tg_client = FakeTelegramClient(latency=0)
+	glue.attach_services(tg_client, config)
+	glue.start_services(tg_client)
+	stickers_client = FakeStickersClient(latency=0)
+	# PNG so that this doesn't need Pillow to have been built with WEBP support
+	images = ImagePool(partial(make_sticker_image, format='PNG'), size=3)
+
+	tg_client.add_sticker_set('batch_test', images.take(2))
+	signal_pack = stickers_client.add_pack('Batch test', images.take(2, offset=1))
+	links = ['https://t.me/addstickers/batch_test', '', 'not a link', signal_pack_url(*signal_pack)]
+
+	async def main():
+		async with Database(tmp_path / 'db.sqlite3') as db:
+			await db.migrate()
+			tg_client.db = db
+
+			output = io.StringIO()
+			batch = BatchRun(db, tg_client, stickers_client, 'test', output, concurrency=2)
+			await batch.add_links(links)
+			assert await batch.run() == dict(done=2, failed=1)
+			results = {result['link']: result for result in map(json.loads, output.getvalue().splitlines())}
+			assert results['not a link']['state'] == 'failed'
+			assert results[links[0]]['url'].startswith('https://signal.art/addstickers/')
+			assert '/addstickers/signal_' in results[links[-1]]['url']
+
+			# nothing is converted (or written) twice
+			output = io.StringIO()
+			batch = BatchRun(db, tg_client, stickers_client, 'test', output)
+			await batch.add_links(links)
+			assert await batch.run() == dict(done=2, failed=1)
+			assert not output.getvalue()
+
+			# a different run with the same links finds the pack already on Telegram
+			batch = BatchRun(db, tg_client, stickers_client, 'mirror', output)
+			await batch.add_links(links[-1:])
+			assert await batch.run() == dict(done=1)
+
+	try:
+		anyio.run(main)
+	finally:
+		glue.shutdown_services(tg_client)
+
+if __name__ == '__main__':
+	anyio.run(main, parse_args())
@@ -0,0 +1,4 @@
+"""Offline benchmarks of pack conversion, using local stand-ins for Telegram and Signal.
+
+Run `python -m adhesive.benchmark --help` for usage.
+"""
@@ -0,0 +1,189 @@
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from pathlib import Path
+from collections import defaultdict
+
+import anyio
+
+from .. import glue
+from ..database import Database
+from .fakes import FakeTelegramClient, FakeStickersClient
+from .fixtures import ImagePool, make_tgs
+
+def percentile(xs, p):
+	"""Nearest-rank percentile of an already sorted list."""
+	if not xs:
+		return None
+	return xs[min(len(xs) - 1, max(0, round(p / 100 * len(xs)) - 1))]
+
+def summarize(xs):
+	xs = sorted(xs)
+	return dict(
+		p50=percentile(xs, 50),
+		p90=percentile(xs, 90),
+		p99=percentile(xs, 99),
+		mean=sum(xs) / len(xs) if xs else None,
+	)
+
+def peak_rss():
+	# ru_maxrss is in KiB on Linux but bytes on macOS
+	scale = 1 if sys.platform == 'darwin' else 1024
+	return dict(
+		self=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+		# worker processes
+		children=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+	)
+
+def git_commit():
+	try:
+		return subprocess.run(
+			['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True, cwd=Path(__file__).parent,
+		).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+class StageTimer:
+	def __init__(self):
+		self.timings = defaultdict(list)
+
+	def __call__(self, stage, elapsed):
+		self.timings[stage].append(elapsed)
+
+	def summarize(self):
+		return {
+			stage: dict(count=len(xs), total=sum(xs), **summarize(xs))
+			for stage, xs in self.timings.items()
+		}
+
+async def convert(db, tg_client, stickers_client, converter, *pack_info):
+	async for response in converter(db, tg_client, stickers_client, *pack_info):
+		if response is glue.IN_PROGRESS:
+			continue
+		is_link, _ = response
+		if not is_link:
+			raise RuntimeError('conversion failed', response)
+
+async def run_conversions(args, db, tg_client, stickers_client, images, direction, pack_size):
+	pack_infos = []
+	for i in range(args.iterations):
+		# every iteration converts a distinct pack so that nothing is answered from the packs tables
+		pack_images = images.take(pack_size, offset=i)
+		if direction == 'signal':
+			short_name = f'bench_{pack_size}_{i}_{time.monotonic_ns()}'
+			tg_client.add_sticker_set(short_name, pack_images)
+			pack_infos.append((short_name,))
+		else:
+			pack_infos.append(stickers_client.add_pack(f'Benchmark {pack_size} #{i}', pack_images))
+
+	converter = glue.convert_to_signal if direction == 'signal' else glue.convert_to_telegram
+	limiter = anyio.create_capacity_limiter(args.concurrency)
+	latencies = []
+
+	async def run_one(pack_info):
+		async with limiter:
+			start = time.perf_counter()
+			await convert(db, tg_client, stickers_client, converter, *pack_info)
+			latencies.append(time.perf_counter() - start)
+
+	start = time.perf_counter()
+	async with anyio.create_task_group() as tg:
+		for pack_info in pack_infos:
+			await tg.spawn(run_one, pack_info)
+	elapsed = time.perf_counter() - start
+
+	return dict(latency=summarize(latencies), packs_per_minute=len(latencies) / elapsed * 60)
+
+async def run_render(args, tg_client):
+	"""Animated packs aren't accepted by convert_to_signal yet, so benchmark rendering them on its own."""
+	latencies = []
+	for seed in range(args.iterations):
+		data = make_tgs(seed, frames=args.tgs_frames)
+		start = time.perf_counter()
+		await glue.convert_tgs_to_apng(tg_client, data)
+		latencies.append(time.perf_counter() - start)
+	return dict(latency=summarize(latencies), stickers_per_minute=len(latencies) / sum(latencies) * 60)
+
+async def main(args):
+	cache_dir = tempfile.TemporaryDirectory(prefix='adhesive-benchmark-')
+	config = dict(
+		cache=dict(path=Path(cache_dir.name, 'cache'), max_size=args.cache_size),
+		staging=dict(path=Path(cache_dir.name, 'staging')),
+		transcode=dict(executor=args.transcoder),
+	)
+
+	tg_client = FakeTelegramClient(latency=args.latency)
+	glue.attach_services(tg_client, config)
+	glue.start_services(tg_client)
+	stickers_client = FakeStickersClient(latency=args.latency)
+	images = ImagePool()
+
+	stage_timer = StageTimer()
+	glue.STAGE_OBSERVERS.append(stage_timer)
+
+	results = []
+	try:
+		async with Database(':memory:') as db:
+			await db.migrate()
+			tg_client.db = db
+
+			for direction in args.directions:
+				for pack_size in args.sizes:
+					stage_timer.timings.clear()
+					result = await run_conversions(args, db, tg_client, stickers_client, images, direction, pack_size)
+					results.append(dict(
+						benchmark='convert_to_' + direction,
+						pack_size=pack_size,
+						stages=stage_timer.summarize(),
+						**result,
+					))
+
+		if args.tgs:
+			stage_timer.timings.clear()
+			results.append(dict(benchmark='render_tgs', frames=args.tgs_frames, **await run_render(args, tg_client)))
+	finally:
+		glue.STAGE_OBSERVERS.remove(stage_timer)
+		glue.shutdown_services(tg_client)
+		cache_dir.cleanup()
+
+	return dict(
+		commit=git_commit(),
+		python=platform.python_version(),
+		args=vars(args),
+		results=results,
+		peak_rss_bytes=peak_rss(),
+	)
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(
+		prog='python -m adhesive.benchmark',
+		description='Benchmark pack conversion against local stand-ins for Telegram and Signal. Prints JSON.',
+	)
+	parser.add_argument('--sizes', type=int, nargs='+', default=[10, 50, 120], help='pack sizes to convert')
+	parser.add_argument(
+		'--directions', nargs='+', choices=('signal', 'telegram'), default=['signal', 'telegram'],
+		help='which platforms to convert to',
+	)
+	parser.add_argument('--iterations', type=int, default=5, help='packs to convert per pack size and direction')
+	parser.add_argument('--concurrency', type=int, default=1, help='conversions to run at once')
+	parser.add_argument('--latency', type=float, default=0.02, help='simulated seconds per network request')
+	parser.add_argument('--transcoder', choices=('inline', 'thread', 'process'), default='thread')
+	parser.add_argument('--cache-size', type=int, default=1024 ** 3, help='image cache size in bytes')
+	parser.add_argument('--tgs', action='store_true', help='also benchmark animated sticker rendering (needs lottie)')
+	parser.add_argument('--tgs-frames', type=int, default=60)
+	parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout)
+	return parser.parse_args(argv)
+
+if __name__ == '__main__':
+	args = parse_args()
+	output = args.output
+	# not JSON serializable
+	del args.output
+	report = anyio.run(main, args)
+	json.dump(report, output, indent='\t')
+	output.write('\n')
@@ -0,0 +1,186 @@
+import hashlib
+import itertools
+import secrets
+from types import SimpleNamespace
+
+import anyio
+import telethon.errors
+from telethon import tl
+from signalstickers_client.models import Sticker, StickerPack
+
+EMOJI = '😀😂🥰😎🤔😴🥳😭'
+
+class FakeTelegramClient:
+	"""Stands in for a TelegramClient, serving sticker sets and files from memory after a simulated network delay.
+
+	Only handles the requests that the converters make.
+	"""
+
+	def __init__(self, *, latency=0.05, chunk_size=128 * 1024):
+		self.user = SimpleNamespace(username='adhesive_benchmark_bot')
+		self.latency = latency
+		self.chunk_size = chunk_size
+		# short name -> messages.StickerSet
+		self.sets = {}
+		# document id -> contents
+		self.files = {}
+		self._ids = itertools.count(1)
+
+	def add_sticker_set(self, short_name, images, mime_type='image/webp'):
+		set_id = next(self._ids)
+		input_sticker_set = tl.types.InputStickerSetID(set_id, 0)
+		documents = []
+		for i, image in enumerate(images):
+			document = self._make_document(image, mime_type, [
+				tl.types.DocumentAttributeSticker(EMOJI[i % len(EMOJI)], input_sticker_set),
+			])
+			documents.append(document)
+
+		self.sets[short_name] = tl.types.messages.StickerSet(
+			set=tl.types.StickerSet(
+				id=set_id,
+				access_hash=0,
+				title=short_name,
+				short_name=short_name,
+				count=len(documents),
+				hash=secrets.randbits(31),
+				animated=mime_type == 'application/x-tgsticker',
+			),
+			packs=[],
+			documents=documents,
+		)
+		return self.sets[short_name]
+
+	def _make_document(self, data, mime_type, attributes):
+		document_id = next(self._ids)
+		self.files[document_id] = data
+		return tl.types.Document(
+			id=document_id,
+			access_hash=0,
+			file_reference=b'',
+			date=None,
+			mime_type=mime_type,
+			size=len(data),
+			dc_id=document_id % 5 + 1,
+			attributes=attributes,
+		)
+
+	def _get_sticker_set(self, request):
+		stickerset = request.stickerset
+		for sticker_set in self.sets.values():
+			if (
+				isinstance(stickerset, tl.types.InputStickerSetShortName)
+				and sticker_set.set.short_name == stickerset.short_name
+				or isinstance(stickerset, tl.types.InputStickerSetID)
+				and sticker_set.set.id == stickerset.id
+			):
+				return sticker_set
+		raise telethon.errors.StickersetInvalidError(request=request)
+
+	def _create_sticker_set(self, request):
+		if request.short_name in self.sets:
+			raise telethon.errors.ShortnameOccupyFailedError(request=request)
+		sticker_set = self.sets[request.short_name] = tl.types.messages.StickerSet(
+			set=tl.types.StickerSet(
+				id=next(self._ids),
+				access_hash=0,
+				title=request.title,
+				short_name=request.short_name,
+				count=len(request.stickers),
+				hash=secrets.randbits(31),
+			),
+			packs=[],
+			documents=[],
+		)
+		return sticker_set
+
+	def _get_document_by_hash(self, request):
+		for document_id, data in self.files.items():
+			if len(data) == request.size and hashlib.sha256(data).digest() == request.sha256:
+				return tl.types.Document(
+					id=document_id,
+					access_hash=0,
+					file_reference=b'',
+					date=None,
+					mime_type=request.mime_type,
+					size=len(data),
+					dc_id=document_id % 5 + 1,
+					attributes=[],
+				)
+		return tl.types.DocumentEmpty(0)
+
+	async def __call__(self, request):
+		await anyio.sleep(self.latency)
+		if isinstance(request, tl.functions.messages.GetStickerSetRequest):
+			return self._get_sticker_set(request)
+		if isinstance(request, tl.functions.messages.UploadMediaRequest):
+			data = self.files[request.media.id]
+			return tl.types.MessageMediaDocument(self._make_document(data, 'image/png', []))
+		if isinstance(request, tl.functions.messages.GetDocumentByHashRequest):
+			return self._get_document_by_hash(request)
+		if isinstance(request, tl.functions.stickers.CreateStickerSetRequest):
+			return self._create_sticker_set(request)
+		raise NotImplementedError(type(request).__name__)
+
+	async def iter_download(self, document):
+		data = self.files[document.id]
+		for i in range(0, len(data), self.chunk_size):
+			await anyio.sleep(self.latency)
+			yield data[i:i + self.chunk_size]
+
+	async def upload_file(self, file, *, file_size=None):
+		data = file.read() if hasattr(file, 'read') else file
+		parts = -(-len(data) // self.chunk_size)
+		await anyio.sleep(self.latency * parts)
+		file_id = next(self._ids)
+		self.files[file_id] = data
+		return tl.types.InputFile(file_id, parts, 'sticker.png', '')
+
+class FakeStickersClient:
+	"""Stands in for MultiStickersClient with a Signal CDN in memory and accounts that are never rate limited."""
+
+	def __init__(self, *, latency=0.05):
+		self.latency = latency
+		# pack_id -> (pack_key, title, [image])
+		self.packs = {}
+
+	def add_pack(self, title, images):
+		pack_id, pack_key = secrets.token_hex(16), secrets.token_hex(32)
+		self.packs[pack_id] = pack_key, title, images
+		return pack_id, pack_key
+
+	async def get_pack_metadata(self, pack_id, pack_key):
+		await anyio.sleep(self.latency)
+		_, title, images = self.packs[pack_id]
+		pack = StickerPack(pack_id, pack_key)
+		pack.title = title
+		pack.author = 'Adhesive benchmark'
+		for i in range(len(images)):
+			sticker = Sticker()
+			sticker.id = i
+			sticker.emoji = EMOJI[i % len(EMOJI)]
+			pack._addsticker(sticker)
+		pack.cover = Sticker()
+		pack.cover.id = 0
+		pack.cover.emoji = EMOJI[0]
+		return pack
+
+	async def download_sticker(self, sticker_id, pack_id, pack_key) -> bytes:
+		await anyio.sleep(self.latency)
+		return self.packs[pack_id][2][sticker_id]
+
+	async def upload_pack(self, pack, *, checkpoint_key=None):
+		# the real uploader registers the pack, uploads the manifest, then uploads 5 stickers at a time
+		await anyio.sleep(self.latency * (2 + -(-len(pack.stickers) // 5)))
+		pack_id, pack_key = secrets.token_hex(16), secrets.token_hex(32)
+		self.packs[pack_id] = pack_key, pack.title, [sticker.image_data for sticker in pack.stickers]
+		return pack_id, pack_key
+
+	async def has_pending_upload(self, checkpoint_key):
+		return False
+
+	async def forget_stale_uploads(self, max_age):
+		return 0
+
+	def get_min_wait_time(self, amount=1):
+		return 0.0
@@ -0,0 +1,60 @@
+import io
+import gzip
+import json
+import random
+
+import PIL.Image
+import PIL.ImageDraw
+
+STICKER_SIZE = 512
+
+def make_sticker_image(seed, format='WEBP') -> bytes:
+	"""Draw a sticker-like image of some random shapes on a transparent background."""
+	rng = random.Random(seed)
+	im = PIL.Image.new('RGBA', (STICKER_SIZE, STICKER_SIZE), (0, 0, 0, 0))
+	draw = PIL.ImageDraw.Draw(im)
+	for _ in range(rng.randrange(8, 24)):
+		x, y = rng.randrange(STICKER_SIZE), rng.randrange(STICKER_SIZE)
+		box = x, y, x + rng.randrange(16, 256), y + rng.randrange(16, 256)
+		shape = rng.choice((draw.ellipse, draw.rectangle))
+		shape(box, fill=tuple(rng.randrange(256) for _ in range(4)), outline=(0, 0, 0, 255), width=4)
+
+	out = io.BytesIO()
+	im.save(out, format=format)
+	return out.getvalue()
+
+def make_tgs(seed, frames=60) -> bytes:
+	"""Make a Telegram animated sticker of a square sliding across the canvas."""
+	rng = random.Random(seed)
+	y = rng.randrange(64, STICKER_SIZE - 64)
+	color = [rng.random(), rng.random(), rng.random(), 1]
+	animation = {
+		'v': '5.5.2', 'fr': 60, 'ip': 0, 'op': frames, 'w': STICKER_SIZE, 'h': STICKER_SIZE,
+		'layers': [{
+			'ty': 4, 'ind': 1, 'ip': 0, 'op': frames, 'st': 0,
+			'ks': {
+				'o': {'a': 0, 'k': 100},
+				'r': {'a': 0, 'k': 0},
+				'a': {'a': 0, 'k': [0, 0, 0]},
+				's': {'a': 0, 'k': [100, 100, 100]},
+				'p': {'a': 1, 'k': [
+					{'t': 0, 's': [64, y, 0], 'e': [STICKER_SIZE - 64, y, 0]},
+					{'t': frames},
+				]},
+			},
+			'shapes': [
+				{'ty': 'rc', 'p': {'a': 0, 'k': [0, 0]}, 's': {'a': 0, 'k': [96, 96]}, 'r': {'a': 0, 'k': 16}},
+				{'ty': 'fl', 'c': {'a': 0, 'k': color}, 'o': {'a': 0, 'k': 100}},
+			],
+		}],
+	}
+	return gzip.compress(json.dumps(animation).encode())
+
+class ImagePool:
+	"""A fixed set of distinct images to build fixture packs from, so that they only have to be encoded once."""
+
+	def __init__(self, make=make_sticker_image, size=32):
+		self.images = [make(seed) for seed in range(size)]
+
+	def take(self, count, offset=0):
+		return [self.images[(offset + i) % len(self.images)] for i in range(count)]
@@ -0,0 +1,171 @@
+import os
+import errno
+import contextlib
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import anyio
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = 'cache'
+DEFAULT_MAX_SIZE = 1024 ** 3
+
+class BlobCache:
+	"""A persistent cache of immutable blobs, evicted least-recently-used first once it grows past max_size bytes.
+
+	Entries are stored one per file, named by the hash of their key.
+	File mtimes double as the recency order so that it survives restarts.
+	"""
+
+	def __init__(self, path, max_size: int):
+		self.path = Path(path)
+		self.max_size = max_size
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		# file name -> size, least recently used first
+		self.entries = OrderedDict()
+		self._lock = threading.Lock()
+
+		self.path.mkdir(parents=True, exist_ok=True)
+		self._load()
+
+	@classmethod
+	def from_config(cls, config, section='cache', *, default_path=DEFAULT_PATH, default_max_size=DEFAULT_MAX_SIZE):
+		cache_config = config.get(section, {})
+		return cls(cache_config.get('path', default_path), cache_config.get('max_size', default_max_size))
+
+	@staticmethod
+	def key(*parts) -> str:
+		"""Derive a cache key from e.g. a namespace, a content identifier, and a transcode profile."""
+		return hashlib.sha256('\0'.join(map(str, parts)).encode()).hexdigest()
+
+	@property
+	def hit_ratio(self) -> float:
+		total = self.hits + self.misses
+		return self.hits / total if total else 0.0
+
+	def _load(self):
+		files = []
+		for path in self.path.iterdir():
+			if path.suffix == '.tmp':
+				# left over from a write that was interrupted
+				path.unlink()
+				continue
+			stat = path.stat()
+			files.append((stat.st_mtime, path.name, stat.st_size))
+
+		for _, name, size in sorted(files):
+			self.entries[name] = size
+			self.size += size
+
+		self._evict()
+
+	def get_sync(self, key: str):
+		with self._lock:
+			if key not in self.entries:
+				self.misses += 1
+				return None
+			self.entries.move_to_end(key)
+
+		path = self.path / key
+		try:
+			data = path.read_bytes()
+			os.utime(path)
+		except FileNotFoundError:
+			# evicted by another thread between the lookup and the read
+			with self._lock:
+				self.misses += 1
+			return None
+
+		with self._lock:
+			self.hits += 1
+		return data
+
+	def put_sync(self, key: str, data):
+		fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				f.write(data)
+			os.replace(tmp_path, self.path / key)
+		except BaseException:
+			with contextlib.suppress(FileNotFoundError):
+				os.unlink(tmp_path)
+			raise
+
+		with self._lock:
+			self.size += len(data) - self.entries.pop(key, 0)
+			self.entries[key] = len(data)
+			self._evict()
+
+	def adopt_sync(self, key: str, path):
+		"""Move the file at path into the cache under key, rather than writing its contents out again."""
+		path = Path(path)
+		try:
+			size = path.stat().st_size
+			os.replace(path, self.path / key)
+		except OSError as exc:
+			if exc.errno != errno.EXDEV:
+				raise
+			# it's on another filesystem, so it has to be copied after all
+			self.put_sync(key, path.read_bytes())
+			path.unlink()
+			return
+		# it's the most recently used now
+		os.utime(self.path / key)
+
+		with self._lock:
+			self.size += size - self.entries.pop(key, 0)
+			self.entries[key] = size
+			self._evict()
+
+	def _evict(self):
+		while self.size > self.max_size and self.entries:
+			name, size = self.entries.popitem(last=False)
+			self.size -= size
+			with contextlib.suppress(FileNotFoundError):
+				(self.path / name).unlink()
+			logger.debug('Evicted %s (%d bytes)', name, size)
+
+	def enforce_limit_sync(self):
+		with self._lock:
+			self._evict()
+
+	async def enforce_limit(self):
+		"""Evict entries until the cache is back under max_size, e.g. after max_size was lowered."""
+		await anyio.run_sync_in_worker_thread(self.enforce_limit_sync)
+
+	async def get(self, key: str):
+		return await anyio.run_sync_in_worker_thread(self.get_sync, key)
+
+	async def put(self, key: str, data):
+		await anyio.run_sync_in_worker_thread(self.put_sync, key, data)
+
+def test_round_trip(tmp_path):
+	cache = BlobCache(tmp_path, 100)
+	key = cache.key('tg', 1234, 'webp')
+
+	assert cache.get_sync(key) is None
+	cache.put_sync(key, b'abc')
+	assert cache.get_sync(key) == b'abc'
+	assert (cache.hits, cache.misses) == (1, 1)
+
+	# survives a restart
+	assert BlobCache(tmp_path, 100).get_sync(key) == b'abc'
+
+def test_lru_eviction(tmp_path):
+	cache = BlobCache(tmp_path, 10)
+	cache.put_sync('a', b'1234')
+	cache.put_sync('b', b'1234')
+	assert cache.get_sync('a') is not None
+	cache.put_sync('c', b'1234')
+
+	assert cache.size == 8
+	assert cache.get_sync('b') is None
+	assert cache.get_sync('a') == b'1234'
+	assert not (tmp_path / 'b').exists()
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 
 import anyio
-import asqlite
 import contextlib
+from functools import partial
 from .stickers_client import MultiStickersClient, CREATE_PACK_RL
+from .blob_cache import BlobCache
+from .database import Database
 
 INTRO = """\
 Hi there! I'm a simple bot that converts Telegram stickers to Signal stickers and back.
@@ -17,13 +19,7 @@ You can also just send me a sticker and I'll convert the pack that it's from.
 This bot is open-source software under the terms of the AGPLv3 license. You can find the source code at:
 """
 
-DB_SCHEMA_PATH = './schema.sql'
-
 async def build_stickers_client(db, config):
-	if len(await db.fetchall("SELECT name FROM sqlite_master WHERE type='table'")) == 0:
-		with open(DB_SCHEMA_PATH, 'r') as f:
-			await db.executescript(f.read())
-
 	accounts = {account['username']: account for account in config['signal']['stickers']['accounts']}
 	bucket_rows = await db.fetchall('SELECT account_id, space_remaining, last_updated_at FROM signal_accounts')
 	for row in bucket_rows:
@@ -34,7 +30,13 @@ async def build_stickers_client(db, config):
 		except KeyError:
 			continue
 
-	return MultiStickersClient(db, accounts.values())
+	return MultiStickersClient(
+		db, accounts.values(),
+		account_strategy=config['signal']['stickers'].get('account_strategy', 'most_space'),
+		flush_interval=config['signal']['stickers'].get('flush_interval', 60),
+		blob_cache=BlobCache.from_config(config, 'signal_cache', default_path='signal_cache', default_max_size=256 * 1024**2),
+		max_manifests=config.get('signal_cache', {}).get('max_manifests', 256),
+	)
 
 async def main():
 	import toml
@@ -55,21 +57,40 @@ async def main():
 	from .telegram_bot import (
 		build_client as build_tg_client,
 		run as run_telegram,
+		deliver as deliver_telegram,
 	)
 	from .signal_bot import (
 		build_client as build_signal_client,
 		run as run_signal,
+		deliver as deliver_signal,
 	)
+	from .jobs import JobScheduler
+	from .glue import verify_telegram_packs
+	from .maintenance import Maintenance
+	from . import metrics
 
-	async with asqlite.connect('db.sqlite3') as db, await build_stickers_client(db, config) as stickers_client:
-		tg_client = build_tg_client(config, db, stickers_client)
-		if config['signal'].get('username'):
-			signal_client = build_signal_client(config, db, tg_client, stickers_client)
-
-		async with anyio.create_task_group() as tg:
-			await tg.spawn(run_telegram, tg_client)
+	async with Database.from_config(config) as db:
+		await db.migrate()
+		async with await build_stickers_client(db, config) as stickers_client:
+			tg_client = build_tg_client(config, db, stickers_client)
+			jobs = tg_client.jobs = JobScheduler.from_config(config, db, tg_client, stickers_client)
+			jobs.register_platform('telegram', partial(deliver_telegram, tg_client))
 			if config['signal'].get('username'):
-				await tg.spawn(run_signal, signal_client)
+				signal_client = build_signal_client(config, db, tg_client, stickers_client)
+				signal_client.jobs = jobs
+				jobs.register_platform('signal', partial(deliver_signal, signal_client))
+			metrics.register_runtime_metrics(db, tg_client, stickers_client)
+
+			async with anyio.create_task_group() as tg:
+				await tg.spawn(run_telegram, tg_client)
+				await tg.spawn(jobs.run)
+				await tg.spawn(stickers_client.flush_periodically)
+				await tg.spawn(verify_telegram_packs, db, tg_client)
+				await tg.spawn(Maintenance.from_config(config, db, tg_client, stickers_client).run)
+				if 'metrics' in config:
+					await tg.spawn(metrics.serve, config)
+				if config['signal'].get('username'):
+					await tg.spawn(run_signal, signal_client)
 
 if __name__ == '__main__':
 	with contextlib.suppress(KeyboardInterrupt):
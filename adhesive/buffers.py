@@ -0,0 +1,100 @@
+"""Passing sticker images between download, decompression, transcoding and upload without copying them.
+
+Images are held as memoryviews (or bytes, which are just as cheap to pass around) from start to finish.
+Anything that wants a file gets a BufferReader over the same memory.
+"""
+
+import io
+
+class Buffer:
+	"""A bytearray that's written to in place, preallocated when the final size is known ahead of time."""
+
+	def __init__(self, size_hint=0):
+		self._data = bytearray(size_hint or 0)
+		self._length = 0
+
+	def __len__(self):
+		return self._length
+
+	def write(self, chunk) -> int:
+		n = len(chunk)
+		end = self._length + n
+		if end > len(self._data):
+			# the size hint was wrong (or missing), so grow geometrically
+			self._data.extend(bytes(max(end - len(self._data), len(self._data))))
+		self._data[self._length:end] = chunk
+		self._length = end
+		return n
+
+	def view(self) -> memoryview:
+		"""Return the contents. Nothing more can be written once this has been called."""
+		if self._length != len(self._data):
+			del self._data[self._length:]
+		return memoryview(self._data)
+
+class BufferReader(io.RawIOBase):
+	"""A read-only, seekable file over a bytes-like object. Unlike io.BytesIO, this never copies it."""
+
+	def __init__(self, data):
+		self._view = memoryview(data).cast('B')
+		self._pos = 0
+
+	def readable(self):
+		return True
+
+	def seekable(self):
+		return True
+
+	def readinto(self, b):
+		chunk = self._view[self._pos:self._pos + len(b)]
+		n = len(chunk)
+		b[:n] = chunk
+		self._pos += n
+		return n
+
+	def readall(self):
+		return self.read(len(self._view) - self._pos)
+
+	def seek(self, offset, whence=io.SEEK_SET):
+		if whence == io.SEEK_SET:
+			pos = offset
+		elif whence == io.SEEK_CUR:
+			pos = self._pos + offset
+		elif whence == io.SEEK_END:
+			pos = len(self._view) + offset
+		else:
+			raise ValueError(f'invalid whence ({whence!r})')
+		if pos < 0:
+			raise ValueError(f'negative seek position {pos}')
+		self._pos = pos
+		return pos
+
+	def tell(self):
+		return self._pos
+
+	def getbuffer(self) -> memoryview:
+		return self._view
+
+def test_buffer():
+	buf = Buffer(4)
+	buf.write(b'ab')
+	buf.write(b'cd')
+	# outgrow the hint
+	buf.write(b'efg')
+	assert len(buf) == 7
+	assert buf.view() == b'abcdefg'
+
+	buf = Buffer(10)
+	buf.write(b'abc')
+	assert buf.view() == b'abc'
+
+def test_buffer_reader():
+	data = bytearray(b'hello world')
+	f = BufferReader(memoryview(data))
+	assert f.read(5) == b'hello'
+	assert f.tell() == 5
+	f.seek(-5, io.SEEK_END)
+	assert f.read() == b'world'
+	assert f.read(1) == b''
+	f.seek(0)
+	assert f.getbuffer() == data
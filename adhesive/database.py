@@ -0,0 +1,166 @@
+import logging
+from pathlib import Path
+from urllib.parse import quote
+
+import anyio
+import asqlite
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = 'db.sqlite3'
+# numbered .sql files, run in order. a database's PRAGMA user_version is the number of the last one it's had
+MIGRATIONS_PATH = Path(__file__).parent.parent / 'migrations'
+
+def _is_read(sql: str) -> bool:
+	return sql.lstrip().upper().startswith('SELECT')
+
+def _init_writer(conn):
+	# in WAL mode this only gives up durability against power loss (not crashes), in exchange for much faster commits
+	conn.execute('pragma synchronous=normal')
+	# lets adhesive.maintenance give free pages back to the OS. asqlite has already switched to WAL by now,
+	# so this needs a VACUUM to take effect, which is only free while the database is still empty
+	if conn.execute('SELECT count(*) FROM sqlite_master').fetchone()[0] == 0:
+		conn.execute('pragma auto_vacuum=incremental')
+		conn.execute('VACUUM')
+
+def _migrations(path):
+	migrations = []
+	for file in Path(path).glob('*.sql'):
+		number, _, _ = file.name.partition('_')
+		migrations.append((int(number), file))
+	return sorted(migrations)
+
+class Database:
+	"""The bot's SQLite database, with the same execute/fetchone/fetchall/executescript methods as an asqlite Connection.
+
+	The database is in WAL mode, so reads don't have to wait for writes. Writes all go through one connection,
+	one at a time, while SELECTs are spread over a pool of read-only connections.
+	Each connection keeps up to cached_statements prepared statements around, keyed by their SQL,
+	so queries should be constant strings with ? parameters rather than formatted.
+	"""
+
+	def __init__(self, path=DEFAULT_PATH, *, readers=2, cached_statements=256):
+		self.path = str(path)
+		# an in-memory database is private to the connection that opened it
+		self.num_readers = 0 if self.path == ':memory:' else readers
+		self.cached_statements = cached_statements
+		self._writer = None
+		self._write_lock = None
+		self._readers = []
+		# reader -> queries running on it
+		self._in_flight = {}
+
+	@classmethod
+	def from_config(cls, config):
+		db_config = config.get('database', {})
+		return cls(
+			db_config.get('path', DEFAULT_PATH),
+			readers=db_config.get('readers', 2),
+			cached_statements=db_config.get('cached_statements', 256),
+		)
+
+	async def __aenter__(self) -> 'Database':
+		self._write_lock = anyio.create_lock()
+		self._writer = await asqlite.connect(self.path, init=_init_writer, cached_statements=self.cached_statements)
+		try:
+			for _ in range(self.num_readers):
+				reader = await asqlite.connect(
+					f'file:{quote(self.path)}?mode=ro', uri=True, cached_statements=self.cached_statements,
+				)
+				self._readers.append(reader)
+				self._in_flight[reader] = 0
+		except BaseException:
+			await self.close()
+			raise
+		return self
+
+	async def __aexit__(self, *excinfo):
+		await self.close()
+
+	async def close(self):
+		for conn in (*self._readers, self._writer):
+			if conn is not None:
+				await conn.close()
+		self._readers.clear()
+		self._in_flight.clear()
+		self._writer = None
+
+	async def _read(self, method, sql, params):
+		# the least busy reader
+		reader = min(self._readers, key=self._in_flight.__getitem__)
+		self._in_flight[reader] += 1
+		try:
+			return await getattr(reader, method)(sql, *params)
+		finally:
+			self._in_flight[reader] -= 1
+
+	async def _write(self, method, sql, params):
+		async with self._write_lock:
+			return await getattr(self._writer, method)(sql, *params)
+
+	async def _run(self, method, sql, params):
+		if self._readers and _is_read(sql):
+			return await self._read(method, sql, params)
+		return await self._write(method, sql, params)
+
+	async def execute(self, sql, *params):
+		return await self._write('execute', sql, params)
+
+	async def executescript(self, script):
+		async with self._write_lock:
+			return await self._writer.executescript(script)
+
+	async def fetchone(self, sql, *params):
+		return await self._run('fetchone', sql, params)
+
+	async def fetchall(self, sql, *params):
+		return await self._run('fetchall', sql, params)
+
+	async def migrate(self, path=MIGRATIONS_PATH):
+		"""Run every migration newer than the database, in order. Each one runs in its own transaction."""
+		async with self._write_lock:
+			[version] = await self._writer.fetchone('PRAGMA user_version')
+			for number, file in _migrations(path):
+				if number <= version:
+					continue
+				logger.info('Migrating the database to version %d (%s)', number, file.name)
+				try:
+					await self._writer.executescript(
+						f'BEGIN;\n{file.read_text()}\nPRAGMA user_version = {number};\nCOMMIT;'
+					)
+				except BaseException:
+					async with anyio.open_cancel_scope(shield=True):
+						if self._writer.get_connection().in_transaction:
+							await self._writer.execute('ROLLBACK')
+					raise
+
+def test_database(tmp_path):
+	migrations = tmp_path / 'migrations'
+	migrations.mkdir()
+	(migrations / '0001_initial.sql').write_text('CREATE TABLE IF NOT EXISTS t (x INTEGER PRIMARY KEY);')
+	(migrations / '0002_add_y.sql').write_text('ALTER TABLE t ADD COLUMN y TEXT;')
+
+	async def main():
+		async with Database(tmp_path / 'db.sqlite3') as db:
+			await db.migrate(migrations)
+			# already up to date, so the ALTER TABLE isn't run again
+			await db.migrate(migrations)
+			assert tuple(await db.fetchone('PRAGMA user_version')) == (2,)
+
+			await db.execute('INSERT INTO t (x, y) VALUES (?, ?)', 1, 'a')
+			assert tuple(await db.fetchone('SELECT x, y FROM t WHERE x = ?', 1)) == (1, 'a')
+			assert tuple(await db.fetchone('INSERT INTO t (x) VALUES (2) RETURNING x')) == (2,)
+			assert len(await db.fetchall('SELECT x FROM t')) == 2
+
+			(migrations / '0003_broken.sql').write_text('CREATE TABLE u (z); INSERT INTO nonexistent VALUES (1);')
+			try:
+				await db.migrate(migrations)
+			except Exception:
+				pass
+			else:
+				assert False, 'the broken migration should have failed'
+			# and left nothing behind
+			assert tuple(await db.fetchone('PRAGMA user_version')) == (2,)
+			assert not await db.fetchall("SELECT 1 FROM sqlite_master WHERE name = 'u'")
+
+	anyio.run(main)
@@ -0,0 +1,174 @@
+import time
+import logging
+
+import anyio
+import httpx
+import telethon.errors
+
+logger = logging.getLogger(__name__)
+
+# errors worth retrying a download for
+TRANSIENT_ERRORS = (
+	OSError,
+	TimeoutError,
+	httpx.TransportError,
+	telethon.errors.ServerError,
+	telethon.errors.TimedOutError,
+)
+
+class _Lane:
+	__slots__ = 'limiter', 'paused_until'
+
+	def __init__(self, limit):
+		self.limiter = anyio.create_capacity_limiter(limit)
+		self.paused_until = 0.0
+
+class _Pack:
+	__slots__ = 'limiter', 'users'
+
+	def __init__(self, limit):
+		self.limiter = anyio.create_capacity_limiter(limit)
+		self.users = 0
+
+class DownloadScheduler:
+	"""Bounds how many downloads run at once: overall, per pack, and per lane.
+
+	A lane is wherever the files come from, i.e. a Telegram DC or the Signal CDN.
+	When Telegram tells us to wait, only the lane that was told to wait is paused.
+	Downloads that fail with transient errors are retried individually with exponential backoff.
+	"""
+
+	def __init__(self, *, global_limit=32, per_pack_limit=8, per_lane_limit=16, retries=3, backoff=1.0):
+		self.global_limit = global_limit
+		self.per_pack_limit = per_pack_limit
+		self.per_lane_limit = per_lane_limit
+		self.retries = retries
+		self.backoff = backoff
+		self._global = None
+		self._lanes = {}
+		self._packs = {}
+
+	@classmethod
+	def from_config(cls, config):
+		downloads_config = config.get('downloads', {})
+		return cls(
+			global_limit=downloads_config.get('global_limit', 32),
+			per_pack_limit=downloads_config.get('per_pack_limit', 8),
+			# per_dc_limit is what this was called before it applied to Signal too
+			per_lane_limit=downloads_config.get('per_lane_limit', downloads_config.get('per_dc_limit', 16)),
+			retries=downloads_config.get('retries', 3),
+		)
+
+	async def run(self, pack, lane, f, *args):
+		"""Return await f(*args) once pack, lane and global capacity allow it."""
+		# limiters can only be created inside the event loop
+		if self._global is None:
+			self._global = anyio.create_capacity_limiter(self.global_limit)
+		try:
+			lane = self._lanes[lane]
+		except KeyError:
+			lane = self._lanes[lane] = _Lane(self.per_lane_limit)
+		try:
+			pack_state = self._packs[pack]
+		except KeyError:
+			pack_state = self._packs[pack] = _Pack(self.per_pack_limit)
+
+		pack_state.users += 1
+		try:
+			return await self._run(pack_state, lane, f, args)
+		finally:
+			pack_state.users -= 1
+			if not pack_state.users:
+				del self._packs[pack]
+
+	async def _run(self, pack, lane, f, args):
+		attempt = 0
+		while True:
+			# wait out a pause before taking one of the pack's slots, so that it doesn't hold up downloads from other lanes
+			await self._wait_for(lane)
+			# acquire the most specific limiter first so that waiting downloads don't hog global capacity
+			async with pack.limiter:
+				if lane.paused_until > time.monotonic():
+					# it was paused again while we were waiting for the slot
+					continue
+				async with lane.limiter, self._global:
+					try:
+						return await f(*args)
+					except telethon.errors.FloodWaitError as exc:
+						logger.warning('Told to wait %ds before downloading more', exc.seconds)
+						lane.paused_until = max(lane.paused_until, time.monotonic() + exc.seconds)
+						# this wasn't the download's fault, so it doesn't count as an attempt
+						continue
+					except TRANSIENT_ERRORS as exc:
+						if attempt >= self.retries:
+							raise
+						delay = self.backoff * 2 ** attempt
+						attempt += 1
+						logger.debug('Download failed (%r); retrying in %gs', exc, delay)
+
+			await anyio.sleep(delay)
+
+	async def _wait_for(self, lane):
+		while True:
+			delay = lane.paused_until - time.monotonic()
+			if delay <= 0:
+				return
+			await anyio.sleep(delay)
+
+def test_retries():
+	scheduler = DownloadScheduler(retries=2, backoff=0)
+	attempts = 0
+
+	async def flaky(failures):
+		nonlocal attempts
+		attempts += 1
+		if attempts <= failures:
+			raise OSError('connection reset')
+		return 'data'
+
+	async def main():
+		nonlocal attempts
+		# transient errors are retried
+		assert await scheduler.run('pack', 'dc1', flaky, 2) == 'data'
+		assert attempts == 3
+
+		# but only so many times
+		attempts = 0
+		try:
+			await scheduler.run('pack', 'dc1', flaky, 3)
+		except OSError:
+			pass
+		else:
+			assert False, 'the download should have failed'
+		assert attempts == 3
+		assert not scheduler._packs
+
+	anyio.run(main)
+
+def test_flood_wait_only_pauses_its_lane():
+	# one download at a time per pack, so a paused lane holding the pack's slot would hold up the other lane too
+	scheduler = DownloadScheduler(per_pack_limit=1)
+	finished = []
+	told_to_wait = False
+
+	async def download(lane):
+		nonlocal told_to_wait
+		if lane == 'dc1' and not told_to_wait:
+			told_to_wait = True
+			raise telethon.errors.FloodWaitError(request=None, capture=1)
+		finished.append((lane, time.monotonic()))
+
+	async def main():
+		start = time.monotonic()
+		async with anyio.create_task_group() as tg:
+			await tg.spawn(scheduler.run, 'pack', 'dc1', download, 'dc1')
+			await anyio.sleep(0.01)
+			await tg.spawn(scheduler.run, 'pack', 'dc2', download, 'dc2')
+
+		assert [lane for lane, _ in finished] == ['dc2', 'dc1']
+		times = dict(finished)
+		assert times['dc2'] - start < 0.5
+		# and dc1 was retried once its wait was over
+		assert times['dc1'] - start >= 1
+
+	anyio.run(main)
@@ -1,25 +1,87 @@
 import io
 import gzip
+import time
 import random
 import logging
+import contextlib
 import urllib.parse
+from functools import partial
 
 import anyio
 import humanize
 import telethon.utils
 import telethon.errors
 from signalstickers_client import models as signal_models
-#from lottie.importers.core import import_tgs
 from telethon import tl
-import PIL.Image
 
 from .stickers_client import RateLimited, ServerRateLimited
-
-#from .apng import export_apng
+from .single_flight import SingleFlight
+from .blob_cache import BlobCache
+from .staging import Staging
+from .uploaded_documents import UploadedDocumentCache
+from .render import RenderEngine
+from .transcode import build_transcoder
+from .downloads import DownloadScheduler
+from .uploads import AdaptiveLimiter
+from .sticker_sets import StickerSetCache
+from .buffers import Buffer, BufferReader
+from .admission import MemoryBudget, estimate_tg_pack, estimate_signal_pack
 
 logger = logging.getLogger(__name__)
 
 THREAD_LIMITER = None
+# how many renders are waiting on THREAD_LIMITER
+THREAD_LIMITER_WAITING = 0
+
+# popular packs tend to get sent to us by many people at once, so make sure each one is only converted once.
+# keyed by tg_hash and Signal pack_id respectively.
+SIGNAL_CONVERSIONS = SingleFlight()
+TELEGRAM_CONVERSIONS = SingleFlight()
+
+# sticker sets are refetched if they're older than this (in seconds) before their stickers are downloaded,
+# since the file references in them expire
+FILE_REFERENCE_MAX_AGE = 60
+
+# how many stickers to send to each transcoder worker at a time
+TRANSCODE_BATCH_SIZE = 4
+# the transcode profiles (see adhesive.transcode) used for Signal stickers going to Telegram
+TELEGRAM_STICKER_PROFILE = 'telegram_sticker'
+TELEGRAM_THUMBNAIL_PROFILE = 'telegram_thumbnail'
+
+# functions (stage, seconds) which are told how long each step of a conversion took.
+# stages are 'download', 'transcode', and 'upload'.
+STAGE_OBSERVERS = []
+
+@contextlib.contextmanager
+def timed(stage):
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		elapsed = time.perf_counter() - start
+		for observer in STAGE_OBSERVERS:
+			observer(stage, elapsed)
+
+def attach_services(tg_client, config):
+	"""Set up everything that the converters expect to find on the Telegram client, other than db and user."""
+	tg_client.blob_cache = BlobCache.from_config(config)
+	tg_client.staging = Staging.from_config(config)
+	tg_client.render_engine = RenderEngine.from_config(config)
+	tg_client.transcoder = build_transcoder(config)
+	tg_client.downloads = DownloadScheduler.from_config(config)
+	# shared by all conversions so that what we learn about Telegram's rate limits carries over
+	tg_client.uploads = AdaptiveLimiter.from_config(config)
+	tg_client.uploaded_documents = UploadedDocumentCache(tg_client)
+	tg_client.sticker_sets = StickerSetCache.from_config(tg_client, config)
+	# caps how much memory all conversions together may use
+	tg_client.admission = MemoryBudget.from_config(config)
+
+def start_services(tg_client):
+	tg_client.transcoder.start()
+
+def shutdown_services(tg_client):
+	tg_client.render_engine.shutdown()
+	tg_client.transcoder.shutdown()
 
 # Yes, this is kind of a jank API. No, I don't really care :)
 async def convert_link_interactive(db, tg_client, stickers_client, link):
@@ -36,10 +98,7 @@ async def convert_link_interactive(db, tg_client, stickers_client, link):
 IN_PROGRESS = object()
 
 async def convert_pack_interactive(db, tg_client, stickers_client, converter, *pack_info):
-	in_progress_message = (
-		f'Converting this pack to {"Signal" if converter is convert_to_signal else "Telegram"}. '
-		'Hold on tight…'
-	)
+	in_progress_message = format_in_progress_message(converter)
 
 	# This seems like a pretty strange thing to do. Allow me to explain.
 	# Converter functions are async generators which are expected to either raise an error,
@@ -56,6 +115,12 @@ async def convert_pack_interactive(db, tg_client, stickers_client, converter, *p
 	except (ValueError, NotImplementedError, RateLimited) as exc:
 		yield False, exc.args[0]
 
+def format_in_progress_message(converter):
+	return (
+		f'Converting this pack to {"Signal" if converter is convert_to_signal else "Telegram"}. '
+		'Hold on tight…'
+	)
+
 def parse_link(link: str):
 	parsed = urllib.parse.urlparse(link)
 	# TODO deduplicate this mess
@@ -85,19 +150,12 @@ def parse_link(link: str):
 	return converter, pack_info
 
 async def convert_to_signal(db, tg_client, stickers_client, pack):
-	rl_wait = stickers_client.get_min_wait_time()
-	if rl_wait:
-		raise RateLimited(
-			"Signal told me to slow down. Looks like I've been a bit too popular lately 🥴\n"
-			f"Try again in about {humanize.naturaltime(stickers_client.get_min_wait_time(), future=True)}."
-		)
-
 	if isinstance(pack, str):
 		input_sticker_set = tl.types.InputStickerSetShortName(short_name=pack)
 	else:
 		input_sticker_set = pack
 	try:
-		tg_pack = await tg_client(tl.functions.messages.GetStickerSetRequest(input_sticker_set))
+		tg_pack = await tg_client.sticker_sets.get(input_sticker_set)
 	except telethon.errors.StickersetInvalidError:
 		raise ValueError('Sticker pack not found.')
 
@@ -116,25 +174,43 @@ async def convert_to_signal(db, tg_client, stickers_client, pack):
 	if tg_pack.set.animated:
 		raise NotImplementedError('Animated packs are not supported yet.')
 
+	# already converted packs don't need any tokens, and neither do ones that were registered by an upload that failed
+	# part of the way through, so only check this once we know we'll need one
+	if stickers_client.get_min_wait_time() and not await stickers_client.has_pending_upload(tg_pack.set.hash):
+		raise rate_limited(stickers_client)
+
 	yield IN_PROGRESS
 
+	try:
+		tg_pack = await tg_client.sticker_sets.get(input_sticker_set, max_age=FILE_REFERENCE_MAX_AGE)
+	except telethon.errors.StickersetInvalidError:
+		raise ValueError('Sticker pack not found.')
+
+	pack_info = await SIGNAL_CONVERSIONS.run(
+		tg_pack.set.hash, _convert_to_signal, db, tg_client, stickers_client, tg_pack,
+	)
+	yield True, (*pack_info, tg_pack_url(tg_pack.set.short_name))
+
+async def _convert_to_signal(db, tg_client, stickers_client, tg_pack):
 	signal_pack = signal_models.LocalStickerPack()
 	signal_pack.title = tg_pack.set.title
 	signal_pack.stickers = [None] * tg_pack.set.count
 	signal_pack.author = tg_pack_url(tg_pack.set.short_name)
 
-	# TODO fix cover downloading
-	async with anyio.create_task_group() as tg:
-		for i, tg_sticker in enumerate(tg_pack.documents):
-			await tg.spawn(add_tg_sticker, tg_client, signal_pack, i, tg_sticker)
-
-	try:
-		pack_info = await stickers_client.upload_pack(signal_pack)
-	except (RateLimited, ServerRateLimited):
-		raise RateLimited(
-			"Signal told me to slow down. Looks like I've been a bit too popular lately 🥴\n"
-			f"Try again in about {humanize.naturaltime(stickers_client.get_min_wait_time(), future=True)}."
-		)
+	async with tg_client.admission.admit(estimate_tg_pack(tg_pack)) as ticket:
+		# TODO fix cover downloading
+		async with anyio.create_task_group() as tg:
+			for i, tg_sticker in enumerate(tg_pack.documents):
+				await tg.spawn(add_tg_sticker, tg_client, signal_pack, i, tg_sticker, tg_pack.set.hash)
+		log_cache_stats(tg_client.blob_cache)
+		ticket.actual = sum(len(sticker.image_data) for sticker in signal_pack.stickers)
+
+		try:
+			with timed('upload'):
+				# if this fails, retrying resumes from the last step that finished, with the same staged images
+				pack_info = await stickers_client.upload_pack(signal_pack, checkpoint_key=tg_pack.set.hash)
+		except (RateLimited, ServerRateLimited):
+			raise rate_limited(stickers_client)
 
 	await db.execute(
 		"""
@@ -144,10 +220,21 @@ async def convert_to_signal(db, tg_client, stickers_client, pack):
 		""",
 		tg_pack.set.hash, *map(bytes.fromhex, pack_info),
 	)
+	await tg_client.staging.move_to_cache(tg_pack.set.hash, tg_client.blob_cache, {
+		i: tg_sticker_cache_key(tg_client, tg_sticker) for i, tg_sticker in enumerate(tg_pack.documents)
+	})
 
-	yield True, (*pack_info, tg_pack_url(tg_pack.set.short_name))
+	return pack_info
+
+def rate_limited(stickers_client):
+	return RateLimited(
+		"Signal told me to slow down. Looks like I've been a bit too popular lately 🥴\n"
+		f"Try again in about {humanize.naturaltime(stickers_client.get_min_wait_time(), future=True)}."
+	)
 
-async def add_tg_sticker(tg_client, signal_pack: signal_models.LocalStickerPack, sticker_id: int, tg_sticker):
+async def add_tg_sticker(
+	tg_client, signal_pack: signal_models.LocalStickerPack, sticker_id: int, tg_sticker, staging_key=None,
+):
 	signal_sticker = signal_models.Sticker()
 	signal_sticker.id = sticker_id
 	signal_sticker.emoji = next(
@@ -156,78 +243,161 @@ async def add_tg_sticker(tg_client, signal_pack: signal_models.LocalStickerPack,
 		if isinstance(attr, tl.types.DocumentAttributeSticker)
 	).alt
 
-	logger.debug('Downloading %s', signal_sticker.emoji)
-	data = io.BytesIO()
-	async for chunk in tg_client.iter_download(tg_sticker):
+	if staging_key is not None:
+		signal_sticker.image_data = await tg_client.staging.get(staging_key, sticker_id)
+		if signal_sticker.image_data is not None:
+			signal_pack.stickers[sticker_id] = signal_sticker
+			return
+
+	cache = tg_client.blob_cache
+	cache_key = tg_sticker_cache_key(tg_client, tg_sticker)
+	signal_sticker.image_data = await cache.get(cache_key)
+	if signal_sticker.image_data is None:
+		logger.debug('Downloading %s', signal_sticker.emoji)
+		with timed('download'):
+			data = await tg_client.downloads.run(
+				signal_pack, f'telegram-dc{tg_sticker.dc_id}', download_document, tg_client, tg_sticker,
+			)
+		logger.debug('Downloaded %s', signal_sticker.emoji)
+		with timed('transcode'):
+			signal_sticker.image_data = await convert_tg_sticker(tg_client, signal_sticker, tg_sticker, data)
+		# each image is only written to disk once. staged images are moved into the cache once the upload is done.
+		# (ones that came from the cache aren't staged as well, so a retry might have to download them again)
+		if staging_key is None:
+			await cache.put(cache_key, signal_sticker.image_data)
+		else:
+			await tg_client.staging.put(staging_key, sticker_id, signal_sticker.image_data)
+
+	signal_pack.stickers[sticker_id] = signal_sticker
+
+def tg_sticker_cache_key(tg_client, tg_sticker):
+	# document IDs identify the sticker's contents, but what we make of animated ones depends on the render settings,
+	# so those are part of the key so that changing them doesn't serve stale images. WEBPs are used as they are.
+	if tg_sticker.mime_type == 'application/x-tgsticker':
+		engine = tg_client.render_engine
+		settings = engine.max_size, engine.compress_level
+	else:
+		settings = ()
+	return tg_client.blob_cache.key('tg', tg_sticker.id, tg_sticker.mime_type, *settings)
+
+async def download_document(tg_client, document) -> memoryview:
+	data = Buffer(document.size)
+	async for chunk in tg_client.iter_download(document):
 		data.write(chunk)
-	data.seek(0)
-	logger.debug('Downloaded %s', signal_sticker.emoji)
+	return data.view()
 
+async def convert_tg_sticker(tg_client, signal_sticker, tg_sticker, data: memoryview) -> memoryview:
 	if tg_sticker.mime_type == 'application/x-tgsticker':
 		logger.debug('Converting %s to APNG', signal_sticker.emoji)
-		image_data = await convert_tgs_to_apng(data)
+		image_data = await convert_tgs_to_apng(tg_client, data)
 	elif tg_sticker.mime_type == 'image/webp':
 		image_data = data
 	else:
 		raise RuntimeError('unexpected image type', tg_sticker.mime_type, 'found in pack')
 
-	signal_sticker.image_data = image_data.getvalue()
+	# WEBP stickers go into the pack exactly as they were downloaded
+	return image_data
 
-	signal_pack.stickers[sticker_id] = signal_sticker
+async def convert_tgs_to_apng(tg_client, data) -> memoryview:
+	global THREAD_LIMITER, THREAD_LIMITER_WAITING
 
-async def convert_tgs_to_apng(data):
-	global THREAD_LIMITER
+	decompressed = gzip.decompress(data)
+	del data
 
-	decompressed = io.BytesIO()
-	with gzip.open(data) as gz:
-		decompressed.write(gz.read())
+	engine = tg_client.render_engine
+	# rendering happens in separate processes now, but each sticker being rendered still holds all of its frames
+	# in memory until they're assembled, so only render as many stickers at a time as there are workers
+	if THREAD_LIMITER is None:
+		THREAD_LIMITER = anyio.create_capacity_limiter(engine.workers)
 
-	decompressed.seek(0)
-	del data
+	THREAD_LIMITER_WAITING += 1
+	try:
+		await THREAD_LIMITER.acquire()
+	finally:
+		THREAD_LIMITER_WAITING -= 1
 
 	apng = io.BytesIO()
-	anim = import_tgs(decompressed)
-	# make sure we share the same thread limiter so that no more than one thread is used for APNG conversion
-	# globally
-	# otherwise we get OOM-killed lmao
-	if THREAD_LIMITER is None:
-		THREAD_LIMITER = anyio.create_capacity_limiter(1)
-	await anyio.run_sync_in_worker_thread(export_apng, anim, apng, limiter=THREAD_LIMITER)
-	return apng
+	try:
+		await engine.render(decompressed, apng)
+	finally:
+		await THREAD_LIMITER.release()
+	return apng.getbuffer()
 
-async def convert_to_telegram(_, tg_client, stickers_client, pack_id, pack_key):
-	# first make sure it's a valid sticker pack
+async def convert_to_telegram(db, tg_client, stickers_client, pack_id, pack_key):
+	try:
+		signal_pack_id = bytes.fromhex(pack_id)
+	except ValueError:
+		raise ValueError('Sticker pack not found.')
+
+	# make sure we haven't already converted this one
+	row = await db.fetchone(
+		"""
+		SELECT tg_short_name
+		FROM telegram_packs
+		WHERE signal_pack_id = ?
+		""",
+		signal_pack_id,
+	)
+	if row:
+		raise ValueError('This sticker pack has been converted before as ' + tg_pack_url(row[0]))
+
+	# then make sure it's a valid sticker pack
 	try:
 		pack = await stickers_client.get_pack_metadata(pack_id, pack_key)
 	except Exception:
 		raise ValueError('Sticker pack not found.')
 
-	stickers = []
-
-	# make sure we haven't already converted this one
 	# this _by_<bot username> suffix is mandatory
 	tg_short_name = f'signal_{pack_id}_by_{tg_client.user.username}'
 
+	# we might have converted it before we started keeping track of that
 	try:
-		await tg_client(tl.functions.messages.GetStickerSetRequest(tl.types.InputStickerSetShortName(tg_short_name)))
+		await tg_client.sticker_sets.get(tl.types.InputStickerSetShortName(tg_short_name))
 	except telethon.errors.StickersetInvalidError:
 		pass
 	else:
+		await record_telegram_pack(db, signal_pack_id, tg_short_name)
 		raise ValueError('This sticker pack has been converted before as ' + tg_pack_url(tg_short_name))
 
 	yield IN_PROGRESS
 
-	async def download_sticker(sticker):
-		sticker.image_data = await stickers_client.download_sticker(sticker.id, pack_id, pack_key)
+	yield True, await TELEGRAM_CONVERSIONS.run(
+		pack_id, _convert_to_telegram, db, tg_client, stickers_client, pack, tg_short_name,
+	)
 
-	async with anyio.create_task_group() as tg:
-		await tg.spawn(download_sticker, pack.cover)
-		for sticker in pack.stickers:
-			await tg.spawn(download_sticker, sticker)
+async def record_telegram_pack(db, signal_pack_id: bytes, tg_short_name):
+	await db.execute(
+		"""
+		INSERT INTO telegram_packs (signal_pack_id, tg_short_name)
+		VALUES (?, ?)
+		ON CONFLICT DO NOTHING
+		""",
+		signal_pack_id, tg_short_name,
+	)
 
-	# used to do this in parallel but that just caused a lot of rate-limiting
-	for sticker in pack.stickers:
-		stickers.append(await convert_signal_sticker(tg_client, sticker))
+async def _convert_to_telegram(db, tg_client, stickers_client, pack, tg_short_name):
+	stickers = [None] * len(pack.stickers)
+	indices = {id(sticker): i for i, sticker in enumerate(pack.stickers)}
+	thumb = None
+
+	async def upload(sticker, thumbnail):
+		nonlocal thumb
+		if thumbnail:
+			thumb = await upload_document(tg_client, 'image/png', sticker.image_data)
+		else:
+			stickers[indices[id(sticker)]] = await convert_signal_sticker(tg_client, sticker)
+
+	async with tg_client.admission.admit(estimate_signal_pack(pack)) as ticket:
+		# we used to upload everything in parallel but that just caused a lot of rate-limiting,
+		# so now upload_document adapts how many uploads it runs at once to how much Telegram will take.
+		# uploads start as soon as each sticker is transcoded, while the rest are still being transcoded.
+		async with anyio.create_task_group() as tg:
+			async for sticker, thumbnail in signal_stickers_to_png(tg_client, stickers_client, pack):
+				await tg.spawn(upload, sticker, thumbnail)
+		log_cache_stats(tg_client.blob_cache)
+		ticket.actual = sum(
+			len(sticker.image_data) for sticker in (*pack.stickers, pack.cover) if sticker and sticker.image_data
+		)
 
 	title = pack.title
 	if pack.author:
@@ -237,35 +407,161 @@ async def convert_to_telegram(_, tg_client, stickers_client, pack_id, pack_key):
 	if len(title) > 64:
 		title = textwrap.shorten(title, 64, placeholder=' …')
 
+	request = tl.functions.stickers.CreateStickerSetRequest(
+		# this user id can be anyone but it has to not be a bot
+		user_id='gq_grognard',
+		title=title,
+		short_name=tg_short_name,
+		stickers=stickers,
+		thumb=thumb,
+	)
 	try:
-		tg_pack = await tg_client(tl.functions.stickers.CreateStickerSetRequest(
-			# this user id can be anyone but it has to not be a bot
-			user_id='gq_grognard',
-			title=title,
-			short_name=tg_short_name,
-			stickers=stickers,
-			thumb=pack.cover and await upload_document(
-				tg_client,
-				'image/png',
-				await img_to_png(pack.cover.image_data, thumbnail=True)
-			),
-		))
+		try:
+			tg_pack = await tg_client(request)
+		except telethon.errors.FileReferenceExpiredError:
+			# documents we uploaded for an earlier pack can be old enough for this.
+			# Telegram doesn't say which ones, so refresh them all.
+			logger.info('File references expired while creating %s; refreshing them', tg_short_name)
+			for item, sticker in zip(stickers, pack.stickers):
+				item.document = await refresh_document(tg_client, 'image/png', sticker.image_data)
+			if thumb is not None:
+				request.thumb = await refresh_document(tg_client, 'image/png', pack.cover.image_data)
+			tg_pack = await tg_client(request)
 	except telethon.errors.ShortnameOccupyFailedError:
 		# handle a race condition occurring when the same pack is sent to us to convert to signal twice
+		tg_client.sticker_sets.invalidate(short_name=tg_short_name)
+		await record_telegram_pack(db, bytes.fromhex(pack.id), tg_short_name)
 		raise ValueError('This sticker pack has been converted before as ' + tg_pack_url(tg_short_name))
 
-	yield True, tg_pack_url(tg_pack.set.short_name)
+	tg_client.sticker_sets.put(tg_pack)
+	await record_telegram_pack(db, bytes.fromhex(pack.id), tg_pack.set.short_name)
+	return tg_pack_url(tg_pack.set.short_name)
+
+async def verify_telegram_packs(db, tg_client, *, interval=60, batch_size=10):
+	"""Forever check that the packs in telegram_packs still exist, forgetting the ones that have been deleted.
+
+	Checks batch_size packs every interval seconds.
+	"""
+	last_pack_id = b''
+	while True:
+		await anyio.sleep(interval)
+
+		rows = await db.fetchall(
+			"""
+			SELECT signal_pack_id, tg_short_name
+			FROM telegram_packs
+			WHERE signal_pack_id > ?
+			ORDER BY signal_pack_id
+			LIMIT ?
+			""",
+			last_pack_id, batch_size,
+		)
+		if not rows:
+			# start over from the beginning
+			last_pack_id = b''
+			continue
+
+		for signal_pack_id, tg_short_name in rows:
+			try:
+				await tg_client(tl.functions.messages.GetStickerSetRequest(
+					tl.types.InputStickerSetShortName(tg_short_name)
+				))
+			except telethon.errors.StickersetInvalidError:
+				logger.info('Telegram pack %s no longer exists; forgetting it', tg_short_name)
+				tg_client.sticker_sets.invalidate(short_name=tg_short_name)
+				await db.execute('DELETE FROM telegram_packs WHERE signal_pack_id = ?', signal_pack_id)
+			except Exception:
+				# we'll get to it next time around
+				logger.exception('Failed to verify Telegram pack %s', tg_short_name)
+
+		last_pack_id = rows[-1][0]
+
+async def signal_stickers_to_png(tg_client, stickers_client, pack):
+	"""Replace the image_data of each sticker in the pack (and of its cover, as a thumbnail) with a PNG.
+
+	Yield (sticker, thumbnail) for each sticker as soon as it's converted.
+	"""
+	cache = tg_client.blob_cache
+	transcoder = tg_client.transcoder
+	hits = []
+	# (sticker, thumbnail, cache key) for every sticker that wasn't already cached
+	misses = []
+
+	async def fetch(sticker, thumbnail=False):
+		# Signal packs are immutable, so the pack and sticker IDs identify the sticker's contents.
+		# the whole profile is part of the key so that changing its settings doesn't serve stale images
+		profile = transcoder.profiles[TELEGRAM_THUMBNAIL_PROFILE if thumbnail else TELEGRAM_STICKER_PROFILE]
+		cache_key = cache.key('signal', pack.id, sticker.id, profile)
+		sticker.image_data = await cache.get(cache_key)
+		if sticker.image_data is not None:
+			hits.append((sticker, thumbnail))
+			return
+
+		with timed('download'):
+			sticker.image_data = await tg_client.downloads.run(
+				pack, 'signal', stickers_client.download_sticker, sticker.id, pack.id, pack.key,
+			)
+		misses.append((sticker, thumbnail, cache_key))
+
+	async with anyio.create_task_group() as tg:
+		if pack.cover:
+			await tg.spawn(partial(fetch, pack.cover, thumbnail=True))
+		for sticker in pack.stickers:
+			await tg.spawn(fetch, sticker)
+
+	for hit in hits:
+		yield hit
+
+	# transcode in chunks rather than all at once so that the first uploads can start sooner.
+	# the caller spawns each upload rather than awaiting it, so the next chunk is transcoded while this one uploads,
+	# but none of a chunk is uploaded until all of it has been transcoded.
+	chunk_size = transcoder.workers * TRANSCODE_BATCH_SIZE
+	for i in range(0, len(misses), chunk_size):
+		chunk = misses[i:i + chunk_size]
+		with timed('transcode'):
+			pngs = await transcoder.transcode_batch([
+				(sticker.image_data, TELEGRAM_THUMBNAIL_PROFILE if thumbnail else TELEGRAM_STICKER_PROFILE)
+				for sticker, thumbnail, _ in chunk
+			])
+		for (sticker, thumbnail, cache_key), png in zip(chunk, pngs):
+			sticker.image_data = png
+			await cache.put(cache_key, png)
+			yield sticker, thumbnail
 
 async def convert_signal_sticker(tg_client, signal_sticker):
+	"""Upload a Signal sticker whose image_data has already been converted to PNG."""
 	return tl.types.InputStickerSetItem(
-		document=await upload_document(tg_client, 'image/png', await img_to_png(signal_sticker.image_data)),
+		document=await upload_document(tg_client, 'image/png', signal_sticker.image_data),
 		emoji=signal_sticker.emoji,
 	)
 
-async def upload_document(tg_client, mime_type: str, data: bytes):
-	media = await tg_client(tl.functions.messages.UploadMediaRequest('me', await tg_client.upload_file(data)))
+async def upload_document(tg_client, mime_type: str, data):
+	"""Upload an image as a document, unless one with the same contents has been uploaded already."""
+	return await tg_client.uploaded_documents.get_or_upload(
+		mime_type, data, partial(_upload_document_now, tg_client, data),
+	)
+
+async def refresh_document(tg_client, mime_type: str, data):
+	return await tg_client.uploaded_documents.refresh(
+		mime_type, data, partial(_upload_document_now, tg_client, data),
+	)
+
+async def _upload_document_now(tg_client, data):
+	with timed('upload'):
+		return await tg_client.uploads.run(_upload_document, tg_client, data)
+
+async def _upload_document(tg_client, data):
+	# Telethon only takes bytes or files
+	file = await tg_client.upload_file(BufferReader(data), file_size=len(data))
+	media = await tg_client(tl.functions.messages.UploadMediaRequest('me', file))
 	return telethon.utils.get_input_document(media)
 
+def log_cache_stats(cache):
+	logger.debug(
+		'Image cache: %d hits, %d misses, %s used',
+		cache.hits, cache.misses, humanize.naturalsize(cache.size, binary=True),
+	)
+
 def signal_pack_url(pack_id, pack_key):
 	if isinstance(pack_id, bytes): pack_id = pack_id.hex()
 	if isinstance(pack_key, bytes): pack_key = pack_key.hex()
@@ -275,21 +571,6 @@ def tg_pack_url(short_name):
 	domain = random.choices(('t.me', 'telegram.dog'), weights=(0.875, 0.125))[0]
 	return f'https://{domain}/addstickers/{short_name}'
 
-async def img_to_png(image_data: bytes, *, thumbnail=False) -> bytes:
-	return await anyio.run_sync_in_worker_thread(_img_to_png, image_data, thumbnail)
-
-def _img_to_png(image_data: bytes, thumbnail=False) -> bytes:
-	input = io.BytesIO(image_data)
-	input.seek(0)
-	im = PIL.Image.open(input)
-	if thumbnail:
-		# normally this would distort the image, but we assume that all stickers are square anyway
-		im = im.resize((100, 100))
-	out = io.BytesIO()
-	im.save(out, format='PNG')
-	del input
-	return out.getvalue()
-
 async def propose_to_signalstickers_dot_com(http, metadata: dict, *, token, signalstickers_baseurl):
 	r = await http.put(
 		f'{signalstickers_baseurl}/v1/contribute/',
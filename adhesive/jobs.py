@@ -0,0 +1,323 @@
+import json
+import time
+import secrets
+import logging
+
+import anyio
+from telethon.tl.tlobject import TLObject
+from telethon.extensions import BinaryReader
+
+from .glue import (
+	IN_PROGRESS,
+	convert_to_signal,
+	convert_to_telegram,
+	format_in_progress_message,
+	parse_link,
+)
+from . import metrics
+from .stickers_client import RateLimited
+
+logger = logging.getLogger(__name__)
+
+# job directions are named after the platform being converted to
+CONVERTERS = dict(signal=convert_to_signal, telegram=convert_to_telegram)
+DIRECTIONS = {converter: direction for direction, converter in CONVERTERS.items()}
+
+def dump_pack_info(pack_info) -> str:
+	# Telegram packs sent as stickers are identified by an InputStickerSet, so serialize those using TL
+	return json.dumps([
+		{'tl': bytes(x).hex()} if isinstance(x, TLObject) else x
+		for x in pack_info
+	])
+
+def load_pack_info(data: str) -> tuple:
+	return tuple(
+		BinaryReader(bytes.fromhex(x['tl'])).tgread_object() if isinstance(x, dict) else x
+		for x in json.loads(data)
+	)
+
+class JobScheduler:
+	"""Runs conversions in the background from a queue that's persisted in the jobs table.
+
+	Chat handlers call convert_*_interactive, which does the cheap checks (is this a valid pack?
+	was it converted already?) right away and queues the rest.
+	Results are sent back to the chat the request came from, using the deliver function registered for that platform.
+	Telegram→Signal jobs are only started when there's a Signal account with a token to spare.
+	"""
+
+	def __init__(self, db, tg_client, stickers_client, *, workers=2, poll_interval=60, error_backoff=5):
+		self.db = db
+		self.tg_client = tg_client
+		self.stickers_client = stickers_client
+		self.workers = workers
+		self.poll_interval = poll_interval
+		# seconds a worker waits after something went wrong outside of a conversion, e.g. the database was locked
+		self.error_backoff = error_backoff
+		# platform name -> async def deliver(chat: dict, is_link, response)
+		self.platforms = {}
+		self._wakeup = None
+		self._tg = None
+
+	@classmethod
+	def from_config(cls, config, db, tg_client, stickers_client):
+		jobs_config = config.get('jobs', {})
+		return cls(
+			db, tg_client, stickers_client,
+			workers=jobs_config.get('workers', 2),
+			poll_interval=jobs_config.get('poll_interval', 60),
+		)
+
+	def register_platform(self, name, deliver):
+		self.platforms[name] = deliver
+
+	async def convert_link_interactive(self, link, platform, chat):
+		try:
+			converter, pack_info = parse_link(link)
+		except ValueError:
+			yield False, 'Invalid sticker pack link provided. Run /start for help.'
+			return
+
+		async for is_link, message in self.convert_pack_interactive(converter, pack_info, platform, chat):
+			yield is_link, message
+
+	async def convert_pack_interactive(self, converter, pack_info, platform, chat):
+		"""Like glue.convert_pack_interactive, but queue the conversion itself instead of waiting on it."""
+		rate_limited_message = None
+		conversion = converter(self.db, self.tg_client, self.stickers_client, *pack_info)
+		try:
+			async for response in conversion:
+				if response is IN_PROGRESS:
+					break
+				yield response
+				return
+		except RateLimited as exc:
+			# it'll get converted once we have tokens again
+			rate_limited_message = exc.args[0]
+		except (ValueError, NotImplementedError) as exc:
+			yield False, exc.args[0]
+			return
+		finally:
+			await conversion.aclose()
+
+		job_id = await self.enqueue(converter, pack_info, platform, chat)
+		if rate_limited_message is None:
+			yield False, f'{format_in_progress_message(converter)} (job #{job_id})'
+		else:
+			yield False, (
+				f"{rate_limited_message}\n"
+				f"I've queued it for you as job #{job_id}. I'll send the pack here once it's done."
+			)
+
+	async def enqueue(self, converter, pack_info, platform, chat) -> int:
+		row = await self.db.fetchone(
+			"""
+			INSERT INTO jobs (direction, pack_info, platform, chat)
+			VALUES (?, ?, ?, ?)
+			RETURNING job_id
+			""",
+			DIRECTIONS[converter], dump_pack_info(pack_info), platform, json.dumps(chat),
+		)
+		await self._wake()
+		return row[0]
+
+	async def _wake(self):
+		if self._wakeup is not None:
+			await self._wakeup.set()
+			self._wakeup = anyio.create_event()
+
+	async def run(self):
+		# jobs that were running when we last stopped were interrupted
+		await self.db.execute("UPDATE jobs SET state = 'pending' WHERE state = 'running'")
+		self._wakeup = anyio.create_event()
+		async with anyio.create_task_group() as self._tg:
+			for _ in range(self.workers):
+				await self._tg.spawn(self._worker)
+
+	async def _worker(self):
+		while True:
+			try:
+				await self._work_once()
+			except Exception as exc:
+				# if we got as far as claiming a job, it stays 'running' until the next run() requeues it
+				ray_id = secrets.randbelow(2**64)
+				logger.error('Unhandled exception in job worker (%s)', ray_id, exc_info=exc)
+				metrics.record_handler_error('job_worker', ray_id)
+				await anyio.sleep(self.error_backoff)
+
+	async def _work_once(self):
+		# taken before claiming, so that a job enqueued while we're claiming still wakes us up
+		wakeup = self._wakeup
+		job = await self._claim()
+		if job is None:
+			timeout = min(self.poll_interval, self.stickers_client.get_min_wait_time() or self.poll_interval)
+			async with anyio.move_on_after(timeout):
+				await wakeup.wait()
+			return
+
+		await self._run_job(*job)
+
+	async def _claim(self):
+		directions = ['telegram']
+		if not self.stickers_client.get_min_wait_time():
+			directions.append('signal')
+
+		return await self.db.fetchone(
+			f"""
+			UPDATE jobs
+			SET state = 'running'
+			WHERE job_id = (
+				SELECT job_id
+				FROM jobs
+				WHERE state = 'pending' AND direction IN ({', '.join('?' * len(directions))})
+				ORDER BY job_id
+				LIMIT 1
+			)
+			RETURNING job_id, direction, pack_info, platform, chat
+			""",
+			*directions,
+		)
+
+	async def _run_job(self, job_id, direction, pack_info, platform, chat):
+		logger.debug('Running job %d (%s)', job_id, direction)
+		chat = json.loads(chat)
+		state = 'done'
+		try:
+			async for response in CONVERTERS[direction](
+				self.db, self.tg_client, self.stickers_client, *load_pack_info(pack_info),
+			):
+				if response is not IN_PROGRESS:
+					await self._deliver(platform, chat, *response)
+		except RateLimited:
+			# someone else got to the last token first, so put it back in the queue
+			logger.debug('Job %d rate limited; requeueing', job_id)
+			state = 'pending'
+		except (ValueError, NotImplementedError) as exc:
+			state = 'failed'
+			await self._deliver(platform, chat, False, exc.args[0])
+		except Exception as exc:
+			state = 'failed'
+			ray_id = secrets.randbelow(2**64)
+			await self._deliver(
+				platform, chat, False,
+				'An internal error occurred while trying to convert that pack. '
+				f'Hey if you see the owner, give them this code okay? {ray_id}',
+			)
+			logger.error('Unhandled exception in job %d (%s)', job_id, ray_id, exc_info=exc)
+			metrics.record_handler_error('job:' + direction, ray_id)
+
+		if state == 'done':
+			# nothing's left to do with it
+			await self.db.execute('DELETE FROM jobs WHERE job_id = ?', job_id)
+		else:
+			# failed jobs are kept around to be looked into, until adhesive.maintenance prunes them
+			await self.db.execute(
+				'UPDATE jobs SET state = ?, finished_at = ? WHERE job_id = ?',
+				state, int(time.time()) if state == 'failed' else None, job_id,
+			)
+
+	async def _deliver(self, platform, chat, is_link, response):
+		async def deliver():
+			try:
+				await self.platforms[platform](chat, is_link, response)
+			except Exception:
+				logger.exception('Failed to deliver %r to %s chat %r', response, platform, chat)
+
+		# delivering can take a while (e.g. the signalstickers.com propose flow), so don't hold up the worker
+		await self._tg.spawn(deliver)
+
+def test_job_scheduler(tmp_path):
+	import sqlite3
+	from functools import partial
+	from . import glue
+	from .database import Database
+	from .benchmark.fakes import FakeTelegramClient, FakeStickersClient
+	from .benchmark.fixtures import ImagePool, make_sticker_image
+
+	config = dict(
+		cache=dict(path=tmp_path / 'cache'),
+		staging=dict(path=tmp_path / 'staging'),
+		transcode=dict(executor='inline'),
+	)
+	tg_client = FakeTelegramClient(latency=0)
+	glue.attach_services(tg_client, config)
+	glue.start_services(tg_client)
+	stickers_client = FakeStickersClient(latency=0)
+	# PNG so that this doesn't need Pillow to have been built with WEBP support
+	images = ImagePool(partial(make_sticker_image, format='PNG'), size=3)
+	tg_client.add_sticker_set('jobs_test', images.take(2))
+	signal_pack = stickers_client.add_pack('Jobs test', images.take(2, offset=1))
+
+	# Signal is rate limited to begin with
+	wait_time = 60
+	stickers_client.get_min_wait_time = lambda amount=1: wait_time
+	upload_pack = stickers_client.upload_pack
+	uploads = 0
+
+	async def upload_pack_losing_the_race(pack, **kwargs):
+		nonlocal uploads
+		uploads += 1
+		if uploads == 1:
+			raise RateLimited('someone else took the last token')
+		return await upload_pack(pack, **kwargs)
+
+	stickers_client.upload_pack = upload_pack_losing_the_race
+
+	async def wait_for(condition):
+		async with anyio.fail_after(10):
+			while not condition():
+				await anyio.sleep(0.01)
+
+	async def main():
+		nonlocal wait_time
+		async with Database(tmp_path / 'db.sqlite3') as db:
+			await db.migrate()
+			tg_client.db = db
+
+			delivered = []
+			jobs = JobScheduler(db, tg_client, stickers_client, workers=1, poll_interval=0.05, error_backoff=0.01)
+
+			async def deliver(chat, is_link, response):
+				delivered.append((chat['id'], is_link))
+
+			jobs.register_platform('test', deliver)
+
+			# the first claim hits a transient database error, which the worker gets over
+			claim = jobs._claim
+			claims = 0
+
+			async def flaky_claim():
+				nonlocal claims
+				claims += 1
+				if claims == 1:
+					raise sqlite3.OperationalError('database is locked')
+				return await claim()
+
+			jobs._claim = flaky_claim
+
+			await jobs.enqueue(glue.convert_to_signal, ('jobs_test',), 'test', dict(id='signal'))
+			await jobs.enqueue(glue.convert_to_telegram, signal_pack, 'test', dict(id='telegram'))
+			async with anyio.create_task_group() as tg:
+				await tg.spawn(jobs.run)
+
+				# the Telegram job runs while the Signal one waits for a token
+				await wait_for(lambda: delivered)
+				assert delivered == [('telegram', True)]
+				assert [tuple(row) for row in await db.fetchall('SELECT direction, state FROM jobs')] == [
+					('signal', 'pending'),
+				]
+
+				# the first upload loses the race for the token, so the job goes back in the queue and runs again
+				wait_time = 0
+				await jobs._wake()
+				await wait_for(lambda: len(delivered) == 2)
+				assert delivered[1] == ('signal', True)
+				assert uploads == 2
+				# finished jobs are deleted
+				assert not await db.fetchall('SELECT 1 FROM jobs')
+
+				await tg.cancel_scope.cancel()
+
+	try:
+		anyio.run(main)
+	finally:
+		glue.shutdown_services(tg_client)
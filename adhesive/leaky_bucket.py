@@ -4,12 +4,25 @@ import time
 from collections import namedtuple
 from math import floor
 
+# rounding down x.999999… tokens as x would make reservations come due a moment too early
+EPSILON = 1e-9
+
 class LeakyBucketConfig(namedtuple('LeakyBucketConfig', 'bucket_size leak_rate_per_second')):
 	def new(self, **kwargs):
 		return LeakyBucket(*self, **kwargs)
 
 class LeakyBucket:
-	__slots__ = 'bucket_size', 'leak_rate_per_second', 'space_remaining', 'last_updated_at'
+	"""A mirror of one of Signal's server-side rate limit buckets.
+
+	The server only updates its bucket (rounding down the space remaining) when something is added to it,
+	so that's the only time this one is updated too. Everything else is computed from the last update,
+	so checking how much space there is, however often, never loses the fractional tokens that are leaking in.
+
+	Tokens can also be reserved ahead of time. Reservations are filled in the order they were made,
+	and reserved tokens can't be taken by add().
+	"""
+
+	__slots__ = 'bucket_size', 'leak_rate_per_second', 'space_remaining', 'last_updated_at', 'reservations'
 
 	def __init__(
 		self,
@@ -24,28 +37,55 @@ class LeakyBucket:
 		self.leak_rate_per_second = leak_rate_per_second
 		self.space_remaining = bucket_size if space_remaining is None else space_remaining
 		self.last_updated_at = _timer() if last_updated_at is None else last_updated_at
+		self.reservations = []
+
+	@property
+	def reserved(self) -> int:
+		return sum(reservation.amount for reservation in self.reservations)
+
+	def add(self, amount: int, now=None, *, _timer=time.time) -> bool:
+		return self._take(amount, self.reserved, _timer() if now is None else now)
 
-	def add(self, amount: int, now=None) -> bool:
-		self.update_space_remaining(now)
-		if (self.space_remaining >= amount):
+	def _take(self, amount, reserved, now):
+		# just like the server does
+		self.space_remaining = floor(self._space_at(now) + EPSILON)
+		self.last_updated_at = now
+		if self.space_remaining - reserved >= amount:
 			self.space_remaining -= amount
 			return True
 		return False
 
-	def update_space_remaining(self, now=None, *, _timer=time.time) -> int:
-		now = now or _timer()
-		elapsed = now - self.last_updated_at
-		self.last_updated_at = now
-		rv = min(self.bucket_size, floor(self.space_remaining + elapsed * self.leak_rate_per_second))
-		self.space_remaining = rv
-		return rv
+	def _space_at(self, now) -> float:
+		elapsed = max(0.0, now - self.last_updated_at)
+		return min(self.bucket_size, self.space_remaining + elapsed * self.leak_rate_per_second)
+
+	def _ready_at(self, total) -> float:
+		"""Return when the bucket will have a total amount of space."""
+		if total > self.bucket_size:
+			return float('inf')
+		return self.last_updated_at + max(0.0, total - self.space_remaining) / self.leak_rate_per_second
+
+	def get_space_remaining(self, now=None, *, _timer=time.time) -> int:
+		"""Return how many tokens add() could take right now."""
+		now = _timer() if now is None else now
+		return max(0, floor(self._space_at(now) + EPSILON) - self.reserved)
+
+	def get_ready_at(self, amount: int) -> float:
+		"""Return the time at which add(amount) will succeed, or inf if it never will."""
+		return self._ready_at(self.reserved + amount)
 
-	def get_wait_time(self, amount: int, now=None) -> float:
+	def get_wait_time(self, amount: int, now=None, *, _timer=time.time) -> float:
 		"""Return how long to wait until the given amount of tokens will be available."""
-		space_remaining = self.update_space_remaining(now=now)
-		if space_remaining >= amount:
-			return 0.0
-		return (amount - space_remaining) / self.leak_rate_per_second
+		now = _timer() if now is None else now
+		return max(0.0, self.get_ready_at(amount) - now)
+
+	def reserve(self, amount: int) -> 'Reservation':
+		"""Set aside amount tokens as soon as they'll be available, after any other reservations."""
+		if self.reserved + amount > self.bucket_size:
+			raise ValueError('the bucket will never have that much space')
+		reservation = Reservation(self, amount)
+		self.reservations.append(reservation)
+		return reservation
 
 	def __repr__(self):
 		return (
@@ -53,24 +93,77 @@ class LeakyBucket:
 			f'leak_rate_per_second={self.leak_rate_per_second}>'
 		)
 
+class Reservation:
+	"""Tokens set aside in a bucket, which can be taken from eta onwards."""
+
+	__slots__ = 'bucket', 'amount'
+
+	def __init__(self, bucket, amount):
+		self.bucket = bucket
+		self.amount = amount
+
+	@property
+	def active(self) -> bool:
+		return self in self.bucket.reservations
+
+	@property
+	def eta(self) -> float:
+		"""When the tokens will be available. This gets earlier if reservations ahead of this one are cancelled."""
+		ahead = 0
+		for reservation in self.bucket.reservations:
+			ahead += reservation.amount
+			if reservation is self:
+				return self.bucket._ready_at(ahead)
+		raise ValueError('reservation already redeemed or cancelled')
+
+	def get_wait_time(self, now=None, *, _timer=time.time) -> float:
+		now = _timer() if now is None else now
+		return max(0.0, self.eta - now)
+
+	def cancel(self):
+		"""Give the tokens back."""
+		if self.active:
+			self.bucket.reservations.remove(self)
+
+	def redeem(self, now=None, *, _timer=time.time) -> bool:
+		"""Take the reserved tokens from the bucket. Returns False if it's too early."""
+		now = _timer() if now is None else now
+		if now + EPSILON < self.eta:
+			return False
+		# the space is there for everyone ahead of us (whether or not they've redeemed yet) and us,
+		# so leave everyone else's alone
+		self.bucket.reservations.remove(self)
+		self.bucket._take(self.amount, 0, now)
+		return True
+
+	def __repr__(self):
+		return f'<{type(self).__qualname__} amount={self.amount} active={self.active}>'
+
+def reserve_earliest(buckets, amount: int) -> Reservation:
+	"""Reserve amount tokens from whichever bucket will have them first."""
+	bucket = min(buckets, key=lambda bucket: bucket.get_ready_at(amount))
+	return bucket.reserve(amount)
+
 # Port of org.whispersystems.textsecuregcm.tests.limits.LeackyBucketTest
 
 def test_full():
+	# polling doesn't round the space down anymore, so freeze time to keep the wait times exact
+	now = 1000.0
 	buck_conf = LeakyBucketConfig(2, 1.0 / 2.0)
 
-	buck = buck_conf.new()
+	buck = buck_conf.new(last_updated_at=now)
 
-	assert buck.add(1)
-	assert buck.get_wait_time(1) == 0.0
-	assert buck.add(1)
-	assert not buck.add(1)
-	assert buck.get_wait_time(1) == 2.0
+	assert buck.add(1, now=now)
+	assert buck.get_wait_time(1, now=now) == 0.0
+	assert buck.add(1, now=now)
+	assert not buck.add(1, now=now)
+	assert buck.get_wait_time(1, now=now) == 2.0
 
-	buck = buck_conf.new()
+	buck = buck_conf.new(last_updated_at=now)
 
-	assert buck.add(2)
-	assert not buck.add(1)
-	assert not buck.add(2)
+	assert buck.add(2, now=now)
+	assert not buck.add(1, now=now)
+	assert not buck.add(2, now=now)
 
 def test_lapse_rate():
 	buck = LeakyBucket(
@@ -87,3 +180,57 @@ def test_lapse_rate():
 	assert not buck.add(1)
 	time.sleep(1/2)
 	assert buck.add(2)
+
+# Tests for what we've added to the port
+
+def test_polling_keeps_fractional_tokens():
+	buck = LeakyBucket(bucket_size=1, leak_rate_per_second=1 / 3, space_remaining=0, last_updated_at=1000.0)
+	for now in (1001.0, 1002.0):
+		assert buck.get_space_remaining(now=now) == 0
+		assert buck.get_wait_time(1, now=now) == 1003.0 - now
+	assert buck.add(1, now=1003.0)
+
+def test_reservations():
+	buck = LeakyBucket(bucket_size=3, leak_rate_per_second=1.0, space_remaining=1, last_updated_at=1000.0)
+
+	first = buck.reserve(1)
+	assert first.eta == 1000.0
+	second = buck.reserve(2)
+	assert second.eta == 1002.0
+	# reserved tokens are off limits to everyone else
+	assert not buck.add(1, now=1000.0)
+	assert buck.get_wait_time(1, now=1000.0) == float('inf')
+	assert buck.get_space_remaining(now=1000.0) == 0
+
+	assert first.redeem(now=1000.0)
+	assert not second.redeem(now=1001.0)
+	assert second.get_wait_time(now=1001.0) == 1.0
+	assert second.redeem(now=1002.0)
+	assert buck.reserved == 0
+
+	third = buck.reserve(1)
+	fourth = buck.reserve(1)
+	assert (third.eta, fourth.eta) == (1003.0, 1004.0)
+	third.cancel()
+	third.cancel()
+	assert not third.active
+	assert fourth.eta == 1003.0
+	assert buck.reserved == 1
+
+	try:
+		buck.reserve(3)
+	except ValueError:
+		pass
+	else:
+		assert False, 'reserving more than the bucket can ever hold should fail'
+
+def test_reserve_earliest():
+	buckets = [
+		LeakyBucket(bucket_size=5, leak_rate_per_second=1.0, space_remaining=0, last_updated_at=1000.0),
+		LeakyBucket(bucket_size=5, leak_rate_per_second=0.5, space_remaining=1, last_updated_at=1000.0),
+	]
+	assert reserve_earliest(buckets, 1).bucket is buckets[1]
+	# the second bucket's token is taken now, so the first one refills sooner
+	reservation = reserve_earliest(buckets, 1)
+	assert reservation.bucket is buckets[0]
+	assert reservation.eta == 1001.0
@@ -0,0 +1,260 @@
+import time
+import shlex
+import logging
+
+import anyio
+
+from .utils import chunked
+
+logger = logging.getLogger(__name__)
+
+class Maintenance:
+	"""Keeps the database and the on-disk caches from growing forever.
+
+	Every interval seconds, runs each task in turn until time_budget seconds have passed. Tasks work in small batches
+	so that they never hold the database for long, and pick up where they left off next time if they run out of time.
+	Each cycle starts from the next task along, so that a big backlog in one doesn't starve the rest.
+	"""
+
+	def __init__(
+		self,
+		db,
+		tg_client,
+		stickers_client,
+		*,
+		interval=60 * 60,
+		time_budget=5.0,
+		pack_max_age=0,
+		finished_max_age=7 * 24 * 60 * 60,
+		batch_size=100,
+		vacuum_pages=256,
+		_timer=time.monotonic,
+	):
+		self.db = db
+		self.tg_client = tg_client
+		self.stickers_client = stickers_client
+		self.interval = interval
+		self.time_budget = time_budget
+		# seconds after which converted packs are forgotten. 0 to keep them forever
+		self.pack_max_age = pack_max_age
+		# seconds after which failed jobs and finished batch links are pruned
+		self.finished_max_age = finished_max_age
+		self.batch_size = batch_size
+		self.vacuum_pages = vacuum_pages
+		self._timer = _timer
+		self._deadline = 0
+		self._cycle = 0
+		self._warned_about_auto_vacuum = False
+		self.tasks = [
+			self.expire_packs,
+			self.prune_finished,
+			self.prune_signal_accounts,
+			self.collect_staging_garbage,
+			self.enforce_cache_limits,
+			self.incremental_vacuum,
+		]
+
+	@classmethod
+	def from_config(cls, config, db, tg_client, stickers_client):
+		maintenance_config = config.get('maintenance', {})
+		return cls(
+			db,
+			tg_client,
+			stickers_client,
+			interval=maintenance_config.get('interval', 60 * 60),
+			time_budget=maintenance_config.get('time_budget', 5.0),
+			pack_max_age=maintenance_config.get('pack_max_age', 0),
+			finished_max_age=maintenance_config.get('finished_max_age', 7 * 24 * 60 * 60),
+			batch_size=maintenance_config.get('batch_size', 100),
+		)
+
+	def _out_of_time(self) -> bool:
+		return self._timer() >= self._deadline
+
+	async def run(self):
+		while True:
+			await anyio.sleep(self.interval)
+			await self.run_once()
+
+	async def run_once(self):
+		self._deadline = self._timer() + self.time_budget
+		start = self._cycle % len(self.tasks)
+		self._cycle += 1
+		for task in self.tasks[start:] + self.tasks[:start]:
+			if self._out_of_time():
+				logger.debug('Maintenance ran out of time before %s', task.__name__)
+				break
+			try:
+				await task()
+			except Exception:
+				logger.exception('Maintenance task %s failed', task.__name__)
+
+	async def _delete_in_batches(self, sql, *params) -> int:
+		"""Run a DELETE … LIMIT ? RETURNING statement until it deletes less than a batch, or time runs out."""
+		total = 0
+		while not self._out_of_time():
+			rows = await self.db.fetchall(sql, *params, self.batch_size)
+			total += len(rows)
+			if len(rows) < self.batch_size:
+				break
+			# let everyone else's queries in between batches
+			await anyio.sleep(0)
+		return total
+
+	async def expire_packs(self):
+		if not self.pack_max_age:
+			return
+		cutoff = int(time.time() - self.pack_max_age)
+		# the subquery walks old_pack_idx, so each batch only touches the rows it deletes
+		total = await self._delete_in_batches(
+			"""
+			DELETE FROM packs
+			WHERE tg_hash IN (
+				SELECT tg_hash
+				FROM packs
+				WHERE converted_at < ?
+				ORDER BY converted_at
+				LIMIT ?
+			)
+			RETURNING tg_hash
+			""",
+			cutoff,
+		)
+		if total:
+			logger.info('Forgot %d packs converted before %d', total, cutoff)
+
+	async def prune_finished(self):
+		"""Delete failed jobs and finished batch links once they're finished_max_age old."""
+		cutoff = int(time.time() - self.finished_max_age)
+		jobs = await self._delete_in_batches(
+			"""
+			DELETE FROM jobs
+			WHERE job_id IN (
+				SELECT job_id
+				FROM jobs
+				WHERE finished_at < ?
+				ORDER BY finished_at
+				LIMIT ?
+			)
+			RETURNING job_id
+			""",
+			cutoff,
+		)
+		batch_items = await self._delete_in_batches(
+			"""
+			DELETE FROM batch_items
+			WHERE rowid IN (
+				SELECT rowid
+				FROM batch_items
+				WHERE finished_at < ?
+				ORDER BY finished_at
+				LIMIT ?
+			)
+			RETURNING rowid
+			""",
+			cutoff,
+		)
+		if jobs or batch_items:
+			logger.info('Pruned %d failed jobs and %d finished batch links', jobs, batch_items)
+
+	async def prune_signal_accounts(self):
+		configured = {account.username for account in self.stickers_client.accounts}
+		rows = await self.db.fetchall('SELECT account_id FROM signal_accounts')
+		orphans = [account_id for [account_id] in rows if account_id not in configured]
+		for chunk in chunked(orphans, self.batch_size):
+			if self._out_of_time():
+				break
+			await self.db.execute(
+				'DELETE FROM signal_accounts WHERE account_id IN (' + ', '.join(['?'] * len(chunk)) + ')',
+				*chunk,
+			)
+		if orphans:
+			logger.info('Forgot the rate limits of %d Signal accounts that are no longer configured', len(orphans))
+
+	async def collect_staging_garbage(self):
+		"""Remove staged packs and saved upload progress that were given up on."""
+		staging = self.tg_client.staging
+		packs = await staging.collect_garbage()
+		uploads = await self.stickers_client.forget_stale_uploads(staging.max_age)
+		if packs or uploads:
+			logger.info('Removed %d stale staged packs and %d stale uploads', packs, uploads)
+
+	async def enforce_cache_limits(self):
+		for cache in self.tg_client.blob_cache, self.stickers_client.blob_cache:
+			if cache is not None:
+				await cache.enforce_limit()
+
+	async def incremental_vacuum(self):
+		[auto_vacuum] = await self.db.fetchone('PRAGMA auto_vacuum')
+		# 2 is incremental
+		if auto_vacuum != 2:
+			if not self._warned_about_auto_vacuum:
+				self._warned_about_auto_vacuum = True
+				logger.info(
+					'The database was created without incremental auto-vacuum, so its free space is never reclaimed. '
+					"To fix that, stop the bot and run: sqlite3 %s 'PRAGMA auto_vacuum = INCREMENTAL; VACUUM;'",
+					shlex.quote(self.db.path),
+				)
+			return
+
+		freed = 0
+		while not self._out_of_time():
+			[free_pages] = await self.db.fetchone('PRAGMA freelist_count')
+			if not free_pages:
+				break
+			# this frees a page per step, so it has to be stepped through to the end with fetchall
+			await self.db.fetchall(f'PRAGMA incremental_vacuum({int(self.vacuum_pages)})')
+			freed += min(free_pages, self.vacuum_pages)
+			await anyio.sleep(0)
+		if freed:
+			logger.debug('Reclaimed %d free database pages', freed)
+
+def test_maintenance(tmp_path):
+	from types import SimpleNamespace
+	from .database import Database
+
+	now = int(time.time())
+	stickers_client = SimpleNamespace(accounts=[SimpleNamespace(username='kept')], blob_cache=None)
+
+	async def main():
+		async with Database(tmp_path / 'db.sqlite3') as db:
+			await db.migrate()
+			for tg_hash, age in enumerate((10, 100, 200, 300, 400)):
+				await db.execute(
+					'INSERT INTO packs (tg_hash, signal_pack_id, signal_pack_key, converted_at) VALUES (?, ?, ?, ?)',
+					tg_hash, b'id', b'key', now - age,
+				)
+			for account_id in 'kept', 'gone-1', 'gone-2':
+				await db.execute('INSERT INTO signal_accounts VALUES (?, 1, 0)', account_id)
+			for job_id, finished_at in (1, None), (2, now - 10), (3, now - 1000):
+				await db.execute(
+					"""
+					INSERT INTO jobs (job_id, direction, pack_info, platform, chat, state, finished_at)
+					VALUES (?, 'signal', '[]', 'telegram', '{}', 'failed', ?)
+					""",
+					job_id, finished_at,
+				)
+			for link, finished_at in ('a', None), ('b', now - 1000), ('c', now - 1000):
+				await db.execute(
+					"INSERT INTO batch_items (run, link, position, finished_at) VALUES ('run', ?, 0, ?)", link, finished_at,
+				)
+
+			maintenance = Maintenance(
+				db, None, stickers_client, time_budget=60, pack_max_age=150, finished_max_age=100, batch_size=2,
+			)
+			maintenance._deadline = maintenance._timer() + maintenance.time_budget
+			await maintenance.expire_packs()
+			await maintenance.prune_signal_accounts()
+			await maintenance.prune_finished()
+			# the batches were 2 then 1
+			assert [tuple(row) for row in await db.fetchall('SELECT tg_hash FROM packs ORDER BY tg_hash')] == [(0,), (1,)]
+			assert [tuple(row) for row in await db.fetchall('SELECT account_id FROM signal_accounts')] == [('kept',)]
+			assert [tuple(row) for row in await db.fetchall('SELECT job_id FROM jobs ORDER BY job_id')] == [(1,), (2,)]
+			assert [tuple(row) for row in await db.fetchall('SELECT link FROM batch_items')] == [('a',)]
+
+			# new databases are created with incremental auto-vacuum
+			await maintenance.incremental_vacuum()
+			assert tuple(await db.fetchone('PRAGMA auto_vacuum')) == (2,)
+			assert not maintenance._warned_about_auto_vacuum
+
+	anyio.run(main)
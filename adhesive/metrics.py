@@ -0,0 +1,353 @@
+import time
+import inspect
+import logging
+from bisect import bisect_left
+
+import anyio
+
+logger = logging.getLogger(__name__)
+
+# all metrics in the order they're exported
+REGISTRY = []
+
+def register(metric):
+	REGISTRY.append(metric)
+	return metric
+
+def _escape(value):
+	return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def _format_sample(name, label_names, label_values, value):
+	if label_names:
+		labels = ','.join(f'{k}="{_escape(v)}"' for k, v in zip(label_names, label_values))
+		return f'{name}{{{labels}}} {value!r}'
+	return f'{name} {value!r}'
+
+class Metric:
+	"""A metric with zero or more labels.
+
+	Values are either set by the code being measured, or, if callback is given, computed when scraped.
+	callback can be sync or async, and must return a dict of label value tuples to values.
+	"""
+
+	type = 'untyped'
+
+	def __init__(self, name, help, labels=(), *, callback=None):
+		self.name = name
+		self.help = help
+		self.labels = tuple(labels)
+		self.callback = callback
+		self.values = {}
+
+	def _key(self, labels):
+		return tuple(labels[name] for name in self.labels)
+
+	async def _collect(self):
+		if self.callback is None:
+			return self.values
+		values = self.callback()
+		if inspect.isawaitable(values):
+			values = await values
+		return values
+
+	async def render(self):
+		lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+		for label_values, value in (await self._collect()).items():
+			lines.append(_format_sample(self.name, self.labels, label_values, value))
+		return lines
+
+class Counter(Metric):
+	type = 'counter'
+
+	def inc(self, amount=1, **labels):
+		key = self._key(labels)
+		self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+	type = 'gauge'
+
+	def set(self, value, **labels):
+		self.values[self._key(labels)] = value
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+class Histogram(Metric):
+	type = 'histogram'
+
+	def __init__(self, name, help, labels=(), *, buckets=DEFAULT_BUCKETS):
+		super().__init__(name, help, labels)
+		self.buckets = buckets
+
+	def observe(self, value, **labels):
+		key = self._key(labels)
+		try:
+			counts, total = self.values[key]
+		except KeyError:
+			counts, total = [0] * len(self.buckets), 0.0
+		# counts are not cumulative until they're rendered
+		counts[bisect_left(self.buckets, value)] += 1
+		self.values[key] = counts, total + value
+
+	async def render(self):
+		lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+		label_names = self.labels + ('le',)
+		for label_values, (counts, total) in self.values.items():
+			cumulative = 0
+			for bucket, count in zip(self.buckets, counts):
+				cumulative += count
+				le = '+Inf' if bucket == float('inf') else repr(bucket)
+				lines.append(_format_sample(self.name + '_bucket', label_names, label_values + (le,), cumulative))
+			lines.append(_format_sample(self.name + '_sum', self.labels, label_values, total))
+			lines.append(_format_sample(self.name + '_count', self.labels, label_values, cumulative))
+		return lines
+
+STAGE_SECONDS = register(Histogram(
+	'adhesive_stage_seconds',
+	'How long each step of a conversion took.',
+	('stage',),
+))
+HANDLER_ERRORS = register(Counter(
+	'adhesive_handler_errors_total',
+	'Unhandled exceptions raised by chat handlers and jobs.',
+	('handler',),
+))
+LAST_HANDLER_ERROR = register(Gauge(
+	'adhesive_handler_last_error_timestamp_seconds',
+	'When each handler last raised an unhandled exception, labeled with the ray ID that was logged for it.',
+	('handler', 'ray_id'),
+))
+
+def record_handler_error(handler, ray_id):
+	HANDLER_ERRORS.inc(handler=handler)
+	# only keep the latest ray ID for each handler so that this doesn't grow forever
+	for key in [key for key in LAST_HANDLER_ERROR.values if key[0] == handler]:
+		del LAST_HANDLER_ERROR.values[key]
+	LAST_HANDLER_ERROR.set(time.time(), handler=handler, ray_id=ray_id)
+
+def register_runtime_metrics(db, tg_client, stickers_client):
+	"""Register the metrics that are computed from the bot's state when scraped."""
+	from . import glue
+
+	glue.STAGE_OBSERVERS.append(lambda stage, elapsed: STAGE_SECONDS.observe(elapsed, stage=stage))
+
+	register(Gauge(
+		'adhesive_conversions_in_flight',
+		'Conversions currently running, not counting requests waiting on them.',
+		('direction',),
+		callback=lambda: {
+			('signal',): len(glue.SIGNAL_CONVERSIONS),
+			('telegram',): len(glue.TELEGRAM_CONVERSIONS),
+		},
+	))
+
+	async def job_states():
+		rows = await db.fetchall('SELECT state, count(*) FROM jobs GROUP BY state')
+		return {(state,): count for state, count in rows}
+
+	register(Gauge('adhesive_jobs', 'Queued conversions by state.', ('state',), callback=job_states))
+
+	register(Gauge(
+		'adhesive_apng_renders_waiting',
+		'Animated stickers waiting for THREAD_LIMITER before they can be rendered.',
+		callback=lambda: {(): glue.THREAD_LIMITER_WAITING},
+	))
+
+	def account_metric(f):
+		def callback():
+			now = time.time()
+			return {(account.username,): f(account.bucket, now) for account in stickers_client.accounts}
+		return callback
+
+	register(Gauge(
+		'adhesive_signal_account_space_remaining',
+		'Pack creation tokens each Signal account has left.',
+		('account',),
+		callback=account_metric(lambda bucket, now: bucket.get_space_remaining(now)),
+	))
+	register(Gauge(
+		'adhesive_signal_account_wait_seconds',
+		'How long until each Signal account can create another pack.',
+		('account',),
+		callback=account_metric(lambda bucket, now: bucket.get_wait_time(1, now=now)),
+	))
+
+	register(Gauge(
+		'adhesive_signal_capacity',
+		'Pack creation tokens across all Signal accounts, as of when each account was last used.',
+		callback=lambda: {(): stickers_client.scheduler.capacity},
+	))
+
+	cache = tg_client.blob_cache
+	register(Counter('adhesive_cache_hits_total', 'Image cache hits.', callback=lambda: {(): cache.hits}))
+	register(Counter('adhesive_cache_misses_total', 'Image cache misses.', callback=lambda: {(): cache.misses}))
+	register(Gauge('adhesive_cache_hit_ratio', 'Image cache hit ratio.', callback=lambda: {(): cache.hit_ratio}))
+	register(Gauge('adhesive_cache_size_bytes', 'Size of the image cache.', callback=lambda: {(): cache.size}))
+
+	admission = tg_client.admission
+	register(Gauge(
+		'adhesive_memory_budget_bytes', 'How much memory conversions may use at once.',
+		callback=lambda: {(): admission.budget},
+	))
+	register(Gauge(
+		'adhesive_memory_reserved_bytes', 'Memory reserved by running conversions, going by their estimates.',
+		callback=lambda: {(): admission.reserved},
+	))
+	register(Gauge(
+		'adhesive_memory_actual_bytes', 'Memory held in images by running conversions that have finished downloading.',
+		callback=lambda: {(): admission.actual},
+	))
+	register(Gauge(
+		'adhesive_memory_waiting_conversions', 'Conversions waiting for memory budget.',
+		callback=lambda: {(): admission.waiting},
+	))
+	register(Counter(
+		'adhesive_memory_estimated_bytes_total', 'Sum of the memory estimates of finished conversions.',
+		callback=lambda: {(): admission.estimated_total},
+	))
+	register(Counter(
+		'adhesive_memory_used_bytes_total', 'Sum of the memory actually held in images by finished conversions.',
+		callback=lambda: {(): admission.actual_total},
+	))
+
+	sticker_sets = tg_client.sticker_sets
+	register(Counter(
+		'adhesive_sticker_set_cache_hits_total', 'Telegram sticker set cache hits.',
+		callback=lambda: {(): sticker_sets.hits},
+	))
+	register(Counter(
+		'adhesive_sticker_set_cache_misses_total', 'Telegram sticker set cache misses.',
+		callback=lambda: {(): sticker_sets.misses},
+	))
+
+	transcode_stats = tg_client.transcoder.stats
+	register(Counter(
+		'adhesive_transcode_seconds_total', 'Time spent transcoding images, by transcode profile.', ('profile',),
+		callback=lambda: {(name,): stats.seconds for name, stats in transcode_stats.items()},
+	))
+	register(Counter(
+		'adhesive_transcodes_total', 'Images transcoded, by transcode profile.', ('profile',),
+		callback=lambda: {(name,): stats.images for name, stats in transcode_stats.items()},
+	))
+	register(Counter(
+		'adhesive_transcode_encodes_total',
+		'Encodes it took to get images under their size limit, by transcode profile.', ('profile',),
+		callback=lambda: {(name,): stats.attempts for name, stats in transcode_stats.items()},
+	))
+
+	uploaded_documents = tg_client.uploaded_documents
+	register(Counter(
+		'adhesive_document_uploads_deduplicated_total', 'Telegram document uploads skipped because the contents were uploaded before.',
+		callback=lambda: {(): uploaded_documents.hits},
+	))
+	register(Counter(
+		'adhesive_document_uploads_total', 'Telegram documents uploaded.',
+		callback=lambda: {(): uploaded_documents.misses},
+	))
+
+async def render():
+	lines = []
+	for metric in REGISTRY:
+		lines.extend(await metric.render())
+	return '\n'.join(lines) + '\n'
+
+async def _handle(client):
+	async with client:
+		try:
+			request = b''
+			while b'\r\n\r\n' not in request and len(request) < 8192:
+				request += await client.receive()
+
+			method, path, *_ = request.split(b'\r\n', 1)[0].split() + [b'', b'']
+			if method == b'GET' and path.partition(b'?')[0] in (b'/', b'/metrics'):
+				status, body = b'200 OK', (await render()).encode()
+			else:
+				status, body = b'404 Not Found', b'Not Found\n'
+
+			await client.send(
+				b'HTTP/1.1 ' + status + b'\r\n'
+				b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+				b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+				b'Connection: close\r\n'
+				b'\r\n' + body
+			)
+		except (anyio.EndOfStream, anyio.BrokenResourceError):
+			# the client hung up before we were done with it, e.g. a health check that only opens a connection
+			return
+		except Exception:
+			logger.exception('Error serving metrics')
+
+async def serve(config):
+	"""Serve the metrics in Prometheus text format over HTTP, forever."""
+	metrics_config = config['metrics']
+	listener = await anyio.create_tcp_listener(
+		local_host=metrics_config.get('host', '127.0.0.1'),
+		local_port=metrics_config.get('port', 9877),
+	)
+	logger.info('Serving metrics on %s:%s', metrics_config.get('host', '127.0.0.1'), metrics_config.get('port', 9877))
+	await listener.serve(_handle)
+
+class _FakeStream:
+	def __init__(self, *chunks, hang_up_on_send=False):
+		self.chunks = list(chunks)
+		self.hang_up_on_send = hang_up_on_send
+		self.sent = b''
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, *excinfo):
+		pass
+
+	async def receive(self):
+		if not self.chunks:
+			raise anyio.EndOfStream
+		return self.chunks.pop(0)
+
+	async def send(self, data):
+		if self.hang_up_on_send:
+			raise anyio.BrokenResourceError
+		self.sent += data
+
+def test_render(caplog):
+	from functools import partial
+
+	histogram = Histogram('test_seconds', 'How long.', ('stage',), buckets=(1, 5, float('inf')))
+	for value in 0.5, 3, 3, 10:
+		histogram.observe(value, stage='a "b"\\c\nd')
+	counter = Counter('test_total', 'How many.')
+	counter.inc(2)
+
+	saved = REGISTRY[:]
+	REGISTRY[:] = [histogram, counter]
+	try:
+		assert anyio.run(render) == '\n'.join([
+			'# HELP test_seconds How long.',
+			'# TYPE test_seconds histogram',
+			# buckets are cumulative
+			'test_seconds_bucket{stage="a \\"b\\"\\\\c\\nd",le="1"} 1',
+			'test_seconds_bucket{stage="a \\"b\\"\\\\c\\nd",le="5"} 3',
+			'test_seconds_bucket{stage="a \\"b\\"\\\\c\\nd",le="+Inf"} 4',
+			'test_seconds_sum{stage="a \\"b\\"\\\\c\\nd"} 16.5',
+			'test_seconds_count{stage="a \\"b\\"\\\\c\\nd"} 4',
+			'# HELP test_total How many.',
+			'# TYPE test_total counter',
+			'test_total 2',
+		]) + '\n'
+
+		async def get(path, **kwargs):
+			# split across reads like a real request can be
+			client = _FakeStream(b'GET ' + path + b' HTTP/1.1\r\n', b'Host: localhost\r\n\r\n', **kwargs)
+			await _handle(client)
+			return client.sent
+
+		response = anyio.run(get, b'/metrics?x=1')
+		assert response.startswith(b'HTTP/1.1 200 OK\r\n')
+		assert response.endswith(b'\r\n\r\n' + anyio.run(render).encode())
+		assert anyio.run(get, b'/nope').startswith(b'HTTP/1.1 404 Not Found\r\n')
+
+		# clients hanging up early aren't errors
+		anyio.run(_handle, _FakeStream())
+		anyio.run(partial(get, b'/metrics', hang_up_on_send=True))
+		assert not caplog.records
+	finally:
+		REGISTRY[:] = saved
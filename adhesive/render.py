@@ -0,0 +1,231 @@
+import os
+import math
+import json
+import logging
+import multiprocessing
+import concurrent.futures
+
+import anyio
+
+from .apng import APNGWriter, FrameMerger, DEFAULT_COMPRESS_LEVEL, scaled_size
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MEMORY_LIMIT = 512 * 1024 ** 2
+# Signal's limit for animated stickers
+DEFAULT_MAX_SIZE = 300 * 1024
+
+# ways to make an animation smaller if it won't fit in max_size: keeping every nth frame (each shown n times
+# as long), and scaling it down. tried in this order, so frame rate goes before resolution does.
+FRAME_STEPS = 1, 2, 3
+SCALES = 1, 0.75, 0.5
+# how many places in an animation to measure frame sizes at
+SAMPLE_POINTS = 4
+# aim a bit under max_size, since the prediction is only a prediction
+SIZE_MARGIN = 0.9
+# fcTL + fdAT chunk overhead per frame
+FRAME_OVERHEAD = 38 + 16
+
+def plan_output(full_sizes, delta_sizes, num_frames, max_size):
+	"""Pick the (frame step, scale) that keeps the most detail while being predicted to fit in max_size bytes.
+
+	full_sizes and delta_sizes are as returned by apng.sample_frame_sizes.
+	"""
+	full = sum(full_sizes) / len(full_sizes)
+	for scale in SCALES:
+		for step in FRAME_STEPS:
+			frames = math.ceil(num_frames / step)
+			deltas = delta_sizes.get(step)
+			# the animation's too short to have sampled this step, so assume the worst
+			delta = sum(deltas) / len(deltas) if deltas else full
+			# a frame's compressed size goes roughly with its area
+			predicted = (full + (frames - 1) * delta) * scale ** 2 + frames * FRAME_OVERHEAD
+			if predicted <= max_size * SIZE_MARGIN:
+				return step, scale
+	# do the best we can
+	return FRAME_STEPS[-1], SCALES[-1]
+
+def _limit_memory(limit):
+	try:
+		import resource
+	except ImportError:
+		# not available on Windows
+		return
+	# not RLIMIT_AS, which counts every page the process has mapped, touched or not (thread stacks, malloc arenas,
+	# shared libraries). RLIMIT_DATA only counts the heap and private mappings, which is where frames end up.
+	resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+
+def _render_frames(*args):
+	# imported here so that the main process doesn't have to load lottie or cairo
+	from .apng import render_frames
+	return render_frames(*args)
+
+def _sample_frame_sizes(*args):
+	from .apng import sample_frame_sizes
+	return sample_frame_sizes(*args)
+
+class RenderEngine:
+	"""Renders animated stickers to APNG using a pool of worker processes.
+
+	Each animation is split into ranges of frames_per_job frames which are rendered in parallel.
+	Frames are cropped to what changed since the frame before, and identical frames are merged.
+	If a sample of frames predicts that the result would be more than max_size bytes (0 for no limit),
+	frames are dropped or the resolution lowered before rendering the rest.
+	Workers run under a data size limit of memory_limit bytes so that a runaway render raises MemoryError
+	in that worker instead of getting the whole bot OOM-killed. They're spawned rather than forked,
+	so that they start from a fresh interpreter instead of a copy of everything the bot has in memory.
+	Each worker is replaced after max_jobs_per_worker jobs to return leaked or fragmented memory.
+	"""
+
+	def __init__(
+		self,
+		workers=None,
+		*,
+		memory_limit=DEFAULT_MEMORY_LIMIT,
+		max_jobs_per_worker=50,
+		frames_per_job=30,
+		compress_level=DEFAULT_COMPRESS_LEVEL,
+		max_size=DEFAULT_MAX_SIZE,
+	):
+		self.workers = workers or os.cpu_count() or 1
+		self.memory_limit = memory_limit
+		self.max_jobs_per_worker = max_jobs_per_worker
+		self.frames_per_job = frames_per_job
+		self.compress_level = compress_level
+		self.max_size = max_size
+		self._pool = None
+
+	@classmethod
+	def from_config(cls, config):
+		render_config = config.get('render', {})
+		return cls(
+			render_config.get('workers'),
+			memory_limit=render_config.get('memory_limit', DEFAULT_MEMORY_LIMIT),
+			max_jobs_per_worker=render_config.get('max_jobs_per_worker', 50),
+			frames_per_job=render_config.get('frames_per_job', 30),
+			compress_level=render_config.get('compress_level', DEFAULT_COMPRESS_LEVEL),
+			max_size=render_config.get('max_size', DEFAULT_MAX_SIZE),
+		)
+
+	def _get_pool(self):
+		if self._pool is None:
+			self._pool = concurrent.futures.ProcessPoolExecutor(
+				self.workers,
+				mp_context=multiprocessing.get_context('spawn'),
+				initializer=_limit_memory if self.memory_limit else None,
+				initargs=(self.memory_limit,) if self.memory_limit else (),
+				max_tasks_per_child=self.max_jobs_per_worker or None,
+			)
+		return self._pool
+
+	def _submit(self, f, *args):
+		return self._get_pool().submit(f, *args)
+
+	async def _plan(self, lottie_json, start, end):
+		# leave room after the last point for the frames that are compared to it
+		span = max(0, end - FRAME_STEPS[-1] - start)
+		points = sorted({start + span * i // (SAMPLE_POINTS - 1) for i in range(SAMPLE_POINTS)})
+		future = self._submit(_sample_frame_sizes, lottie_json, points, FRAME_STEPS, self.compress_level)
+		try:
+			full_sizes, delta_sizes = await anyio.run_sync_in_worker_thread(future.result)
+		finally:
+			future.cancel()
+		return plan_output(full_sizes, delta_sizes, end + 1 - start, self.max_size)
+
+	async def render(self, lottie_json: bytes, fp):
+		"""Render an animation given as Lottie JSON to fp as an APNG."""
+		meta = json.loads(lottie_json)
+		start, end = int(meta['ip']), int(meta['op'])
+		width, height = int(meta['w']), int(meta['h'])
+		frame_rate = meta['fr']
+		del meta
+
+		step, scale = (1, 1) if not self.max_size else await self._plan(lottie_json, start, end)
+		if (step, scale) != (1, 1):
+			logger.debug('Rendering every %d frames at %d%% scale to fit in %d bytes', step, scale * 100, self.max_size)
+		frames = range(start, end + 1, step)
+		delay = 1000 * step / frame_rate
+
+		# workers send back frames that are already compressed and cropped, which are written out as they arrive.
+		# each one also renders the frame before its range so that it can crop the first one.
+		futures = [
+			self._submit(
+				_render_frames,
+				lottie_json,
+				frames[i:i + self.frames_per_job],
+				frames[i - 1] if i else None,
+				scale,
+				self.compress_level,
+			)
+			for i in range(0, len(frames), self.frames_per_job)
+		]
+		merger = FrameMerger(APNGWriter(fp, *scaled_size(width, height, scale)))
+		try:
+			# collect frames in order as they're done so that we only hold on to the ranges that are ahead
+			for future in futures:
+				for frame in await anyio.run_sync_in_worker_thread(future.result):
+					merger.add(frame, delay)
+		finally:
+			for future in futures:
+				future.cancel()
+
+		merger.close()
+
+	def shutdown(self):
+		if self._pool is not None:
+			self._pool.shutdown(wait=False)
+			self._pool = None
+
+def test_plan_output():
+	# 100 frames: 20 KB for the first, then 2 KB, 3 KB or 4 KB per frame at steps of 1, 2 or 3
+	full_sizes = [20_000]
+	delta_sizes = {1: [2_000], 2: [3_000], 3: [4_000]}
+	assert plan_output(full_sizes, delta_sizes, 100, 300 * 1024) == (1, 1)
+	# ~166 KB at every other frame
+	assert plan_output(full_sizes, delta_sizes, 100, 200 * 1024) == (2, 1)
+	# ~150 KB at every third frame, ~125 KB at 75%
+	assert plan_output(full_sizes, delta_sizes, 100, 150 * 1024) == (1, 0.75)
+	# nothing fits
+	assert plan_output(full_sizes, delta_sizes, 100, 1024) == (3, 0.5)
+	# a static animation's frames are all merged into one
+	assert plan_output(full_sizes, {1: [0], 2: [0], 3: [0]}, 100, 30 * 1024) == (1, 1)
+
+def _allocate(size):
+	return len(bytearray(size))
+
+def test_memory_limit_with_busy_parent():
+	import mmap
+	import threading
+
+	# a parent like the bot: lots of threads (each with its own stack and malloc arena) and a big address space
+	stop = threading.Event()
+	threads = [threading.Thread(target=stop.wait) for _ in range(8)]
+	for thread in threads:
+		thread.start()
+	reserved = mmap.mmap(-1, 1024 ** 3)
+
+	engine = RenderEngine(2, memory_limit=256 * 1024 ** 2)
+	try:
+		assert engine._submit(_allocate, 100 * 1024 ** 2).result() == 100 * 1024 ** 2
+		try:
+			engine._submit(_allocate, 512 * 1024 ** 2).result()
+		except MemoryError:
+			pass
+		else:
+			assert False, 'the worker should have run out of memory'
+	finally:
+		engine.shutdown()
+		reserved.close()
+		stop.set()
+		for thread in threads:
+			thread.join()
+
+def test_workers_are_recycled():
+	engine = RenderEngine(1, memory_limit=0, max_jobs_per_worker=2)
+	try:
+		pids = [engine._submit(os.getpid).result() for _ in range(3)]
+		# the third job gets a new worker, and the old one is gone rather than left alongside it
+		assert pids[0] == pids[1] != pids[2]
+		assert len(engine._pool._processes) <= engine.workers
+	finally:
+		engine.shutdown()
@@ -5,8 +5,9 @@ from pathlib import Path
 
 import semaphore
 from semaphore import StopPropagation
+from . import metrics
 from .bot import INTRO, build_stickers_client
-from .glue import convert_link_interactive, convert_pack_interactive, convert_to_telegram, signal_pack_url
+from .glue import convert_to_telegram, signal_pack_url
 
 logger = logging.getLogger(__name__)
 
@@ -30,6 +31,7 @@ def handler(pattern):
 					quote=True
 				)
 				logger.error('Unhandled exception in %s (%s)', f.__name__, ray_id, exc_info=exc)
+				metrics.record_handler_error(f.__name__, ray_id)
 
 		handlers.append((pattern, handler))
 		return handler
@@ -43,16 +45,10 @@ async def intro(ctx):
 @handler(r'^(https?|sgnl|tg)://')
 async def convert(ctx):
 	await ctx.message.mark_read()
-	async for _, response in convert_link_interactive(
-		ctx.bot.db,
-		ctx.bot.tg_client,
-		ctx.bot.stickers_client,
-		ctx.message.get_body(),
+	async for _, response in ctx.bot.jobs.convert_link_interactive(
+		ctx.message.get_body(), 'signal', signal_chat(ctx),
 	):
-		if isinstance(response, tuple):
-			await ctx.message.reply(signal_pack_url(*response[:2]), quote=True)
-		else:
-			await ctx.message.reply(response, quote=True)
+		await ctx.message.reply(format_response(response), quote=True)
 
 	raise StopPropagation
 
@@ -62,15 +58,26 @@ async def convert_sticker(ctx):
 	if sticker is None:
 		return
 	await ctx.message.mark_read()
-	async for _, response in convert_pack_interactive(
-		ctx.bot.db,
-		ctx.bot.tg_client,
-		ctx.bot.stickers_client,
+	async for _, response in ctx.bot.jobs.convert_pack_interactive(
 		convert_to_telegram,
-		sticker.pack.pack_id,
-		sticker.pack.pack_key,
+		(sticker.pack.pack_id, sticker.pack.pack_key),
+		'signal',
+		signal_chat(ctx),
 	):
-		await ctx.message.reply(response, quote=True)
+		await ctx.message.reply(format_response(response), quote=True)
+
+def format_response(response):
+	if isinstance(response, tuple):
+		return signal_pack_url(*response[:2])
+	return response
+
+def signal_chat(ctx):
+	return dict(receiver=ctx.message.get_group_id() or ctx.message.source.uuid)
+
+async def deliver(bot, chat, _, response):
+	"""Send the result of a queued conversion to the chat that requested it."""
+	# signald can't quote messages outside of a reply context, so just send it
+	await bot.send_message(chat['receiver'], format_response(response))
 
 def build_client(config, db, tg_client, stickers_client):
 	bot = semaphore.Bot(
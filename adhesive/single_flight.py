@@ -0,0 +1,107 @@
+import anyio
+
+class _Call:
+	__slots__ = 'done', 'result', 'exc'
+
+	def __init__(self):
+		self.done = anyio.create_event()
+		self.result = None
+		self.exc = None
+
+class SingleFlight:
+	"""Coalesce concurrent calls that share a key into one call whose outcome is shared by every caller."""
+
+	def __init__(self):
+		self.in_flight = {}
+
+	def __len__(self):
+		return len(self.in_flight)
+
+	def __contains__(self, key):
+		return key in self.in_flight
+
+	async def run(self, key, f, *args):
+		while key in self.in_flight:
+			call = self.in_flight[key]
+			await call.done.wait()
+			if call.exc is None:
+				return call.result
+			if isinstance(call.exc, Exception):
+				raise call.exc
+			# the leader was cancelled rather than failing, so there's no outcome to share.
+			# take over the call ourselves.
+
+		call = self.in_flight[key] = _Call()
+		try:
+			call.result = await f(*args)
+		except BaseException as exc:
+			call.exc = exc
+			raise
+		finally:
+			del self.in_flight[key]
+			await call.done.set()
+
+		return call.result
+
+def test_single_flight():
+	flight = SingleFlight()
+	calls = 0
+
+	async def f(gate, outcome):
+		nonlocal calls
+		calls += 1
+		await gate.wait()
+		if isinstance(outcome, Exception):
+			raise outcome
+		return outcome
+
+	async def run(results, *args):
+		try:
+			results.append(await flight.run('key', f, *args))
+		except ValueError as exc:
+			results.append(exc)
+
+	async def main():
+		nonlocal calls
+		async with anyio.create_task_group() as tg:
+			# followers share the leader's result, and the key is gone once it's done
+			results = []
+			gate = anyio.create_event()
+			for _ in range(3):
+				await tg.spawn(run, results, gate, 'result')
+			await anyio.sleep(0.01)
+			assert calls == 1 and 'key' in flight
+			await gate.set()
+			await anyio.sleep(0.01)
+			assert results == ['result'] * 3 and 'key' not in flight
+
+			# and its exception
+			calls = 0
+			results = []
+			gate = anyio.create_event()
+			exc = ValueError('failed')
+			for _ in range(2):
+				await tg.spawn(run, results, gate, exc)
+			await anyio.sleep(0.01)
+			await gate.set()
+			await anyio.sleep(0.01)
+			assert calls == 1 and results == [exc, exc] and not flight
+
+			# a follower takes over if the leader is cancelled
+			calls = 0
+			results = []
+			gate = anyio.create_event()
+			async with anyio.create_task_group() as leader:
+				await leader.spawn(run, [], gate, 'from the leader')
+				await anyio.sleep(0.01)
+				await tg.spawn(run, results, gate, 'from the follower')
+				await anyio.sleep(0.01)
+				await leader.cancel_scope.cancel()
+			await anyio.sleep(0.01)
+			assert calls == 2 and 'key' in flight
+			await gate.set()
+			await anyio.sleep(0.01)
+			# the follower called f again with its own arguments
+			assert results == ['from the follower'] and not flight
+
+	anyio.run(main)
@@ -0,0 +1,124 @@
+import os
+import time
+import shutil
+import logging
+import tempfile
+import contextlib
+from pathlib import Path
+
+import anyio
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = 'staging'
+# a week
+DEFAULT_MAX_AGE = 7 * 24 * 60 * 60
+
+class Staging:
+	"""Holds on to the converted images of Telegram packs that are being uploaded to Signal, until the upload succeeds.
+
+	Unlike BlobCache, nothing here is evicted to make room, so an upload that failed part of the way through
+	can be retried with exactly the same images, without downloading or transcoding them again.
+	Images are staged instead of being cached, and moved into the cache once the upload succeeds.
+	Packs are staged one directory per Telegram pack hash. Ones that haven't been touched in max_age seconds
+	were probably given up on, and are removed by collect_garbage().
+	"""
+
+	def __init__(self, path, max_age=DEFAULT_MAX_AGE, *, _timer=time.time):
+		self.path = Path(path)
+		self.max_age = max_age
+		self._timer = _timer
+		self.path.mkdir(parents=True, exist_ok=True)
+
+	@classmethod
+	def from_config(cls, config):
+		staging_config = config.get('staging', {})
+		return cls(staging_config.get('path', DEFAULT_PATH), staging_config.get('max_age', DEFAULT_MAX_AGE))
+
+	def _pack_path(self, tg_hash) -> Path:
+		return self.path / str(tg_hash)
+
+	def get_sync(self, tg_hash, sticker_id):
+		try:
+			return (self._pack_path(tg_hash) / str(sticker_id)).read_bytes()
+		except FileNotFoundError:
+			return None
+
+	def put_sync(self, tg_hash, sticker_id, data):
+		pack_path = self._pack_path(tg_hash)
+		pack_path.mkdir(exist_ok=True)
+		fd, tmp_path = tempfile.mkstemp(dir=pack_path, suffix='.tmp')
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				f.write(data)
+			os.replace(tmp_path, pack_path / str(sticker_id))
+		except BaseException:
+			with contextlib.suppress(FileNotFoundError):
+				os.unlink(tmp_path)
+			raise
+		# the directory's mtime is what collect_garbage goes by
+		os.utime(pack_path)
+
+	def discard_sync(self, tg_hash):
+		shutil.rmtree(self._pack_path(tg_hash), ignore_errors=True)
+
+	def move_to_cache_sync(self, tg_hash, cache, keys):
+		"""Hand a pack's staged images over to a BlobCache, then discard the rest. keys maps sticker IDs to cache keys."""
+		pack_path = self._pack_path(tg_hash)
+		for sticker_id, key in keys.items():
+			with contextlib.suppress(FileNotFoundError):
+				cache.adopt_sync(key, pack_path / str(sticker_id))
+		self.discard_sync(tg_hash)
+
+	def collect_garbage_sync(self) -> int:
+		"""Remove packs that haven't been staged to in max_age seconds. Returns how many were removed."""
+		cutoff = self._timer() - self.max_age
+		removed = 0
+		for pack_path in self.path.iterdir():
+			try:
+				if pack_path.stat().st_mtime >= cutoff:
+					continue
+			except FileNotFoundError:
+				continue
+			logger.info('Removing stale staged pack %s', pack_path.name)
+			shutil.rmtree(pack_path, ignore_errors=True)
+			removed += 1
+		return removed
+
+	async def get(self, tg_hash, sticker_id):
+		return await anyio.run_sync_in_worker_thread(self.get_sync, tg_hash, sticker_id)
+
+	async def put(self, tg_hash, sticker_id, data):
+		await anyio.run_sync_in_worker_thread(self.put_sync, tg_hash, sticker_id, data)
+
+	async def discard(self, tg_hash):
+		await anyio.run_sync_in_worker_thread(self.discard_sync, tg_hash)
+
+	async def move_to_cache(self, tg_hash, cache, keys):
+		await anyio.run_sync_in_worker_thread(self.move_to_cache_sync, tg_hash, cache, keys)
+
+	async def collect_garbage(self) -> int:
+		return await anyio.run_sync_in_worker_thread(self.collect_garbage_sync)
+
+def test_staging(tmp_path):
+	from .blob_cache import BlobCache
+
+	now = time.time()
+	staging = Staging(tmp_path, 60, _timer=lambda: now)
+	assert staging.get_sync(1234, 0) is None
+	staging.put_sync(1234, 0, memoryview(b'abc'))
+	staging.put_sync(1234, 1, b'def')
+	staging.put_sync(-5678, 0, b'ghi')
+	assert staging.get_sync(1234, 0) == b'abc'
+
+	os.utime(tmp_path / '-5678', (now - 61, now - 61))
+	assert staging.collect_garbage_sync() == 1
+	assert staging.get_sync(-5678, 0) is None
+	assert staging.get_sync(1234, 1) == b'def'
+
+	cache = BlobCache(tmp_path / 'cache', 100)
+	staging.move_to_cache_sync(1234, cache, {0: 'a', 1: 'b', 2: 'c'})
+	assert staging.get_sync(1234, 0) is None
+	assert not (tmp_path / '1234').exists()
+	assert (cache.get_sync('a'), cache.get_sync('b'), cache.get_sync('c')) == (b'abc', b'def', None)
+	assert cache.size == 6
@@ -0,0 +1,217 @@
+import time
+import inspect
+import logging
+from collections import OrderedDict
+
+import telethon.errors
+from telethon import tl
+
+from .single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Newer layers let messages.getStickerSet take the hash of the version we have, and answer
+# messages.stickerSetNotModified if it's still current. Use that when the installed Telethon has it.
+SUPPORTS_HASH = 'hash' in inspect.signature(tl.functions.messages.GetStickerSetRequest.__init__).parameters
+StickerSetNotModified = getattr(tl.types.messages, 'StickerSetNotModified', None)
+
+class _Entry:
+	__slots__ = 'result', 'fetched_at'
+
+	def __init__(self, result, fetched_at):
+		# None if the set doesn't exist
+		self.result = result
+		self.fetched_at = fetched_at
+
+class StickerSetCache:
+	"""An LRU cache of messages.StickerSet results, keyed by both short name and set ID.
+
+	Entries older than ttl seconds are revalidated, and sets that don't exist are remembered for negative_ttl seconds.
+	Documents from the cache may have stale file references, so pass max_age if they're going to be downloaded.
+	"""
+
+	def __init__(self, tg_client, *, max_size=1024, ttl=600, negative_ttl=60, _timer=time.monotonic):
+		self.tg_client = tg_client
+		self.max_size = max_size
+		self.ttl = ttl
+		self.negative_ttl = negative_ttl
+		self.hits = 0
+		self.misses = 0
+		self._timer = _timer
+		# key -> _Entry, least recently used first
+		self.entries = OrderedDict()
+		self.fetches = SingleFlight()
+
+	@classmethod
+	def from_config(cls, tg_client, config):
+		sticker_sets_config = config.get('sticker_sets', {})
+		return cls(
+			tg_client,
+			max_size=sticker_sets_config.get('max_size', 1024),
+			ttl=sticker_sets_config.get('ttl', 600),
+			negative_ttl=sticker_sets_config.get('negative_ttl', 60),
+		)
+
+	@staticmethod
+	def _key(input_sticker_set):
+		if isinstance(input_sticker_set, tl.types.InputStickerSetShortName):
+			# short names are case insensitive
+			return 'short_name', input_sticker_set.short_name.lower()
+		if isinstance(input_sticker_set, tl.types.InputStickerSetID):
+			return 'id', input_sticker_set.id
+		# e.g. the animated emoji set. those are rare enough not to bother caching.
+		return None
+
+	def _store(self, key, result, now):
+		if result is None:
+			keys = [key]
+		else:
+			keys = [('short_name', result.set.short_name.lower()), ('id', result.set.id)]
+
+		entry = _Entry(result, now)
+		for key in keys:
+			self.entries[key] = entry
+			self.entries.move_to_end(key)
+		while len(self.entries) > self.max_size:
+			self.entries.popitem(last=False)
+
+	def put(self, result):
+		"""Remember a messages.StickerSet we got some other way, e.g. by creating the set."""
+		self._store(None, result, self._timer())
+
+	def invalidate(self, *, short_name=None, set_id=None):
+		"""Forget a set, e.g. because we just created or changed it."""
+		if short_name is not None:
+			self.entries.pop(('short_name', short_name.lower()), None)
+		if set_id is not None:
+			self.entries.pop(('id', set_id), None)
+
+	async def get(self, input_sticker_set, *, max_age=None):
+		"""Return messages.getStickerSet(input_sticker_set), or raise StickersetInvalidError if there's no such set."""
+		request = tl.functions.messages.GetStickerSetRequest(input_sticker_set)
+		key = self._key(input_sticker_set)
+		if key is None:
+			return await self.tg_client(request)
+
+		entry = self.entries.get(key)
+		if entry is not None:
+			ttl = self.ttl if entry.result is not None else self.negative_ttl
+			if max_age is not None:
+				ttl = min(ttl, max_age)
+			if self._timer() - entry.fetched_at < ttl:
+				self.hits += 1
+				self.entries.move_to_end(key)
+				if entry.result is None:
+					raise telethon.errors.StickersetInvalidError(request)
+				return entry.result
+
+		self.misses += 1
+		# a set that's not modified still has the old file references, so don't revalidate if they need to be fresh.
+		# for the same reason, callers that need them fresh don't join a fetch that might revalidate.
+		fresh = max_age is not None
+		result = await self.fetches.run(
+			(key, fresh), self._fetch, key, input_sticker_set, None if fresh else entry,
+		)
+		if result is None:
+			raise telethon.errors.StickersetInvalidError(request)
+		return result
+
+	async def _fetch(self, key, input_sticker_set, entry):
+		now = self._timer()
+		if SUPPORTS_HASH and entry is not None and entry.result is not None:
+			request = tl.functions.messages.GetStickerSetRequest(input_sticker_set, hash=entry.result.set.hash)
+		else:
+			request = tl.functions.messages.GetStickerSetRequest(input_sticker_set)
+
+		try:
+			result = await self.tg_client(request)
+		except telethon.errors.StickersetInvalidError:
+			result = None
+
+		if StickerSetNotModified is not None and isinstance(result, StickerSetNotModified):
+			logger.debug('Sticker set %r not modified', key)
+			result = entry.result
+
+		self._store(key, result, now)
+		return result
+
+def test_sticker_set_cache():
+	import anyio
+	import pytest
+	from functools import partial
+	from .benchmark.fakes import FakeTelegramClient
+
+	class CountingClient(FakeTelegramClient):
+		def __init__(self):
+			super().__init__(latency=0)
+			self.fetches = 0
+			self.gate = None
+
+		async def __call__(self, request):
+			if isinstance(request, tl.functions.messages.GetStickerSetRequest):
+				self.fetches += 1
+				if self.gate is not None:
+					await self.gate.wait()
+			return await super().__call__(request)
+
+	now = 0.0
+	client = CountingClient()
+	a = client.add_sticker_set('a', [b'a'])
+	client.add_sticker_set('b', [b'b'])
+	client.add_sticker_set('c', [b'c'])
+	by_name = tl.types.InputStickerSetShortName
+
+	async def main():
+		nonlocal now
+		cache = StickerSetCache(client, ttl=100, negative_ttl=10, _timer=lambda: now)
+
+		# one fetch fills both keys, and short names are case insensitive
+		assert await cache.get(by_name('a')) is a
+		assert await cache.get(by_name('A')) is a
+		assert await cache.get(tl.types.InputStickerSetID(a.set.id, 0)) is a
+		assert client.fetches == 1 and cache.hits == 2
+
+		# max_age only applies to the caller that passed it
+		now = 50
+		await cache.get(by_name('a'), max_age=30)
+		assert client.fetches == 2
+		await cache.get(by_name('a'))
+		assert client.fetches == 2
+
+		now = 151
+		await cache.get(by_name('a'))
+		assert client.fetches == 3
+
+		# sets that don't exist are remembered for negative_ttl
+		for _ in range(2):
+			with pytest.raises(telethon.errors.StickersetInvalidError):
+				await cache.get(by_name('nope'))
+		assert client.fetches == 4
+		now += 11
+		with pytest.raises(telethon.errors.StickersetInvalidError):
+			await cache.get(by_name('nope'))
+		assert client.fetches == 5
+
+		# least recently used keys are evicted first
+		cache = StickerSetCache(client, max_size=4, _timer=lambda: now)
+		await cache.get(by_name('a'))
+		await cache.get(by_name('b'))
+		await cache.get(by_name('a'))
+		await cache.get(by_name('c'))
+		assert len(cache.entries) == 4
+		assert ('short_name', 'a') in cache.entries
+		assert ('short_name', 'b') not in cache.entries
+
+		# concurrent gets share a fetch, except callers that need fresh file references don't join one that doesn't
+		cache = StickerSetCache(client, _timer=lambda: now)
+		client.fetches = 0
+		client.gate = anyio.create_event()
+		async with anyio.create_task_group() as tg:
+			await tg.spawn(cache.get, by_name('a'))
+			await tg.spawn(cache.get, by_name('a'))
+			await tg.spawn(partial(cache.get, by_name('a'), max_age=0))
+			await anyio.sleep(0.01)
+			await client.gate.set()
+		assert client.fetches == 2
+
+	anyio.run(main)
@@ -1,16 +1,24 @@
+import copy
+import json
 import time
 import logging
-import itertools
+from secrets import token_hex, token_bytes
+from collections import OrderedDict
 
+import anyio
 import httpx
 
-from signalstickers_client.classes import downloader, uploader
+from signalstickers_client.classes import downloader
+from signalstickers_client.classes.signalcrypto import encrypt, derive_key
 from signalstickers_client.models import LocalStickerPack
+from signalstickers_client.urls import SERVICE_STICKER_FORM_URL, CDN_BASEURL
 from signalstickers_client.utils.ca import CACERT_PATH
-from signalstickers_client.errors import RateLimited as ServerRateLimited
+from signalstickers_client.errors import HTTPException, Unauthorized, RateLimited as ServerRateLimited
 
 from .leaky_bucket import LeakyBucketConfig, LeakyBucket
-from .utils import starstarmap
+from .account_scheduler import AccountScheduler
+from .single_flight import SingleFlight
+from .utils import starstarmap, chunked
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +28,9 @@ CREATE_PACK_RL = LeakyBucketConfig(bucket_size=50, leak_rate_per_second=20 / (60
 class RateLimited(Exception):
 	pass
 
+# how many stickers the official uploader sends to the CDN at once
+UPLOAD_CONCURRENCY = 5
+
 class Account:
 	__slots__ = 'username password bucket'.split()
 	def __init__(self, username, password, bucket=None):
@@ -30,57 +41,414 @@ class Account:
 		else:
 			self.bucket = bucket
 
+async def _upload_to_cdn(http, cdn_creds, encrypted_data):
+	"""Upload an object (the manifest or a sticker) to the CDN, with the credentials Signal gave us for it."""
+	# signalstickers_client has this too, but it's private
+	resp = await http.post(
+		CDN_BASEURL,
+		files={
+			'key': (None, cdn_creds['key']),
+			'x-amz-credential': (None, cdn_creds['credential']),
+			'acl': (None, cdn_creds['acl']),
+			'x-amz-algorithm': (None, cdn_creds['algorithm']),
+			'x-amz-date': (None, cdn_creds['date']),
+			'policy': (None, cdn_creds['policy']),
+			'x-amz-signature': (None, cdn_creds['signature']),
+			'Content-Type': (None, 'application/octet-stream'),
+			'file': (None, encrypted_data, 'application/octet-stream'),
+		},
+		timeout=None,
+	)
+	if resp.status_code not in range(200, 300):
+		raise HTTPException(resp, 'Unhandled HTTP exception while trying to upload to the sticker CDN')
+
+class _Upload:
+	"""How far along a pack upload is."""
+
+	__slots__ = 'pack_key', 'pack_attrs', 'manifest_uploaded', 'stickers_uploaded'
+
+	def __init__(self, pack_key, pack_attrs, manifest_uploaded=False, stickers_uploaded=()):
+		self.pack_key = pack_key
+		# the response to registering the pack: its ID and the credentials for uploading each part of it
+		self.pack_attrs = pack_attrs
+		self.manifest_uploaded = manifest_uploaded
+		self.stickers_uploaded = set(stickers_uploaded)
+
 class MultiStickersClient:
-	def __init__(self, db, accounts):
+	def __init__(
+		self, db, accounts, *, account_strategy='most_space', flush_interval=60, blob_cache=None, max_manifests=256,
+	):
 		self.db = db
 		self.http: httpx.AsyncClient
 
+		# Signal packs are immutable, so their manifests (in memory) and stickers (on disk, if blob_cache is given)
+		# can be cached for as long as we like
+		self.blob_cache = blob_cache
+		self.max_manifests = max_manifests
+		# (pack_id, pack_key) -> StickerPack without any image_data, least recently used first
+		self.manifests = OrderedDict()
+		self.fetches = SingleFlight()
+
 		self.accounts = list(starstarmap(Account, accounts))
+		self.scheduler = AccountScheduler(self.accounts, account_strategy)
+		# bucket state is written back to the db in batches, so that uploads don't wait on it
+		self.flush_interval = flush_interval
+		self.dirty = set()
 
 	async def __aenter__(self) -> 'MultiStickersClient':
 		self.http = await httpx.AsyncClient(verify=CACERT_PATH).__aenter__()
 		return self
 
 	async def __aexit__(self, *excinfo):
-		return await self.http.__aexit__(*excinfo)
+		try:
+			# we're probably being cancelled, but losing track of spent tokens could get accounts banned
+			async with anyio.open_cancel_scope(shield=True):
+				await self.flush()
+		finally:
+			return await self.http.__aexit__(*excinfo)
 
 	async def get_pack(self, pack_id, pack_key):
-		return await downloader.get_pack(self.http, pack_id, pack_key)
+		pack = await self.get_pack_metadata(pack_id, pack_key)
+
+		async def download(sticker):
+			sticker.image_data = await self.download_sticker(sticker.id, pack_id, pack_key)
+
+		async with anyio.create_task_group() as tg:
+			await tg.spawn(download, pack.cover)
+			for sticker in pack.stickers:
+				await tg.spawn(download, sticker)
+
+		return pack
 
 	async def get_pack_metadata(self, pack_id, pack_key):
-		return await downloader.get_pack_metadata(self.http, pack_id, pack_key)
+		# the key is part of the cache key so that nobody can read a cached pack without it
+		key = pack_id, pack_key
+		try:
+			pack = self.manifests[key]
+		except KeyError:
+			pack = await self.fetches.run(key, self._fetch_pack_metadata, key)
+		else:
+			self.manifests.move_to_end(key)
+
+		# callers fill in the image_data, which shouldn't stay in memory
+		return copy.deepcopy(pack)
+
+	async def _fetch_pack_metadata(self, key):
+		pack = await downloader.get_pack_metadata(self.http, *key)
+		self.manifests[key] = pack
+		while len(self.manifests) > self.max_manifests:
+			self.manifests.popitem(last=False)
+		return pack
 
 	async def download_sticker(self, sticker_id: int, pack_id, pack_key) -> bytes:
-		return await downloader.get_sticker(self.http, sticker_id, pack_id, pack_key)
+		if self.blob_cache is None:
+			return await downloader.get_sticker(self.http, sticker_id, pack_id, pack_key)
+
+		cache_key = self.blob_cache.key('signal-sticker', pack_id, pack_key, sticker_id)
+		data = await self.blob_cache.get(cache_key)
+		if data is None:
+			data = await self.fetches.run(cache_key, self._download_sticker, cache_key, sticker_id, pack_id, pack_key)
+		return data
 
-	async def upload_pack(self, pack: LocalStickerPack):
+	async def _download_sticker(self, cache_key, sticker_id, pack_id, pack_key):
+		data = await downloader.get_sticker(self.http, sticker_id, pack_id, pack_key)
+		await self.blob_cache.put(cache_key, data)
+		return data
+
+	async def upload_pack(self, pack: LocalStickerPack, *, checkpoint_key=None):
+		"""Upload a pack and return (pack_id, pack_key).
+
+		If checkpoint_key is given, progress is saved under it as the upload goes, and uploading the same pack
+		with the same key again resumes from there. Resuming doesn't spend another rate limit token.
+		"""
+		upload = None
+		if checkpoint_key is not None:
+			upload = await self._load_upload(checkpoint_key)
+		resumed = upload is not None
+		if resumed:
+			logger.info(
+				'Resuming upload of %s (%d of %d stickers already uploaded)',
+				checkpoint_key, len(upload.stickers_uploaded), pack.nb_stickers_with_cover,
+			)
+		else:
+			upload = await self._register_pack(pack)
+			if checkpoint_key is not None:
+				await self._save_upload(checkpoint_key, upload)
+
+		try:
+			await self._upload_contents(pack, upload, checkpoint_key)
+		except HTTPException as exc:
+			# the CDN credentials are signed with an expiry date. once that's passed, we have to start over.
+			if resumed and exc.status_code == 403:
+				logger.warning('Upload credentials for %s expired; the next attempt will start over', checkpoint_key)
+				await self.forget_upload(checkpoint_key)
+			raise
+
+		if checkpoint_key is not None:
+			await self.forget_upload(checkpoint_key)
+		return upload.pack_attrs['packId'], upload.pack_key
+
+	async def _register_pack(self, pack) -> '_Upload':
 		account = self.get_next_account()
 		try:
-			return await uploader.upload_pack(self.http, pack, account.username, account.password)
+			resp = await self.http.get(
+				SERVICE_STICKER_FORM_URL.format(nb_stickers=pack.nb_stickers_with_cover),
+				auth=(account.username, account.password),
+				timeout=None,
+			)
+			if resp.status_code == 401:
+				raise Unauthorized(resp, 'Invalid authentication')
+			if resp.status_code == 413:
+				raise ServerRateLimited(resp, 'Service rate limit exceeded, please try again later.')
+			if resp.status_code not in range(200, 300):
+				raise HTTPException(resp, 'Unhandled HTTP exception while trying to upload a pack')
 		except ServerRateLimited:
 			logger.warning(
 				'%s ratelimited but not detected client-side. Setting space_remaining to 0.', account.username
 			)
 			account.bucket.space_remaining = 0
+			self.scheduler.update(account)
+			self.dirty.add(account)
+			# don't risk forgetting this one if we crash
+			await self.flush()
 			raise
 		finally:
-			await self.save(account)
+			self.dirty.add(account)
+
+		return _Upload(token_hex(32), resp.json())
+
+	async def _upload_contents(self, pack, upload, checkpoint_key):
+		# the same steps as signalstickers_client.uploader.upload_pack, skipping the ones that are already done
+		aes_key, hmac_key = derive_key(upload.pack_key)
+
+		def encrypt_(plaintext):
+			return encrypt(plaintext=plaintext, aes_key=aes_key, hmac_key=hmac_key, iv=token_bytes(16))
+
+		if not upload.manifest_uploaded:
+			await _upload_to_cdn(self.http, upload.pack_attrs['manifest'], encrypt_(pack.manifest))
+			upload.manifest_uploaded = True
+			if checkpoint_key is not None:
+				await self._save_upload(checkpoint_key, upload)
+
+		async def upload_sticker(sticker):
+			await _upload_to_cdn(
+				self.http, upload.pack_attrs['stickers'][sticker.id], encrypt_(sticker.image_data),
+			)
+			upload.stickers_uploaded.add(sticker.id)
+
+		stickers = pack.stickers + [pack.cover] if pack.cover else pack.stickers
+		remaining = [sticker for sticker in stickers if sticker.id not in upload.stickers_uploaded]
+		for chunk in chunked(remaining, UPLOAD_CONCURRENCY):
+			try:
+				async with anyio.create_task_group() as tg:
+					for sticker in chunk:
+						await tg.spawn(upload_sticker, sticker)
+			finally:
+				if checkpoint_key is not None:
+					# save whichever ones made it, even if the others failed
+					async with anyio.open_cancel_scope(shield=True):
+						await self._save_upload(checkpoint_key, upload)
+
+	async def _load_upload(self, checkpoint_key):
+		row = await self.db.fetchone(
+			"""
+			SELECT signal_pack_key, pack_attrs, manifest_uploaded, stickers_uploaded
+			FROM signal_uploads
+			WHERE tg_hash = ?
+			""",
+			checkpoint_key,
+		)
+		if row is None:
+			return None
+		pack_key, pack_attrs, manifest_uploaded, stickers_uploaded = row
+		return _Upload(pack_key, json.loads(pack_attrs), bool(manifest_uploaded), set(json.loads(stickers_uploaded)))
+
+	async def _save_upload(self, checkpoint_key, upload):
+		await self.db.execute(
+			"""
+			INSERT OR REPLACE INTO signal_uploads
+				(tg_hash, signal_pack_key, pack_attrs, manifest_uploaded, stickers_uploaded, updated_at)
+			VALUES (?, ?, ?, ?, ?, ?)
+			""",
+			checkpoint_key,
+			upload.pack_key,
+			json.dumps(upload.pack_attrs),
+			upload.manifest_uploaded,
+			json.dumps(sorted(upload.stickers_uploaded)),
+			int(time.time()),
+		)
+
+	async def has_pending_upload(self, checkpoint_key) -> bool:
+		"""Return whether an upload saved under checkpoint_key can be resumed (so it won't need a token)."""
+		return await self.db.fetchone('SELECT 1 FROM signal_uploads WHERE tg_hash = ?', checkpoint_key) is not None
+
+	async def forget_upload(self, checkpoint_key):
+		await self.db.execute('DELETE FROM signal_uploads WHERE tg_hash = ?', checkpoint_key)
+
+	async def forget_stale_uploads(self, max_age) -> int:
+		"""Forget uploads that haven't made progress in max_age seconds. Returns how many were forgotten."""
+		rows = await self.db.fetchall(
+			'DELETE FROM signal_uploads WHERE updated_at < ? RETURNING tg_hash', int(time.time() - max_age),
+		)
+		return len(rows)
 
 	def get_next_account(self):
-		now = time.time()
-		for account in self.accounts:
-			if account.bucket.add(1, now=now):
-				return account
+		account = self.scheduler.acquire()
+		if account is not None:
+			return account
 
 		logger.warning('All accounts ratelimited.')
 		raise RateLimited('Unable to find an account with rate limit tokens remaining')
 
-	async def save(self, account):
-		await self.db.execute("""
-			INSERT OR REPLACE INTO signal_accounts (account_id, space_remaining, last_updated_at)
-			VALUES (?, ?, ?)
-		""", (account.username, account.bucket.space_remaining, account.bucket.last_updated_at))
+	async def flush(self):
+		"""Save the buckets of every account that's been used since the last flush."""
+		accounts, self.dirty = self.dirty, set()
+		# SQLite limits how many parameters a statement can have
+		chunks = list(chunked(accounts, 300))
+		for i, chunk in enumerate(chunks):
+			# a single statement is a single transaction, and other tasks sharing the connection can't interleave
+			try:
+				await self.db.execute(
+					"""
+					INSERT OR REPLACE INTO signal_accounts (account_id, space_remaining, last_updated_at)
+					VALUES """ + ', '.join(['(?, ?, ?)'] * len(chunk)),
+					*[
+						param
+						for account in chunk
+						for param in (account.username, account.bucket.space_remaining, account.bucket.last_updated_at)
+					],
+				)
+			except BaseException:
+				# try again next time
+				for chunk in chunks[i:]:
+					self.dirty.update(chunk)
+				raise
+
+	async def flush_periodically(self):
+		while True:
+			await anyio.sleep(self.flush_interval)
+			try:
+				await self.flush()
+			except Exception:
+				logger.exception('Failed to save Signal account rate limits')
 
 	def get_min_wait_time(self, amount=1):
-		now = time.time()
-		return min(account.bucket.get_wait_time(amount, now=now) for account in self.accounts)
+		return self.scheduler.get_min_wait_time(amount)
+
+class _FakeSignalService:
+	"""Stands in for the HTTP client, as Signal's pack registration endpoint and its CDN."""
+
+	def __init__(self):
+		self.registrations = 0
+		# object key -> uploaded contents
+		self.objects = {}
+		# object key -> status code to fail its next upload with
+		self.failures = {}
+
+	def _creds(self, key):
+		return dict(
+			key=key, credential='credential', acl='private', algorithm='AWS4-HMAC-SHA256', date='date',
+			policy='policy', signature='signature',
+		)
+
+	async def get(self, url, *, auth, timeout):
+		self.registrations += 1
+		pack_id = f'pack{self.registrations}'
+		num_stickers = int(url.rpartition('/')[2])
+		body = dict(
+			packId=pack_id,
+			manifest=self._creds(f'{pack_id}/manifest'),
+			stickers=[self._creds(f'{pack_id}/{i}') for i in range(num_stickers)],
+		)
+		return httpx.Response(200, json=body)
+
+	async def post(self, url, *, files, timeout):
+		assert url == CDN_BASEURL
+		key = files['key'][1]
+		status_code = self.failures.pop(key, 200)
+		if status_code == 200:
+			self.objects[key] = files['file'][1]
+		return httpx.Response(status_code)
+
+def test_upload_to_cdn():
+	service = _FakeSignalService()
+	creds = service._creds('pack/0')
+
+	async def main():
+		await _upload_to_cdn(service, creds, b'data')
+		assert service.objects == {'pack/0': b'data'}
+
+		service.failures['pack/0'] = 403
+		try:
+			await _upload_to_cdn(service, creds, b'data')
+		except HTTPException as exc:
+			assert exc.status_code == 403
+		else:
+			assert False, 'the upload should have failed'
+
+	anyio.run(main)
+
+def test_resumable_upload(tmp_path):
+	from signalstickers_client.models import Sticker
+	from .database import Database
+
+	pack = LocalStickerPack()
+	pack.title = 'Resumable'
+	pack.author = 'test'
+	for i in range(7):
+		sticker = Sticker()
+		sticker.id = i
+		sticker.emoji = '🙂'
+		sticker.image_data = bytes([i]) * 16
+		pack._addsticker(sticker)
+
+	service = _FakeSignalService()
+	posts = []
+	post = service.post
+
+	async def counting_post(url, *, files, timeout):
+		posts.append(files['key'][1])
+		return await post(url, files=files, timeout=timeout)
+
+	service.post = counting_post
+
+	async def upload(client, checkpoint_key):
+		try:
+			return await client.upload_pack(pack, checkpoint_key=checkpoint_key)
+		except HTTPException as exc:
+			return exc.status_code
+
+	async def main():
+		async with Database(tmp_path / 'db.sqlite3') as db:
+			await db.migrate()
+			client = MultiStickersClient(db, [dict(username='user', password='password')])
+			client.http = service
+			[account] = client.accounts
+			tokens = account.bucket.space_remaining
+
+			# fail in the second batch of stickers
+			service.failures['pack1/6'] = 500
+			assert await upload(client, 1) == 500
+			assert await client.has_pending_upload(1)
+			uploaded = (await client._load_upload(1)).stickers_uploaded
+			assert {0, 1, 2, 3, 4} <= uploaded and 6 not in uploaded
+
+			# resuming doesn't register the pack (or spend a token) again, or redo what was already uploaded
+			pack_key = (await client._load_upload(1)).pack_key
+			del posts[:]
+			assert await upload(client, 1) == ('pack1', pack_key)
+			assert service.registrations == 1 and round(tokens - account.bucket.space_remaining) == 1
+			assert 'pack1/manifest' not in posts and not uploaded & {int(key.partition('/')[2]) for key in posts}
+			assert len(service.objects) == 1 + 7
+			assert not await client.has_pending_upload(1)
+
+			# once the upload credentials have expired, the checkpoint is forgotten and the next attempt starts over
+			service.failures['pack2/0'] = 500
+			assert await upload(client, 2) == 500
+			service.failures['pack2/6'] = 403
+			assert await upload(client, 2) == 403
+			assert not await client.has_pending_upload(2)
+			assert (await upload(client, 2))[0] == 'pack3'
+			assert service.registrations == 3 and round(tokens - account.bucket.space_remaining) == 3
+
+	anyio.run(main)
@@ -14,12 +14,14 @@ from telethon import TelegramClient, errors, events, tl
 from signalstickers_client import StickersClient as SignalStickersClient
 
 from .glue import (
-	convert_link_interactive,
-	convert_pack_interactive,
+	attach_services,
+	start_services,
+	shutdown_services,
 	convert_to_signal,
 	signal_pack_url,
 	propose_to_signalstickers_dot_com,
 )
+from . import metrics
 from .bot import INTRO
 
 import logging
@@ -48,6 +50,7 @@ def register_event(*args, **kwargs):
 					f'Hey if you see the owner, give them this code okay? `{ray_id}`'
 				)
 				logger.error('Unhandled exception in %s (%s)', f.__name__, ray_id, exc_info=exc)
+				metrics.record_handler_error(f.__name__, ray_id)
 
 		event_handlers.append(handler)
 		return handler
@@ -60,8 +63,8 @@ async def intro(event):
 
 @register_event(events.NewMessage(pattern=r'^(https?|sgnl|tg)://'))
 async def convert(event):
-	async for is_link, response in convert_link_interactive(
-		event.client.db, event.client, event.client.stickers_client, event.message.message,
+	async for is_link, response in event.client.jobs.convert_link_interactive(
+		event.message.message, 'telegram', telegram_chat(event),
 	):
 		await maybe_enter_convo(event, is_link, response)
 	raise events.StopPropagation
@@ -82,11 +85,26 @@ def sticker_message_required(handler):
 @register_event(events.NewMessage)
 @sticker_message_required
 async def convert_sticker(event):
-	async for is_link, response in convert_pack_interactive(
-		event.client.db, event.client, event.client.stickers_client, convert_to_signal, event.sticker_set,
+	async for is_link, response in event.client.jobs.convert_pack_interactive(
+		convert_to_signal, (event.sticker_set,), 'telegram', telegram_chat(event),
 	):
 		await maybe_enter_convo(event, is_link, response)
 
+def telegram_chat(event):
+	return dict(chat_id=event.chat_id, message_id=event.message.id)
+
+async def deliver(client, chat, is_link, response):
+	"""Send the result of a queued conversion in reply to the message that requested it."""
+	message = await client.get_messages(chat['chat_id'], ids=chat['message_id'])
+	if message is None:
+		# they deleted their request, but they probably still want the pack
+		if isinstance(response, tuple):
+			response = signal_pack_url(*response[:2])
+		await client.send_message(chat['chat_id'], response, link_preview=False)
+		return
+	# messages have everything that maybe_enter_convo needs from an event
+	await maybe_enter_convo(message, is_link, response)
+
 async def maybe_enter_convo(event, is_link, response):
 	"""Go through the signalstickers.com propose flow if this is a Signal pack link"""
 	if not is_link or not isinstance(response, tuple):
@@ -262,22 +280,34 @@ def get_timeout_exc_class():
 
 	raise AssertionError('unexpected async library', backend)
 
-def build_client(config, db, stickers_client):
+def build_client(config, db, stickers_client, *, session_name=None, handle_events=True):
+	"""Set up a Telegram client with everything the converters need.
+
+	Clients that don't handle events (e.g. adhesive.batch's) don't receive updates either,
+	and should use a session_name of their own so that they don't share the bot's session file.
+	"""
 	tg_config = config['telegram']
 	signal_stickers_config = config['signal']['stickers']
 
-	client = TelegramClient(tg_config.get('session_name', 'adhesive'), tg_config['api_id'], tg_config['api_hash'])
+	client = TelegramClient(
+		session_name or tg_config.get('session_name', 'adhesive'), tg_config['api_id'], tg_config['api_hash'],
+		receive_updates=handle_events,
+	)
 	client.config = config
 	client.source_code_url = config['source_code_url']
 	client.stickers_client = stickers_client
 	client.db = db
+	attach_services(client, config)
 
-	for handler in event_handlers:
-		client.add_event_handler(handler)
+	if handle_events:
+		for handler in event_handlers:
+			client.add_event_handler(handler)
 
 	return client
 
-async def run(client):
+@contextlib.asynccontextmanager
+async def started(client):
+	start_services(client)
 	await client.start(bot_token=client.config['telegram']['api_token'])
 	client.user = await client.get_me()
 	# yes, with syntax really doesn't support parentheses
@@ -285,4 +315,11 @@ async def run(client):
 		client, \
 		httpx.AsyncClient(headers={'User-Agent': f'Adhesive ({client.config["source_code_url"]})'}) as client.http \
 	:
+		try:
+			yield client
+		finally:
+			shutdown_services(client)
+
+async def run(client):
+	async with started(client):
 		await client.run_until_disconnected()
@@ -0,0 +1,276 @@
+import io
+import os
+import math
+import time
+import logging
+import multiprocessing
+import concurrent.futures
+from collections import namedtuple
+
+import anyio
+import PIL.Image
+
+from .buffers import BufferReader
+
+logger = logging.getLogger(__name__)
+
+class Profile(namedtuple('Profile', 'name format box exact max_size compress_levels colors resample')):
+	"""How to transcode images for one use.
+
+	Images are resized to fit within box (or to exactly box, if exact), then encoded as cheaply as possible
+	while staying under max_size bytes: first at each of compress_levels in turn, then quantized to colors colors.
+	"""
+
+	__slots__ = ()
+
+	def rungs(self):
+		"""Return the (compress_level, colors) to try, cheapest first."""
+		rungs = [(level, None) for level in self.compress_levels]
+		if self.colors:
+			rungs.append((self.compress_levels[-1], self.colors))
+		return rungs
+
+	def with_config(self, config):
+		overrides = dict(config)
+		for key in 'box', 'compress_levels':
+			if key in overrides:
+				overrides[key] = tuple(overrides[key])
+		profile = self._replace(**overrides)
+		if profile.format != 'PNG':
+			raise ValueError(f'Transcode profile {self.name!r}: only PNG output is supported, not {profile.format!r}')
+		if not hasattr(PIL.Image, profile.resample.upper()):
+			raise ValueError(f'Transcode profile {self.name!r}: unknown resampling filter {profile.resample!r}')
+		return profile
+
+Profile.__new__.__defaults__ = ('PNG', (512, 512), False, None, (1, 6, 9), 256, 'lanczos')
+
+PROFILES = {profile.name: profile for profile in (
+	# Telegram wants static stickers to be 512px on their longest side and at most 512 KiB
+	Profile('telegram_sticker', box=(512, 512), max_size=512 * 1024),
+	# and sticker set thumbnails to be exactly 100×100 and at most 128 KiB.
+	# this would normally distort the image, but we assume that all stickers are square anyway
+	Profile('telegram_thumbnail', box=(100, 100), exact=True, max_size=128 * 1024),
+)}
+
+def build_profiles(transcode_config) -> dict:
+	profiles = dict(PROFILES)
+	for name, profile_config in transcode_config.get('profiles', {}).items():
+		profiles[name] = profiles.get(name, Profile(name)).with_config(profile_config)
+	return profiles
+
+class ImageTooLarge(ValueError):
+	pass
+
+# encoded size ÷ uncompressed size for each rung of each profile, learned as we go so that the first rung
+# we try is usually the cheapest one that fits. these are just the starting guesses.
+UNQUANTIZED_RATIO = 0.5
+QUANTIZED_RATIO = 0.2
+RATIO_SMOOTHING = 0.2
+# aim a bit under the limit so that a slightly optimistic guess doesn't cost a second encode
+SIZE_MARGIN = 0.9
+_ratios = {}
+
+def _guess_rung(ratios, rungs, raw_size, max_size, start):
+	for i in range(start, len(rungs)):
+		if ratios[i] * raw_size <= max_size * SIZE_MARGIN:
+			return i
+	return len(rungs) - 1
+
+def _resize(im, profile):
+	if profile.exact:
+		size = profile.box
+	else:
+		scale = min(profile.box[0] / im.width, profile.box[1] / im.height)
+		size = max(1, round(im.width * scale)), max(1, round(im.height * scale))
+	if im.size == size:
+		return im
+	return im.resize(size, getattr(PIL.Image, profile.resample.upper()))
+
+def _encode(im, compress_level, colors) -> memoryview:
+	if colors:
+		im = im.quantize(colors, method=PIL.Image.FASTOCTREE)
+	out = io.BytesIO()
+	im.save(out, format='PNG', compress_level=compress_level)
+	return out.getbuffer()
+
+def transcode(image_data, profile: Profile):
+	"""Transcode an image according to profile. Returns the image and how many encodes it took."""
+	im = _resize(PIL.Image.open(BufferReader(image_data)), profile)
+	rungs = profile.rungs()
+	if profile.max_size is None:
+		return _encode(im, *rungs[0]), 1
+
+	raw_size = im.width * im.height * len(im.getbands())
+	ratios = _ratios.setdefault(profile, [QUANTIZED_RATIO if colors else UNQUANTIZED_RATIO for _, colors in rungs])
+	i = _guess_rung(ratios, rungs, raw_size, profile.max_size, 0)
+	attempts = 0
+	while True:
+		out = _encode(im, *rungs[i])
+		attempts += 1
+		ratios[i] += RATIO_SMOOTHING * (len(out) / raw_size - ratios[i])
+		if len(out) <= profile.max_size:
+			return out, attempts
+		if i == len(rungs) - 1:
+			raise ImageTooLarge(
+				f"A sticker in this pack is still {len(out)} bytes after compressing it as much as I can, "
+				f"which is more than the {profile.max_size} that's allowed."
+			)
+		logger.debug('%s: %d bytes at %r is too big', profile.name, len(out), rungs[i])
+		i = _guess_rung(ratios, rungs, raw_size, profile.max_size, i + 1)
+
+def transcode_batch(items):
+	"""Transcode a list of (image_data, profile) pairs. Returns (image, seconds, attempts) for each one."""
+	results = []
+	for image_data, profile in items:
+		start = time.perf_counter()
+		out, attempts = transcode(image_data, profile)
+		results.append((out, time.perf_counter() - start, attempts))
+	return results
+
+def _transcode_batch_picklable(items):
+	# memoryviews can't be sent between processes
+	return [(bytes(out), seconds, attempts) for out, seconds, attempts in transcode_batch(items)]
+
+def _warm_up():
+	# load the image plugins we need ahead of time rather than during the first conversion
+	import PIL.WebPImagePlugin  # noqa: F401
+	import PIL.PngImagePlugin  # noqa: F401
+
+class ProfileStats:
+	__slots__ = 'images', 'seconds', 'attempts'
+
+	def __init__(self):
+		self.images = 0
+		self.seconds = 0.0
+		# how many encodes it took. any more than images means the size search guessed wrong
+		self.attempts = 0
+
+class Transcoder:
+	"""Base class for the ways of running Pillow work. Subclasses implement _run_batch."""
+
+	def __init__(self, workers=None, profiles=None):
+		self.workers = workers or os.cpu_count() or 1
+		self.profiles = PROFILES if profiles is None else profiles
+		# profile name -> ProfileStats
+		self.stats = {name: ProfileStats() for name in self.profiles}
+
+	def start(self):
+		pass
+
+	def shutdown(self):
+		pass
+
+	async def transcode(self, image_data, profile: str):
+		return (await self.transcode_batch([(image_data, profile)]))[0]
+
+	async def transcode_batch(self, items) -> list:
+		"""Transcode a whole pack's worth of (image_data, profile name) pairs, split evenly across workers."""
+		if not items:
+			return []
+
+		items = [(image_data, self.profiles[profile]) for image_data, profile in items]
+		batch_size = math.ceil(len(items) / self.workers)
+		batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+		results = [None] * len(batches)
+
+		async def run(i, batch):
+			results[i] = await self._run_batch(batch)
+
+		async with anyio.create_task_group() as tg:
+			for i, batch in enumerate(batches):
+				await tg.spawn(run, i, batch)
+
+		outs = []
+		for batch, batch_results in zip(batches, results):
+			for (_, profile), (out, seconds, attempts) in zip(batch, batch_results):
+				stats = self.stats[profile.name]
+				stats.images += 1
+				stats.seconds += seconds
+				stats.attempts += attempts
+				outs.append(out)
+		return outs
+
+	async def _run_batch(self, batch):
+		raise NotImplementedError
+
+class InlineTranscoder(Transcoder):
+	"""Transcode on the event loop thread. Only useful for debugging and benchmarking."""
+
+	def __init__(self, workers=None, profiles=None):
+		super().__init__(1, profiles)
+
+	async def _run_batch(self, batch):
+		return transcode_batch(batch)
+
+class ThreadTranscoder(Transcoder):
+	def __init__(self, workers=None, profiles=None):
+		super().__init__(workers, profiles)
+		self._limiter = None
+
+	async def _run_batch(self, batch):
+		if self._limiter is None:
+			self._limiter = anyio.create_capacity_limiter(self.workers)
+		return await anyio.run_sync_in_worker_thread(transcode_batch, batch, limiter=self._limiter)
+
+class ProcessTranscoder(Transcoder):
+	"""Transcode in worker processes so that encoding isn't bound by the GIL."""
+
+	def __init__(self, workers=None, profiles=None):
+		super().__init__(workers, profiles)
+		self._pool = None
+
+	def start(self):
+		if self._pool is not None:
+			return
+		# spawned rather than forked, since forking a process that's already running threads (as the bot is, by now)
+		# can leave the child stuck on a lock that some other thread held at the time
+		self._pool = concurrent.futures.ProcessPoolExecutor(
+			self.workers, mp_context=multiprocessing.get_context('spawn'), initializer=_warm_up,
+		)
+		# workers are started on demand, so submit one job per worker to get them all running now
+		# rather than during the first conversion
+		for _ in range(self.workers):
+			self._pool.submit(os.getpid)
+
+	def shutdown(self):
+		if self._pool is not None:
+			self._pool.shutdown(wait=False)
+			self._pool = None
+
+	async def _run_batch(self, batch):
+		self.start()
+		# memoryviews can't be pickled. this is free for images that are already bytes
+		batch = [(bytes(image_data), profile) for image_data, profile in batch]
+		future = self._pool.submit(_transcode_batch_picklable, batch)
+		try:
+			return await anyio.run_sync_in_worker_thread(future.result)
+		finally:
+			future.cancel()
+
+TRANSCODERS = dict(inline=InlineTranscoder, thread=ThreadTranscoder, process=ProcessTranscoder)
+
+def build_transcoder(config) -> Transcoder:
+	transcode_config = config.get('transcode', {})
+	kind = transcode_config.get('executor', 'thread')
+	try:
+		cls = TRANSCODERS[kind]
+	except KeyError:
+		raise ValueError(f'Invalid transcode executor {kind!r}. Must be one of {", ".join(TRANSCODERS)}.')
+
+	return cls(transcode_config.get('workers'), build_profiles(transcode_config))
+
+def _png(size, color):
+	out = io.BytesIO()
+	PIL.Image.new('RGBA', size, color).save(out, format='PNG')
+	return out.getvalue()
+
+def test_transcode_fits_box_and_limit():
+	profile = PROFILES['telegram_sticker']._replace(name='test', max_size=10 * 1024)
+	out, attempts = transcode(_png((256, 128), (255, 0, 0, 255)), profile)
+	assert PIL.Image.open(BufferReader(out)).size == (512, 256)
+	assert len(out) <= profile.max_size
+	# a solid color compresses so well that the cheapest encode was the right guess
+	assert attempts == 1
+
+	thumbnail, _ = transcode(_png((512, 256), (0, 0, 0, 0)), PROFILES['telegram_thumbnail'])
+	assert PIL.Image.open(BufferReader(thumbnail)).size == (100, 100)
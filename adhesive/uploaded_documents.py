@@ -0,0 +1,144 @@
+import time
+import hashlib
+import logging
+
+import telethon.errors
+from telethon import tl
+
+from .single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+class UploadedDocumentCache:
+	"""Remembers what we've uploaded to Telegram by the SHA-256 of its contents, so each image is only uploaded once.
+
+	The same sticker often turns up in more than one pack, and sometimes more than once in the same pack.
+	Uploads of the same contents that are in flight at once are coalesced, and finished ones are kept in the
+	uploaded_documents table so that they outlive restarts.
+	"""
+
+	def __init__(self, tg_client):
+		# the db is read from the client when it's needed, since services are attached before it's set
+		self.tg_client = tg_client
+		self.uploads = SingleFlight()
+		self.hits = 0
+		self.misses = 0
+
+	@staticmethod
+	def hash(data) -> bytes:
+		return hashlib.sha256(data).digest()
+
+	async def get_or_upload(self, mime_type, data, upload) -> tl.types.InputDocument:
+		"""Return the document with these contents, calling upload() to upload it if we don't have one yet."""
+		sha256 = self.hash(data)
+		return await self.uploads.run((sha256, mime_type), self._get_or_upload, sha256, mime_type, data, upload)
+
+	async def _get_or_upload(self, sha256, mime_type, data, upload):
+		row = await self.tg_client.db.fetchone(
+			"""
+			SELECT document_id, access_hash, file_reference
+			FROM uploaded_documents
+			WHERE sha256 = ? AND mime_type = ?
+			""",
+			sha256, mime_type,
+		)
+		if row is not None:
+			self.hits += 1
+			document_id, access_hash, file_reference = row
+			return tl.types.InputDocument(document_id, access_hash, file_reference)
+
+		self.misses += 1
+		document = await upload()
+		await self._store(sha256, mime_type, len(data), document)
+		return document
+
+	async def refresh(self, mime_type, data, upload) -> tl.types.InputDocument:
+		"""Return the document with these contents with a fresh file reference, e.g. after FileReferenceExpiredError.
+
+		If Telegram no longer has the document, it's uploaded again with upload().
+		"""
+		sha256 = self.hash(data)
+		try:
+			result = await self.tg_client(tl.functions.messages.GetDocumentByHashRequest(sha256, len(data), mime_type))
+		except telethon.errors.RPCError as exc:
+			logger.debug('Looking up document by hash failed: %r', exc)
+			result = None
+
+		if isinstance(result, tl.types.Document):
+			document = tl.types.InputDocument(result.id, result.access_hash, result.file_reference)
+		else:
+			logger.debug('Document %s is gone; uploading it again', sha256.hex())
+			document = await upload()
+		await self._store(sha256, mime_type, len(data), document)
+		return document
+
+	async def _store(self, sha256, mime_type, size, document):
+		await self.tg_client.db.execute(
+			"""
+			INSERT OR REPLACE INTO uploaded_documents
+				(sha256, mime_type, size, document_id, access_hash, file_reference, uploaded_at)
+			VALUES (?, ?, ?, ?, ?, ?, ?)
+			""",
+			sha256, mime_type, size, document.id, document.access_hash, document.file_reference, int(time.time()),
+		)
+
+def test_uploaded_document_cache(tmp_path):
+	import anyio
+	import telethon.utils
+	from functools import partial
+	from .database import Database
+	from .benchmark.fakes import FakeTelegramClient
+
+	tg_client = FakeTelegramClient(latency=0)
+	uploads = 0
+
+	async def upload(data):
+		nonlocal uploads
+		uploads += 1
+		# let the other uploads of the same contents pile up behind this one
+		await anyio.sleep(0.01)
+		file = await tg_client.upload_file(data)
+		media = await tg_client(tl.functions.messages.UploadMediaRequest('me', file))
+		return telethon.utils.get_input_document(media)
+
+	async def main():
+		async with Database(tmp_path / 'db.sqlite3') as db:
+			await db.migrate()
+			tg_client.db = db
+			cache = UploadedDocumentCache(tg_client)
+
+			# the same image more than once in a pack is uploaded once
+			documents = []
+			async def get(data, mime_type='image/png'):
+				documents.append(await cache.get_or_upload(mime_type, data, partial(upload, data)))
+			async with anyio.create_task_group() as tg:
+				for _ in range(3):
+					await tg.spawn(get, b'a')
+			assert uploads == 1 and cache.misses == 1
+			assert len({document.id for document in documents}) == 1
+			document = documents[0]
+
+			# but not if it's a different type
+			await get(b'a', 'image/webp')
+			assert uploads == 2
+
+			# uploads outlive restarts
+			cache = UploadedDocumentCache(tg_client)
+			assert (await cache.get_or_upload('image/png', b'a', partial(upload, b'a'))).id == document.id
+			assert uploads == 2 and cache.hits == 1
+
+			# refreshing looks the document up by its hash
+			refreshed = await cache.refresh('image/png', b'a', partial(upload, b'a'))
+			assert tg_client.files[refreshed.id] == b'a'
+			assert uploads == 2
+
+			# and uploads it again if Telegram doesn't have it any more
+			for document_id, data in list(tg_client.files.items()):
+				if data == b'a':
+					del tg_client.files[document_id]
+			refreshed = await cache.refresh('image/png', b'a', partial(upload, b'a'))
+			assert uploads == 3 and tg_client.files[refreshed.id] == b'a'
+			assert (await cache.get_or_upload('image/png', b'a', partial(upload, b'a'))).id == refreshed.id
+			assert uploads == 3
+
+	anyio.run(main)
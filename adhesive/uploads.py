@@ -0,0 +1,142 @@
+import time
+import logging
+
+import anyio
+import telethon.errors
+
+logger = logging.getLogger(__name__)
+
+class AdaptiveLimiter:
+	"""A concurrency limit tuned by additive increase/multiplicative decrease.
+
+	Every call that succeeds raises the limit by about one per limit's worth of calls;
+	every flood wait cuts it by decrease_factor.
+	Telethon quietly sleeps through short flood waits itself, so calls that take longer than slow_after seconds
+	are treated like flood waits too.
+	"""
+
+	def __init__(self, *, initial=1, minimum=1, maximum=8, decrease_factor=0.5, slow_after=10.0, _timer=time.monotonic):
+		self.limit = float(initial)
+		self.minimum = minimum
+		self.maximum = maximum
+		self.decrease_factor = decrease_factor
+		self.slow_after = slow_after
+		self.in_flight = 0
+		self._changed = None
+		self._timer = _timer
+
+	@classmethod
+	def from_config(cls, config):
+		uploads_config = config.get('uploads', {})
+		return cls(
+			initial=uploads_config.get('initial_concurrency', 1),
+			maximum=uploads_config.get('max_concurrency', 8),
+			slow_after=uploads_config.get('slow_after', 10.0),
+		)
+
+	async def _notify(self):
+		if self._changed is not None:
+			await self._changed.set()
+			self._changed = None
+
+	async def _acquire(self):
+		while self.in_flight >= int(self.limit):
+			if self._changed is None:
+				self._changed = anyio.create_event()
+			await self._changed.wait()
+		self.in_flight += 1
+
+	async def _release(self):
+		self.in_flight -= 1
+		await self._notify()
+
+	def _increase(self):
+		self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+	def _decrease(self):
+		old_limit = int(self.limit)
+		self.limit = max(self.minimum, self.limit * self.decrease_factor)
+		if int(self.limit) != old_limit:
+			logger.info('Upload concurrency decreased to %d', int(self.limit))
+
+	async def run(self, f, *args):
+		"""Return await f(*args), running no more than limit calls at once and retrying after flood waits."""
+		while True:
+			await self._acquire()
+			start = self._timer()
+			try:
+				rv = await f(*args)
+			except telethon.errors.FloodWaitError as exc:
+				self._decrease()
+				delay = exc.seconds
+			else:
+				if self._timer() - start > self.slow_after:
+					self._decrease()
+				else:
+					self._increase()
+				return rv
+			finally:
+				await self._release()
+
+			logger.warning('Told to wait %ds before uploading more', delay)
+			await anyio.sleep(delay)
+
+def test_adaptive_limiter():
+	now = 0.0
+	limiter = AdaptiveLimiter(initial=1, minimum=1, maximum=3, slow_after=10, _timer=lambda: now)
+	flood_waits = 0
+
+	async def upload(seconds=0, flood_wait=False):
+		nonlocal now, flood_waits
+		now += seconds
+		if flood_wait and not flood_waits:
+			flood_waits += 1
+			raise telethon.errors.FloodWaitError(request=None, capture=0)
+		return seconds
+
+	async def main():
+		# additive increase: +1/limit per success, up to the ceiling
+		assert await limiter.run(upload) == 0
+		assert limiter.limit == 2
+		await limiter.run(upload)
+		assert limiter.limit == 2.5
+		for _ in range(5):
+			await limiter.run(upload)
+		assert limiter.limit == 3
+
+		# a slow call counts as a flood wait
+		assert await limiter.run(upload, 11) == 11
+		assert limiter.limit == 1.5
+
+		# a flood wait halves it too, down to the floor, and the call is retried
+		assert await limiter.run(upload, 0, True) == 0
+		assert flood_waits == 1
+		# the retry succeeded, so it's back up from the floor
+		assert limiter.limit == 2
+		await limiter.run(upload, 11)
+		await limiter.run(upload, 11)
+		assert limiter.limit == 1
+		assert limiter.in_flight == 0
+
+		# no more than limit calls run at once
+		limiter.limit = 2
+		release = anyio.create_event()
+		running = 0
+		most_running = 0
+
+		async def blocked():
+			nonlocal running, most_running
+			running += 1
+			most_running = max(most_running, running)
+			await release.wait()
+			running -= 1
+
+		async with anyio.create_task_group() as tg:
+			for _ in range(4):
+				await tg.spawn(limiter.run, blocked)
+			await anyio.sleep(0.01)
+			assert running == 2
+			await release.set()
+		assert most_running == 2
+
+	anyio.run(main)
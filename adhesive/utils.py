@@ -1,3 +1,10 @@
+import itertools
+
 def starstarmap(f, xs):
 	for x in xs:
 		yield f(**x)
+
+def chunked(xs, n):
+	"""Yield lists of up to n items from xs."""
+	it = iter(xs)
+	return iter(lambda: list(itertools.islice(it, n)), [])
@@ -0,0 +1,79 @@
+-- The schema as it was before migrations were numbered (see adhesive.database).
+-- Databases from back then already have some or all of this, so every statement here must be idempotent.
+-- Later migrations only ever run once, so they don't need to be.
+
+-- This table stores packs converted from Telegram to Signal.
+CREATE TABLE IF NOT EXISTS packs (
+	tg_hash INTEGER PRIMARY KEY,
+	signal_pack_id BLOB NOT NULL,
+	signal_pack_key BLOB NOT NULL,
+	-- for timed deletion
+	-- UTC seconds since 1970 without leap seconds
+	converted_at INTEGER NOT NULL DEFAULT (cast(strftime('%s', 'now') AS INT))
+);
+
+CREATE INDEX IF NOT EXISTS old_pack_idx ON packs (converted_at);
+
+CREATE TABLE IF NOT EXISTS signal_accounts (
+	account_id TEXT PRIMARY KEY,
+	space_remaining INTEGER NOT NULL,
+	last_updated_at DOUBLE NOT NULL
+);
+
+-- Progress of Telegram→Signal uploads that haven't finished yet, so that retrying one picks up where it left off
+-- instead of registering the pack (and spending a rate limit token) all over again.
+-- The images being uploaded are kept in the staging directory (see adhesive.staging).
+CREATE TABLE IF NOT EXISTS signal_uploads (
+	tg_hash INTEGER PRIMARY KEY,
+	signal_pack_key TEXT NOT NULL,
+	-- JSON object of the pack ID and CDN upload credentials that Signal gave us when we registered the pack
+	pack_attrs TEXT NOT NULL,
+	manifest_uploaded BOOLEAN NOT NULL DEFAULT 0,
+	-- JSON array of the IDs of the stickers uploaded so far
+	stickers_uploaded TEXT NOT NULL DEFAULT '[]',
+	-- UTC seconds since 1970 without leap seconds
+	updated_at INTEGER NOT NULL DEFAULT (cast(strftime('%s', 'now') AS INT))
+);
+
+-- This table stores packs converted from Signal to Telegram.
+-- Our Telegram sticker pack short names are derived from the Signal pack_id, so this table is only a cache
+-- that saves asking Telegram whether a pack exists. glue.verify_telegram_packs removes packs that were deleted.
+CREATE TABLE IF NOT EXISTS telegram_packs (
+	signal_pack_id BLOB PRIMARY KEY,
+	tg_short_name TEXT NOT NULL,
+	-- UTC seconds since 1970 without leap seconds
+	converted_at INTEGER NOT NULL DEFAULT (cast(strftime('%s', 'now') AS INT))
+);
+
+-- Documents uploaded to Telegram, by the hash of their contents, so that the same image is never uploaded twice.
+-- See adhesive.uploaded_documents.
+CREATE TABLE IF NOT EXISTS uploaded_documents (
+	sha256 BLOB NOT NULL,
+	mime_type TEXT NOT NULL,
+	size INTEGER NOT NULL,
+	document_id INTEGER NOT NULL,
+	access_hash INTEGER NOT NULL,
+	file_reference BLOB NOT NULL,
+	-- UTC seconds since 1970 without leap seconds
+	uploaded_at INTEGER NOT NULL,
+	PRIMARY KEY (sha256, mime_type)
+);
+
+-- Conversions queued by adhesive.jobs.JobScheduler.
+CREATE TABLE IF NOT EXISTS jobs (
+	job_id INTEGER PRIMARY KEY,
+	-- the platform being converted to: 'signal' or 'telegram'
+	direction TEXT NOT NULL,
+	-- JSON array of the converter's arguments
+	pack_info TEXT NOT NULL,
+	-- the platform that the request came from, and where the result is sent: 'signal' or 'telegram'
+	platform TEXT NOT NULL,
+	-- JSON object identifying the chat to send the result to
+	chat TEXT NOT NULL,
+	-- one of 'pending', 'running', 'done', or 'failed'
+	state TEXT NOT NULL DEFAULT 'pending',
+	-- UTC seconds since 1970 without leap seconds
+	created_at INTEGER NOT NULL DEFAULT (cast(strftime('%s', 'now') AS INT))
+);
+
+CREATE INDEX IF NOT EXISTS pending_job_idx ON jobs (state, job_id);
@@ -0,0 +1,19 @@
+-- Links being converted by adhesive.batch, so that an interrupted run picks up where it stopped.
+CREATE TABLE batch_items (
+	-- the name of the run, which defaults to the name of the file the links were read from
+	run TEXT NOT NULL,
+	link TEXT NOT NULL,
+	-- where the link was in the input, so that links are converted in the order they were given
+	position INTEGER NOT NULL,
+	-- the platform being converted to: 'signal' or 'telegram'. NULL if the link isn't a sticker pack link
+	direction TEXT,
+	-- JSON array of the converter's arguments
+	pack_info TEXT,
+	-- one of 'pending', 'running', 'done', or 'failed'
+	state TEXT NOT NULL DEFAULT 'pending',
+	-- the JSON object that was written to the run's output, once it's done or failed
+	result TEXT,
+	PRIMARY KEY (run, link)
+);
+
+CREATE INDEX batch_pending_idx ON batch_items (run, state, position);
@@ -0,0 +1,11 @@
+-- When failed jobs and finished batch links finished, so that adhesive.maintenance can prune them after a while.
+-- UTC seconds since 1970 without leap seconds. NULL for ones that haven't finished (or that finished before this).
+ALTER TABLE jobs ADD COLUMN finished_at INTEGER;
+ALTER TABLE batch_items ADD COLUMN finished_at INTEGER;
+
+-- rows from before this migration are pruned too
+UPDATE jobs SET finished_at = created_at WHERE state IN ('done', 'failed');
+UPDATE batch_items SET finished_at = cast(strftime('%s', 'now') AS INT) WHERE state IN ('done', 'failed');
+
+CREATE INDEX finished_job_idx ON jobs (finished_at);
+CREATE INDEX finished_batch_item_idx ON batch_items (finished_at);